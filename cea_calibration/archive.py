@@ -0,0 +1,114 @@
+"""
+Archive of the best trial of a calibration. When a trial beats the trials finished before it, the inputs it wrote and
+the schedules and demand it simulated are compressed from its workspaces, one zip per scenario. At the end of the
+calibration the archive of the best trial is promoted into the scenarios, instead of simulating the best trial again.
+"""
+from __future__ import division
+from __future__ import print_function
+import json
+import os
+import shutil
+import zipfile
+import cea.inputlocator
+from hyperopt import JOB_STATE_DONE
+from cea_calibration.workspace import get_mutable_paths
+from cea_calibration.timing import timed
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+
+def get_archives_folder(project_path):
+    """project/output/calibration/archives"""
+    return os.path.join(project_path, 'output', 'calibration', 'archives')
+
+
+def get_best_archive_folder(archives_folder):
+    return os.path.join(archives_folder, 'best')
+
+
+def get_trial_archive_folder(archives_folder, tid):
+    """archive written by a trial, until it is kept as the best archive or removed (see ``keep_best_archive``)"""
+    return os.path.join(archives_folder, 'trial-%i' % tid)
+
+
+def get_scenario_archive_file(archive_folder, i):
+    return os.path.join(archive_folder, 'scenario-%i.zip' % i)
+
+
+def get_manifest_file(archive_folder):
+    return os.path.join(archive_folder, 'manifest.json')
+
+
+def get_archived_files(locator, demand_outputs):
+    """
+    Files of a scenario written by a trial: its inputs (see ``get_mutable_paths``), the schedules of its buildings and,
+    with ``demand_outputs``, the demand results.
+    """
+    paths = get_mutable_paths(locator) + [locator.get_schedule_model_folder()]
+    if demand_outputs:
+        paths.append(locator.get_demand_results_folder())
+    archived_files = []
+    for path in paths:
+        if os.path.isfile(path):
+            archived_files.append(path)
+        for folder, _, file_names in os.walk(path):
+            archived_files.extend(os.path.join(folder, file_name) for file_name in sorted(file_names))
+    return archived_files
+
+
+def archive_scenario(config, scenario, archive_file, demand_outputs):
+    """compresses the files written by the trial in the workspace ``scenario`` to ``archive_file``"""
+    locator = cea.inputlocator.InputLocator(scenario, config.plugins)
+    with timed('archive', locator.scenario):
+        with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for path in get_archived_files(locator, demand_outputs):
+                archive.write(path, os.path.relpath(path, locator.scenario))
+
+
+def write_manifest(archive_folder, tid, score, n_scenarios, demand_outputs):
+    """written once all the scenarios are archived, an archive without manifest is incomplete"""
+    with open(get_manifest_file(archive_folder), 'w') as f:
+        json.dump({'tid': tid, 'score': score, 'scenarios': n_scenarios, 'demand_outputs': demand_outputs}, f)
+
+
+def read_manifest(archive_folder):
+    """manifest of the archive, None if there is no complete archive in ``archive_folder``"""
+    manifest_file = get_manifest_file(archive_folder)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def keep_best_archive(archives_folder, trials):
+    """
+    Keeps the archive of the best finished trial (with all the measured buildings) as the best archive, and removes the
+    archives of the other finished trials. The archives of the trials that are still running are left alone.
+    """
+    if not os.path.exists(archives_folder):
+        return
+    finished_trials = [trial for trial in trials.trials if trial['state'] == JOB_STATE_DONE]
+    full_fidelity_trials = [trial for trial in finished_trials
+                            if trial['result'].get('fidelity', 1.0) == 1.0 and not trial['result'].get('pruned', False)]
+    if full_fidelity_trials:
+        best_trial = min(full_fidelity_trials, key=lambda trial: trial['result']['loss'])
+        trial_archive_folder = get_trial_archive_folder(archives_folder, best_trial['tid'])
+        if read_manifest(trial_archive_folder) is not None:
+            best_archive_folder = get_best_archive_folder(archives_folder)
+            shutil.rmtree(best_archive_folder, ignore_errors=True)
+            os.rename(trial_archive_folder, best_archive_folder)
+    for trial in finished_trials:
+        shutil.rmtree(get_trial_archive_folder(archives_folder, trial['tid']), ignore_errors=True)
+
+
+def promote_archive(archive_folder, i, scenario):
+    """extracts the archive of the ``i``-th scenario of the calibration into ``scenario``"""
+    with zipfile.ZipFile(get_scenario_archive_file(archive_folder, i)) as archive:
+        archive.extractall(scenario)
@@ -0,0 +1,400 @@
+"""
+Benchmark of the validation and the calibration, to track their speed and memory over releases. Synthetic projects of
+N scenarios x M buildings are generated in a temporary folder: building properties, weekly schedules, hourly demand
+results in the format of CEA and random monthly measurements around them. The archetypes mapper, schedules and demand
+of CEA are replaced by stand-ins (see ``use_standin_demand``), so the benchmark needs no database of CEA. Each case runs
+in its own process, so that its peak memory is its own, and the results are appended to a JSONL file.
+"""
+from __future__ import division
+from __future__ import print_function
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import cea.config
+import cea.inputlocator
+from cea.datamanagement import archetypes_mapper
+from cea.demand import demand_main
+from cea.demand.schedule_maker import schedule_maker
+from cea.utilities.dbf import dbf_to_dataframe, dataframe_to_dbf
+from cea.utilities.schedule_reader import read_cea_schedule, save_cea_schedule
+from cea_calibration.validation import validation, get_measured_building_names, MONTHS_IN_YEAR_NAMES
+from cea_calibration.demand_cache import get_monthly_demand_cache_file
+from cea_calibration.checkpoint import get_results_file, get_timings_file
+from cea_calibration.timing import get_peak_rss
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# hours of the synthetic year (2005, no 29th of February, starts on a Saturday)
+DATES = pd.date_range('2005-01-01', periods=8760, freq='h')
+MONTH = DATES.month.values
+# hour of the week of the schedules of CEA: 24 hours of weekdays, then Saturday and Sunday
+SCHEDULE_HOUR = np.select([DATES.dayofweek.values < 5, DATES.dayofweek.values == 5], [0, 24], 48) + DATES.hour.values
+# outdoor temperature of the synthetic climate [C]
+OUTDOOR_TEMPERATURE = (12.0 + 10.0 * np.sin(2 * np.pi * (DATES.dayofyear.values - 110) / 365) +
+                       4.0 * np.sin(2 * np.pi * (DATES.hour.values - 9) / 24))
+FOOTPRINT_M2 = 400.0
+COP = 3.0
+LOADS = ['GRID', 'E_sys', 'QC_sys', 'QH_sys']
+BENCHMARK_NAMES = ['validation_cold', 'validation_warm', 'modify_monthly_multiplier', 'write_inputs', 'calibration']
+
+
+def get_benchmark_results_file(project_path):
+    """project/output/calibration/calibration_benchmark.jsonl"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_benchmark.jsonl')
+
+
+def standin_archetypes_mapper(locator, update_architecture_dbf=False, update_air_conditioning_systems_dbf=False,
+                              update_indoor_comfort_dbf=False, update_internal_loads_dbf=False,
+                              update_supply_systems_dbf=False, update_schedule_operation_cea=True, buildings=None):
+    """stand-in of ``archetypes_mapper``: writes the same office schedule for all the buildings of the scenario"""
+    occupancy = [0.0] * 7 + [0.4, 0.8, 1.0, 1.0, 0.6, 0.6, 1.0, 1.0, 0.8, 0.4] + [0.0] * 7
+    schedule = {'DAY': ['WEEKDAY'] * 24 + ['SATURDAY'] * 24 + ['SUNDAY'] * 24,
+                'HOUR': list(range(1, 25)) * 3,
+                'OCCUPANCY': occupancy + [0.2 * value for value in occupancy] + [0.0] * 24,
+                'APPLIANCES': [max(0.1, value) for value in occupancy] * 2 + [0.1] * 24,
+                'LIGHTING': [max(0.05, value) for value in occupancy] * 2 + [0.05] * 24}
+    for building_name in dbf_to_dataframe(locator.get_building_architecture()).Name:
+        save_cea_schedule(schedule, {'METADATA': 'benchmark', 'MONTHLY_MULTIPLIER': [1.0] * 12},
+                          locator.get_building_weekly_schedules(building_name))
+
+
+def standin_schedule_maker_main(locator, config, building=None):
+    """stand-in of ``schedule_maker_main``: the stand-in demand reads the weekly schedules itself"""
+    pass
+
+
+def calc_standin_demand(architecture, internal_loads, indoor_comfort, zone, schedule, monthly_multiplier):
+    """
+    Hourly loads of a building [kWh] from its properties and schedule: the electricity of the appliances and lights,
+    and the heating (with hot water) and cooling of a simple heat balance with the synthetic climate, supplied by heat
+    pumps. Every calibrated parameter changes the grid demand.
+    """
+    area = zone['floors_ag'] * FOOTPRINT_M2
+    occupancy = np.asarray(schedule['OCCUPANCY'], dtype=float)[SCHEDULE_HOUR]
+    appliances = np.asarray(schedule['APPLIANCES'], dtype=float)[SCHEDULE_HOUR]
+    lighting = np.asarray(schedule['LIGHTING'], dtype=float)[SCHEDULE_HOUR]
+    multiplier = np.asarray(monthly_multiplier, dtype=float)[MONTH - 1]
+    electricity = (internal_loads['Ea_Wm2'] * appliances + internal_loads['El_Wm2'] * lighting) * area * multiplier
+    electricity = electricity / 1000  # kWh
+    people = area / internal_loads['Occ_m2pax'] * occupancy * multiplier
+    hot_water = people * internal_loads['Vww_lpdpax'] / 24 * 4.18 * 45 / 3600  # kWh
+    envelope = area * 0.01 * (0.5 + architecture['Hs_ag']) * (1.2 - architecture['Es'])  # kW/K
+    solar_gains = 0.0025 * area * architecture['Ns'] * np.clip(OUTDOOR_TEMPERATURE, 0, None)
+    gains = 0.8 * electricity + 0.1 * people + solar_gains
+    cooling = np.clip(envelope * (OUTDOOR_TEMPERATURE - indoor_comfort['Tcs_set_C']) + gains, 0, None)
+    heating = np.clip(envelope * (20.0 - OUTDOOR_TEMPERATURE) - gains, 0, None) + hot_water
+    return {'E_sys': electricity, 'QC_sys': cooling, 'QH_sys': heating,
+            'GRID': electricity + (cooling + heating) / COP}
+
+
+def write_standin_demand(locator, building_names, resolution_output='hourly', loads_output=()):
+    """
+    Writes the demand results of the buildings (see ``calc_standin_demand``) in the format of CEA, hourly or monthly,
+    with the ``loads_output`` (all the loads if empty).
+    """
+    architecture = dbf_to_dataframe(locator.get_building_architecture()).set_index('Name')
+    internal_loads = dbf_to_dataframe(locator.get_building_internal()).set_index('Name')
+    indoor_comfort = dbf_to_dataframe(locator.get_building_comfort()).set_index('Name')
+    zone = dbf_to_dataframe(os.path.splitext(locator.get_zone_geometry())[0] + '.dbf').set_index('Name')
+    loads = [load for load in LOADS if not loads_output or load in loads_output]
+    if resolution_output == 'monthly':
+        dates = DATES.to_period('M').unique().to_timestamp().strftime('%Y-%m-%d %H:%M:%S+00:00')
+    else:
+        dates = DATES.strftime('%Y-%m-%d %H:%M:%S+00:00')
+    for building_name in building_names:
+        schedule, metadata = read_cea_schedule(locator.get_building_weekly_schedules(building_name))
+        demand = calc_standin_demand(architecture.loc[building_name], internal_loads.loc[building_name],
+                                     indoor_comfort.loc[building_name], zone.loc[building_name], schedule,
+                                     metadata['MONTHLY_MULTIPLIER'])
+        if resolution_output == 'monthly':
+            demand = dict((load, np.bincount(MONTH - 1, weights=values, minlength=12)) for load, values in
+                          demand.items())
+        results = pd.DataFrame(OrderedDict([('DATE', dates), ('Name', building_name)] +
+                                           [(load + '_kWh', demand[load]) for load in loads]))
+        results.to_csv(locator.get_demand_results_file(building_name), index=False, float_format='%.3f')
+
+
+def standin_demand_calculation(locator, config):
+    """stand-in of ``demand_calculation``: the demand of ``demand:buildings`` with the outputs set in the config"""
+    write_standin_demand(locator, config.demand.buildings, config.demand.resolution_output,
+                         config.demand.loads_output)
+
+
+@contextmanager
+def use_standin_demand():
+    """replaces the archetypes mapper, schedules and demand of CEA by the stand-ins in the ``with`` block"""
+    originals = [(archetypes_mapper, 'archetypes_mapper', standin_archetypes_mapper),
+                 (schedule_maker, 'schedule_maker_main', standin_schedule_maker_main),
+                 (demand_main, 'demand_calculation', standin_demand_calculation)]
+    originals = [(module, name, getattr(module, name), standin) for module, name, standin in originals]
+    for module, name, _, standin in originals:
+        setattr(module, name, standin)
+    try:
+        yield
+    finally:
+        for module, name, original, _ in originals:
+            setattr(module, name, original)
+
+
+def make_synthetic_project(project_path, n_scenarios, n_buildings, plugins, seed=0):
+    """
+    Generates a project of ``n_scenarios`` scenarios with ``n_buildings`` buildings each: random building properties,
+    the schedules of the stand-in archetypes mapper, hourly demand results of the stand-in demand and monthly
+    measurements of the grid demand, 70% to 130% of the modelled demand with 5% noise per month.
+
+    :return: the paths of the scenarios
+    """
+    generator = np.random.default_rng(seed)
+    scenario_list = []
+    for i in range(n_scenarios):
+        scenario = os.path.join(project_path, 'scenario-%i' % i)
+        locator = cea.inputlocator.InputLocator(scenario, plugins)
+        building_names = ['B%i%04i' % (i, k) for k in range(n_buildings)]
+        zone_dbf = os.path.splitext(locator.get_zone_geometry())[0] + '.dbf'
+        tables = [(locator.get_building_architecture(),
+                   pd.DataFrame({'Name': building_names, 'Hs_ag': generator.uniform(0.1, 0.4, n_buildings),
+                                 'Es': generator.uniform(0.4, 0.9, n_buildings),
+                                 'Ns': generator.uniform(0.4, 1.0, n_buildings), 'void_deck': 0})),
+                  (locator.get_building_internal(),
+                   pd.DataFrame({'Name': building_names, 'Occ_m2pax': generator.uniform(25.0, 50.0, n_buildings),
+                                 'Vww_lpdpax': generator.uniform(20.0, 50.0, n_buildings),
+                                 'Ea_Wm2': generator.uniform(1.0, 8.0, n_buildings),
+                                 'El_Wm2': generator.uniform(1.0, 8.0, n_buildings)})),
+                  (locator.get_building_comfort(),
+                   pd.DataFrame({'Name': building_names, 'Tcs_set_C': generator.uniform(22.0, 27.0, n_buildings),
+                                 'Tcs_setb_C': 28.0})),
+                  (zone_dbf,
+                   pd.DataFrame({'Name': building_names, 'floors_ag': generator.integers(1, 10, n_buildings),
+                                 'height_ag': 30.0, 'floors_bg': 0, 'height_bg': 0.0}))]
+        for dbf_path, table in tables:
+            if not os.path.exists(os.path.dirname(dbf_path)):
+                os.makedirs(os.path.dirname(dbf_path))
+            dataframe_to_dbf(table, dbf_path)
+        standin_archetypes_mapper(locator)
+        write_standin_demand(locator, building_names)
+
+        monthly_modelled = np.array([np.bincount(MONTH - 1, weights=pd.read_csv(
+            locator.get_demand_results_file(building_name), usecols=['GRID_kWh'])['GRID_kWh'].values, minlength=12)
+                                     for building_name in building_names])
+        monthly_measured = (monthly_modelled * generator.uniform(0.7, 1.3, (n_buildings, 1)) *
+                            generator.normal(1.0, 0.05, (n_buildings, 12)))
+        measurements = pd.DataFrame(monthly_measured, columns=MONTHS_IN_YEAR_NAMES)
+        measurements.insert(0, 'ZipCode', 'ZIP')
+        measurements.insert(0, 'Name', building_names)
+        measurements['Variable'] = 'GRID_kWh'
+        measurements_file = locator.get_monthly_measurements()
+        if not os.path.exists(os.path.dirname(measurements_file)):
+            os.makedirs(os.path.dirname(measurements_file))
+        measurements.to_csv(measurements_file, index=False)
+        scenario_list.append(scenario)
+    return scenario_list
+
+
+def get_children_peak_rss():
+    """peak resident memory of the largest finished child process (e.g. of the pools of the calibration) [MB]"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def repeat_timed(function, repeats):
+    """wall times of ``repeats`` calls of ``function`` [s]"""
+    wall_times = []
+    for _ in range(repeats):
+        wall_time = time.perf_counter()
+        function()
+        wall_times.append(time.perf_counter() - wall_time)
+    return wall_times
+
+
+def bench_validation(config, scenario_list, repeats):
+    """``validation`` of all the measured buildings, without (cold) and with (warm) the monthly demand caches"""
+    locators = [cea.inputlocator.InputLocator(scenario, config.plugins) for scenario in scenario_list]
+    building_names = [get_measured_building_names(locator) for locator in locators]
+
+    def validate(cold):
+        for locator in locators:
+            cache_file = get_monthly_demand_cache_file(locator)
+            if cold and os.path.exists(cache_file):
+                os.remove(cache_file)
+        validation(scenario_list=scenario_list, locators_of_scenarios=locators,
+                   measured_building_names_of_scenarios=building_names)
+
+    return {'validation_cold': repeat_timed(lambda: validate(True), repeats),
+            'validation_warm': repeat_timed(lambda: validate(False), repeats)}
+
+
+def bench_monthly_multiplier(config, scenario_list, repeats):
+    """``modify_monthly_multiplier`` of all the scenarios (with the stand-in archetypes mapper)"""
+    from cea_calibration.calibration import read_scenario, calc_monthly_multipliers, modify_monthly_multiplier
+    locators = [cea.inputlocator.InputLocator(scenario, config.plugins) for scenario in scenario_list]
+    scenarios = [read_scenario(locator) for locator in locators]
+
+    def modify():
+        for locator, scenario in zip(locators, scenarios):
+            modify_monthly_multiplier(locator, config, scenario['measured_building_names'],
+                                      calc_monthly_multipliers(scenario['monthly_measured_demand']))
+
+    return {'modify_monthly_multiplier': repeat_timed(modify, repeats)}
+
+
+def bench_write_inputs(config, scenario_list, repeats):
+    """the inputs of a trial: the building properties varied around the middle of the ranges, written as DBF"""
+    from cea_calibration.calibration import (read_scenario, calc_input_tables, calc_building_parameters,
+                                             calc_perturbations, DYNAMIC_PARAMETERS)
+    from cea_calibration.screening import get_uniform_range
+    scenarios = [read_scenario(cea.inputlocator.InputLocator(scenario, config.plugins)) for scenario in scenario_list]
+    dynamic_params = dict((label, np.mean(get_uniform_range(expression)))
+                          for label, expression in DYNAMIC_PARAMETERS.items())
+
+    def write_inputs():
+        for scenario, Rand_it in zip(scenarios, calc_perturbations(0, scenarios)):
+            for dbf_path, table in calc_input_tables(scenario, calc_building_parameters(dynamic_params,
+                                                                                        Rand_it)).items():
+                dataframe_to_dbf(table, dbf_path)
+
+    return {'write_inputs': repeat_timed(write_inputs, repeats)}
+
+
+def bench_calibration(config, scenario_list, trials):
+    """``calibration`` with a budget of ``trials`` trials, with the calibration parameters of the config"""
+    from cea_calibration.calibration import calibration
+    config.calibration.max_evals = trials
+    config.calibration.resume = False
+    config.calibration.warm_start = None
+    config.calibration.distributed = 'off'
+    config.calibration.plateau_trials = 0
+    config.calibration.target_calibrated = 101  # the budget is always spent
+    config.calibration.profile_trial = None
+    wall_time = time.perf_counter()
+    calibration(config, scenario_list)
+    wall_time = time.perf_counter() - wall_time
+
+    project_path = config.project
+    results = pd.read_csv(get_results_file(project_path))
+    timings = pd.read_json(get_timings_file(project_path), lines=True)
+    return {'calibration': [wall_time],
+            'trials': len(results),
+            'simulated_buildings': float(results['fidelity'].sum()) * sum(
+                len(get_measured_building_names(cea.inputlocator.InputLocator(scenario, config.plugins)))
+                for scenario in scenario_list),
+            'phase_wall_s': timings.groupby('phase')['wall_s'].sum().round(3).to_dict()}
+
+
+def run_case(queue, bench, config, scenario_list, argument):
+    """runs a benchmark case with the stand-in demand in a process of its own and puts its results into ``queue``"""
+    try:
+        config.project = os.path.dirname(scenario_list[0])
+        config.scenario = scenario_list[0]
+        with use_standin_demand():
+            results = bench(config, scenario_list, argument)
+        results['peak_rss_mb'] = get_peak_rss()
+        results['peak_rss_children_mb'] = get_children_peak_rss()
+        queue.put(results)
+    except Exception:
+        queue.put(RuntimeError(traceback.format_exc()))
+
+
+def run_benchmark(config, n_scenarios, n_buildings, repeats, trials):
+    """
+    Benchmarks a synthetic project of ``n_scenarios`` x ``n_buildings``.
+
+    :return: one record per benchmark, with the median and minimum of its wall times and its throughput
+    """
+    project_path = tempfile.mkdtemp(prefix='cea-calibration-benchmark-')
+    try:
+        scenario_list = make_synthetic_project(project_path, n_scenarios, n_buildings, config.plugins)
+        records = []
+        for bench, argument in [(bench_validation, repeats), (bench_monthly_multiplier, repeats),
+                                (bench_write_inputs, repeats), (bench_calibration, trials)]:
+            if bench is bench_calibration and trials < 1:
+                continue
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_case, args=(queue, bench, config, scenario_list, argument))
+            process.start()
+            results = queue.get()
+            process.join()
+            if isinstance(results, Exception):
+                raise results
+            for name in BENCHMARK_NAMES:
+                if name not in results:
+                    continue
+                wall_times = results[name]
+                record = {'benchmark': name, 'scenarios': n_scenarios, 'buildings': n_buildings,
+                          'repeats': len(wall_times), 'wall_s': statistics.median(wall_times),
+                          'wall_min_s': min(wall_times),
+                          'buildings_per_s': n_scenarios * n_buildings / statistics.median(wall_times),
+                          'peak_rss_mb': results['peak_rss_mb'],
+                          'peak_rss_children_mb': results['peak_rss_children_mb']}
+                if name == 'calibration':
+                    record.update({'trials': results['trials'],
+                                   'trials_per_hour': results['trials'] / wall_times[0] * 3600,
+                                   'buildings_per_s': results['simulated_buildings'] / wall_times[0],
+                                   'phase_wall_s': results['phase_wall_s']})
+                records.append(record)
+        return records
+    finally:
+        shutil.rmtree(project_path, ignore_errors=True)
+
+
+def parse_size(size):
+    """number of scenarios and of buildings per scenario of a size 'NxM'"""
+    n_scenarios, n_buildings = size.lower().split('x')
+    return int(n_scenarios), int(n_buildings)
+
+
+def main(config):
+    """
+    Benchmarks the synthetic projects of ``benchmark:sizes`` and appends the results to ``benchmark:results-file``
+    (one JSON record per benchmark and size).
+
+    :param config:
+    :type config: cea.config.Configuration
+    :return:
+    """
+    results_file = config.benchmark.results_file or get_benchmark_results_file(config.project)
+    run = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'version': __version__,
+           'python': platform.python_version(), 'host': platform.node(), 'cpus': multiprocessing.cpu_count()}
+    records = []
+    for size in config.benchmark.sizes:
+        n_scenarios, n_buildings = parse_size(size)
+        print('Benchmarking {} scenarios x {} buildings'.format(n_scenarios, n_buildings))
+        records.extend(dict(run, **record) for record in run_benchmark(config, n_scenarios, n_buildings,
+                                                                        config.benchmark.repeats,
+                                                                        config.benchmark.trials))
+
+    if not os.path.exists(os.path.dirname(results_file)):
+        os.makedirs(os.path.dirname(results_file))
+    with open(results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    print(pd.DataFrame(records).reindex(columns=['benchmark', 'scenarios', 'buildings', 'wall_s', 'buildings_per_s',
+                                                 'trials_per_hour', 'peak_rss_mb']).to_string(index=False))
+    print('The results were appended to {}'.format(results_file))
+
+
+if __name__ == '__main__':
+    main(cea.config.Configuration())
@@ -3,7 +3,7 @@ This tool calibrates a set of inputs from CEA to minimize the error between mode
 """
 from __future__ import division
 from __future__ import print_function
-from hyperopt.pyll import scope
+from hyperopt.pyll import Apply, rec_eval
 import cea.config
 import cea.inputlocator
 from cea.utilities.dbf import dbf_to_dataframe, dataframe_to_dbf
@@ -12,13 +12,29 @@ from cea.demand import demand_main, schedule_maker
 from cea.demand.schedule_maker import schedule_maker
 from cea_calibration.validation import *
 from cea_calibration.global_variables import *
+from cea_calibration.workspace import create_workspaces, make_workspaces_folder, remove_workspace
+from cea_calibration.surrogate import make_surrogate, suggest_with_surrogate, update_surrogate
+from cea_calibration.checkpoint import make_checkpoint, update_checkpoint, get_results_file, get_perturbations_file, \
+    write_perturbations, read_perturbations
+from cea_calibration.archive import get_archives_folder, get_best_archive_folder, get_trial_archive_folder, \
+    get_scenario_archive_file, archive_scenario, write_manifest, read_manifest, promote_archive
+from cea_calibration.metrics import read_measured_buildings, calc_building_metrics, write_measured_buildings, \
+    NOT_SIMULATED
+from cea_calibration.screening import screen_parameters, calc_reduced_space
+from cea_calibration.distributed import get_queue_file, QueuePool, run_worker
+from cea_calibration.timing import timed, profiled, pop_phase_timings, calc_timing_summary, PHASE_TIMINGS
 from cea.utilities.schedule_reader import read_cea_schedule, save_cea_schedule
 from collections import OrderedDict
-from hyperopt import fmin, tpe, hp, Trials
+from hyperopt import fmin, fmin_pass_expr_memo_ctrl, tpe, hp, Trials, Domain, space_eval, partial, STATUS_OK, \
+    JOB_STATE_RUNNING, JOB_STATE_DONE
+from hyperopt.fmin import generate_trial
 import pandas as pd
 import numpy as np
-import glob2
+import math
+import multiprocessing
 import os
+import shutil
+from queue import Queue
 
 MONTHS_IN_YEAR_NAMES = ['JANUARY', 'FEBRUARY', 'MARCH', 'APRIL',
                         'MAY', 'JUNE', 'JULY', 'AUGUST', 'SEPTEMBER',
@@ -33,205 +49,1219 @@ __maintainer__ = "Daren Thomas"
 __email__ = "cea@arch.ethz.ch"
 __status__ = "Production"
 
-def modify_monthly_multiplier(locator, config, measured_building_names):
+##define fixed constant parameters (to be redefined by CEA config file)
+Tcs_setb_C = 40
+void_deck = 1
+height_bg = 0
+floors_bg = 0
+
+#  define a search space
+# DYNAMIC_PARAMETERS = OrderedDict([('Hs_ag', hp.uniform('Hs_ag', 0.1, 0.25)),
+#                                   ('Tcs_set_C', hp.uniform('Tcs_set_C', 24, 26)),
+#                                   ('Es', hp.uniform('Es', 0.4, 0.6)),
+#                                   ('Ns', hp.uniform('Ns', 0.4, 0.6)),
+#                                   ('Occ_m2pax', hp.uniform('Occ_m2pax', 35.0, 45.0)),
+#                                   ('Vww_lpdpax', hp.uniform('Vww_lpdpax', 25.0, 30.0)),
+#                                   ('Ea_Wm2', hp.uniform('Ea_Wm2', 1, 2.5)),
+#                                   ('El_Wm2', hp.uniform('El_Wm2', 1, 2.5))
+#                                   ])
+# the random variation of the parameters between the buildings is not searched, all the trials of a calibration use the
+# same variation (see ``calc_perturbations``)
+DYNAMIC_PARAMETERS = OrderedDict([('Hs_ag', hp.uniform('Hs_ag', 0.1, 0.40)),
+                                  ('Tcs_set_C', hp.uniform('Tcs_set_C', 22, 27)),
+                                  ('Es', hp.uniform('Es', 0.4, 0.9)),
+                                  ('Ns', hp.uniform('Ns', 0.4, 1.0)),
+                                  ('Occ_m2pax', hp.uniform('Occ_m2pax', 25.0, 50.0)),
+                                  ('Vww_lpdpax', hp.uniform('Vww_lpdpax', 20.0, 50.0)),
+                                  ('Ea_Wm2', hp.uniform('Ea_Wm2', 1, 8)),
+                                  ('El_Wm2', hp.uniform('El_Wm2', 1, 8))
+                                  ])
+# the search of each building of the decomposed calibration leaves out the parameters that ``calc_building_parameters``
+# sets to fixed values
+DECOMPOSED_PARAMETERS = OrderedDict((label, expression) for label, expression in DYNAMIC_PARAMETERS.items()
+                                    if label not in ['Hs_ag', 'Tcs_set_C'])
+
+
+def calc_monthly_multipliers(monthly_measured_demand):
+    """
+    Monthly multiplier of each building: the measured monthly loads normalised by the month with the highest load.
+
+    :param monthly_measured_demand: monthly measurements indexed by building name
+    :return: multipliers indexed by building name, one column per month
+    """
+    monthly_measured_demand = monthly_measured_demand[MONTHS_IN_YEAR_NAMES]
+    return monthly_measured_demand.div(monthly_measured_demand.max(axis=1), axis=0).round(2)
+
+
+def modify_monthly_multiplier(locator, config, measured_building_names, monthly_multipliers):
 
     ##create building input schedules to set monthly multiplier
-    archetypes_mapper.archetypes_mapper(locator,
-                      update_architecture_dbf=False,
-                      update_air_conditioning_systems_dbf=False,
-                      update_indoor_comfort_dbf=False,
-                      update_internal_loads_dbf=False,
-                      update_supply_systems_dbf=False,
-                      update_schedule_operation_cea=True,
-                      buildings=[])
-
-    ##calculate monthly multiplier based on buildings real consumption (adjusts monthly measured loads in CEA for each building accordingly to what is observed in real life)
-    for building_name in measured_building_names:
-        # monthly_measured_data = pd.read_csv(locator.get_monthly_measurements())
-        monthly_measured_data = locator.get_monthly_measurements.read()
-        fields_to_extract = ['Name'] + MONTHS_IN_YEAR_NAMES
-        monthly_measured_demand = monthly_measured_data[fields_to_extract].set_index('Name')
-        monthly_measured_demand = monthly_measured_demand.loc[building_name]
-        monthly_measured_demand = pd.DataFrame({'Month': monthly_measured_demand.index.values,
-                                                'measurements': monthly_measured_demand.values})
-        monthly_measured_load = monthly_measured_demand.measurements / max(monthly_measured_demand.measurements)
-
-        path_to_schedule = locator.get_building_weekly_schedules(building_name)
-        data_schedule, data_metadata = read_cea_schedule(path_to_schedule)
-        data_metadata["MONTHLY_MULTIPLIER"] = list(monthly_measured_load.round(2))
-
-        # save cea schedule format
-        save_cea_schedule(data_schedule, data_metadata, path_to_schedule)
-
-
-def calc_score(static_params, dynamic_params):
-    """
-    This tool reduces the error between observed (real life measured data) and predicted (output of the model data) values by changing some of CEA inputs.
-    Monthly data is compared in terms of NMBE and CvRMSE (follwing ASHRAE Guideline 14-2014).
-    A new input folder with measurements has to be created, with a csv each for monthly data provided as input for this tool.
-    The input file contains: Name (CEA ID)| ZipCode (optional) | Monthly Data (JAN - DEC) | Type of equivalent variable in CEA (GRID_kWh is the default for total electricity consumption)
-    The script prints the NBME and CvRMSE for each building in each iteration. It also outputs the number of calibrated buildings and a score metric (calibrated buildings weighted by their energy consumption).
-    A new output csv is generated providing the calibration results (iteration number, parameters tested and results(score metric))
+    with timed('archetypes_mapper', locator.scenario):
+        archetypes_mapper.archetypes_mapper(locator,
+                          update_architecture_dbf=False,
+                          update_air_conditioning_systems_dbf=False,
+                          update_indoor_comfort_dbf=False,
+                          update_internal_loads_dbf=False,
+                          update_supply_systems_dbf=False,
+                          update_schedule_operation_cea=True,
+                          buildings=[])
+
+    ##set monthly multiplier based on buildings real consumption (adjusts monthly measured loads in CEA for each building accordingly to what is observed in real life)
+    with timed('modify_monthly_multiplier', locator.scenario):
+        for building_name in measured_building_names:
+            path_to_schedule = locator.get_building_weekly_schedules(building_name)
+            data_schedule, data_metadata = read_cea_schedule(path_to_schedule)
+            data_metadata["MONTHLY_MULTIPLIER"] = list(monthly_multipliers.loc[building_name])
+
+            # save cea schedule format
+            save_cea_schedule(data_schedule, data_metadata, path_to_schedule)
+
+
+def read_scenario(locator):
     """
+    Reads the measurements and the building properties of a scenario (without modifying it).
 
-    ## define set of CEA inputs to be calibrated and initial guess values
-    SEED = dynamic_params['SEED']
-    np.random.seed (SEED)                   #initalize seed numpy randomly npy.random.seed (once call the function) - inside put the seed
-     #import random (initialize) npy.random.randint(low=1, high=100, size= number of buildings)/1000 - for every parameter.
-    Hs_ag = dynamic_params['Hs_ag']
-    Tcs_set_C = dynamic_params['Tcs_set_C']
-    Es = dynamic_params['Es']
-    Ns = dynamic_params['Ns']
-    Occ_m2pax = dynamic_params['Occ_m2pax']
-    Vww_lpdpax = dynamic_params['Vww_lpdpax']
-    Ea_Wm2 = dynamic_params['Ea_Wm2']
-    El_Wm2 = dynamic_params['El_Wm2']
+    :return: the state of the scenario needed by the trials (see ``prepare_scenario``)
+    """
+    monthly_measured_demand = locator.get_monthly_measurements.read().set_index('Name')
+    measured_building_names = list(monthly_measured_demand.index)
+    df_arch = dbf_to_dataframe(locator.get_building_architecture())
+    building_positions = dict((building_name, i) for i, building_name in enumerate(df_arch.Name))
+    return {'locator': locator,
+            'measured_building_names': measured_building_names,
+            'measured_building_positions': [building_positions[name] for name in measured_building_names],
+            'measured_loads': sorted(set(get_measured_loads(monthly_measured_demand))),
+            'monthly_measured_demand': monthly_measured_demand,
+            'architecture': df_arch,
+            'internal_loads': dbf_to_dataframe(locator.get_building_internal()),
+            'indoor_comfort': dbf_to_dataframe(locator.get_building_comfort())}
+
+
+def prepare_scenario(locator, config):
+    """
+    One-time preparation of a scenario for the calibration. Everything that does not depend on the parameters of a
+    trial is done here once, instead of in every trial: reading the measurements, setting the monthly multipliers of
+    the building schedules, writing the fixed zone parameters and reading the building properties that the trials
+    modify.
 
+    :return: the prepared state of the scenario, reused by all the trials run in it (see ``calc_score``)
+    """
+    with timed('read_inputs', locator.scenario):
+        prepared_scenario = read_scenario(locator)
+    prepared_scenario['monthly_multipliers'] = calc_monthly_multipliers(prepared_scenario['monthly_measured_demand'])
+    modify_monthly_multiplier(locator, config, prepared_scenario['measured_building_names'],
+                              prepared_scenario['monthly_multipliers'])
+
+    # the fixed parameters of the zone are the same for all the trials
+    with timed('write_inputs', locator.scenario):
+        zone_dbf = os.path.splitext(locator.get_zone_geometry())[0] + '.dbf'
+        df_zone = dbf_to_dataframe(zone_dbf)
+        df_zone.height_bg = height_bg
+        df_zone.floors_bg = floors_bg
+        dataframe_to_dbf(df_zone, zone_dbf)
+    # the building properties last written by a trial (see ``select_changed_tables``)
+    prepared_scenario['written_tables'] = {}
+
+    return prepared_scenario
+
+
+def prepare_scenarios(scenario_list, config):
+    prepared_scenarios = []
+    for scenario in scenario_list:
+        config.scenario = scenario
+        locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
+        prepared_scenarios.append(prepare_scenario(locator, config))
+    return prepared_scenarios
+
+
+def set_calibration_demand_outputs(config, measured_loads):
+    """
+    During the calibration the demand only writes what the validation reads: the measured loads at monthly resolution,
+    without mass flows and temperatures. This cuts the size of the demand results (and the time to write and read
+    them) in every trial.
+    """
+    config.demand.resolution_output = 'monthly'
+    config.demand.loads_output = measured_loads
+    config.demand.massflows_output = []
+    config.demand.temperatures_output = []
+
+
+def calc_perturbations(seed, prepared_scenarios):
+    """
+    Random variation (-30% to +30%) of the calibrated parameters of each building, one array per scenario with a value
+    for each building of the building properties. The variation is drawn from its own generator seeded with ``seed``,
+    so it does not depend on (or change) any other random numbers of the process. All the trials of a calibration use
+    the seed of the calibration (common random numbers), so that the differences between their scores come from their
+    parameters only.
+    """
+    generator = np.random.default_rng(seed)
+    return [generator.integers(low=-30, high=30, size=prepared_scenario['architecture'].shape[0]) / 100
+            for prepared_scenario in prepared_scenarios]
+
+
+def calc_building_parameters(dynamic_params, Rand_it):
+    """
+    Values of the calibrated parameters for the buildings of a scenario: the values of the trial, varied by
+    ``Rand_it`` for each building. Hs_ag and Tcs_set_C are fixed, their values in the trial are not used.
+
+    :return: dict of parameter -> array with the value of each building
+    """
     ##define fixed constant parameters (to be redefined by CEA config file)
     Hs_ag = 0.15
     Tcs_set_C = 28
-    Tcs_setb_C = 40
-    void_deck = 1
-    height_bg = 0
-    floors_bg = 0
+
+    return OrderedDict([('Hs_ag', Hs_ag*(1+Rand_it)),
+                        ('Tcs_set_C', Tcs_set_C*(1+Rand_it)),
+                        ('Es', dynamic_params['Es']*(1+Rand_it)),
+                        ('Ns', dynamic_params['Ns']*(1+Rand_it)),
+                        ('Occ_m2pax', dynamic_params['Occ_m2pax']*(1+Rand_it)),
+                        ('Vww_lpdpax', dynamic_params['Vww_lpdpax']*(1+Rand_it)),
+                        ('Ea_Wm2', dynamic_params['Ea_Wm2']*(1+Rand_it)),
+                        ('El_Wm2', dynamic_params['El_Wm2']*(1+Rand_it))])
+
+
+def calc_measured_building_parameters(dynamic_params, prepared_scenarios, seed):
+    """
+    Values of the calibrated parameters of the measured buildings of all the scenarios, in the order used by the
+    validation.
+
+    :return: array of (measured buildings x parameters)
+    """
+    measured_building_parameters = []
+    for prepared_scenario, Rand_it in zip(prepared_scenarios, calc_perturbations(seed, prepared_scenarios)):
+        building_parameters = calc_building_parameters(dynamic_params, Rand_it)
+        positions = prepared_scenario['measured_building_positions']
+        measured_building_parameters.append(np.array([values[positions] for values in building_parameters.values()]).T)
+    return np.concatenate(measured_building_parameters)
+
+
+def select_measured_buildings(prepared_scenarios, fidelity):
+    """
+    Measured buildings simulated by a trial of the given fidelity: a share ``fidelity`` of the measured buildings of all
+    the scenarios, always drawn in the same random order, so that the buildings of a lower fidelity are also part of
+    every higher fidelity.
+
+    :return: list with the names of the selected buildings of each scenario, and the share of the measured consumption
+        of all the buildings that these buildings represent
+    """
+    measured_buildings = [(i, name) for i, prepared_scenario in enumerate(prepared_scenarios)
+                          for name in prepared_scenario['measured_building_names']]
+    n_selected = max(1, int(round(fidelity * len(measured_buildings))))
+    order = np.random.RandomState(0).permutation(len(measured_buildings))
+    selected = set(measured_buildings[k] for k in order[:n_selected])
+
+    selected_building_names_of_scenarios = []
+    selected_consumption = 0.0
+    total_consumption = 0.0
+    for i, prepared_scenario in enumerate(prepared_scenarios):
+        consumption = prepared_scenario['monthly_measured_demand'][MONTHS_IN_YEAR_NAMES].sum(axis=1)
+        selected_building_names = [name for name in prepared_scenario['measured_building_names']
+                                   if (i, name) in selected]
+        selected_building_names_of_scenarios.append(selected_building_names)
+        selected_consumption += consumption.loc[selected_building_names].sum()
+        total_consumption += consumption.sum()
+    return selected_building_names_of_scenarios, selected_consumption / total_consumption
+
+
+def get_consumption(prepared_scenario, building_names):
+    """measured annual consumption of the buildings [kWh]"""
+    return prepared_scenario['monthly_measured_demand'].loc[building_names, MONTHS_IN_YEAR_NAMES].values.sum(axis=1)
+
+
+def split_into_batches(prepared_scenarios, building_names_of_scenarios, n_batches):
+    """
+    Splits the buildings of all the scenarios into ``n_batches`` batches of buildings simulated together, in descending
+    order of their measured consumption (the buildings that weigh most in the score come first).
+
+    :return: list of batches, each with the list of building names of each scenario
+    """
+    buildings = [(consumption, i, name) for i, (prepared_scenario, building_names) in
+                 enumerate(zip(prepared_scenarios, building_names_of_scenarios))
+                 for consumption, name in zip(get_consumption(prepared_scenario, building_names), building_names)]
+    buildings.sort(key=lambda building: -building[0])
+    batches = []
+    for batch in np.array_split(np.arange(len(buildings)), min(n_batches, len(buildings))):
+        batch_buildings = set(buildings[k][1:] for k in batch)
+        batches.append([[name for name in building_names if (i, name) in batch_buildings]
+                        for i, building_names in enumerate(building_names_of_scenarios)])
+    return batches
+
+
+def calc_input_tables(prepared_scenario, building_parameters):
+    """
+    Building properties of a scenario with the calibrated parameters of a trial.
+
+    :return: dict of path of the dbf file -> table to write to it
+    """
+    locator = prepared_scenario['locator']
+
+    # Changes and saves variables related to the architecture
+    df_arch = prepared_scenario['architecture'].copy()
+    df_arch.Es = building_parameters['Es']
+    df_arch.Ns = building_parameters['Ns']
+    df_arch.Hs_ag = building_parameters['Hs_ag']
+    df_arch.void_deck = void_deck
+
+    # Changes and saves variables related to intetnal loads
+    df_intload = prepared_scenario['internal_loads'].copy()
+    df_intload.Occ_m2pax = building_parameters['Occ_m2pax']
+    df_intload.Vww_lpdpax = building_parameters['Vww_lpdpax']
+    df_intload.Ea_Wm2 = building_parameters['Ea_Wm2']
+    df_intload.El_Wm2 = building_parameters['El_Wm2']
+
+    #Changes and saves variables related to comfort
+    df_comfort = prepared_scenario['indoor_comfort'].copy()
+    df_comfort.Tcs_set_C = building_parameters['Tcs_set_C']
+    df_comfort.Tcs_setb_C = Tcs_setb_C
+
+    return OrderedDict([(locator.get_building_architecture(), df_arch),
+                        (locator.get_building_internal(), df_intload),
+                        (locator.get_building_comfort(), df_comfort)])
+
+
+def select_changed_tables(prepared_scenario, input_tables):
+    """
+    The ``input_tables`` (see ``calc_input_tables``) that differ from the tables last written to the scenario by the
+    trials, None if none of them changed. Only the trials write these tables, so a table that did not change does not
+    need to be written again (e.g. the tables without the parameter changed by a step of the screening, or the tables
+    of a trial evaluated again at a higher fidelity). The selected tables are remembered as written.
+    """
+    written_tables = prepared_scenario['written_tables']
+    changed_tables = OrderedDict((dbf_path, table) for dbf_path, table in input_tables.items()
+                                 if dbf_path not in written_tables or not written_tables[dbf_path].equals(table))
+    written_tables.update(changed_tables)
+    return changed_tables or None
+
+
+def simulate_scenario(config, scenario, input_tables, building_names, measured_loads):
+    """
+    Writes the inputs of a trial to a scenario (``input_tables``, see ``calc_input_tables``, None if they are written
+    already) and runs the schedules and the energy demand of ``building_names``.
+    """
+    config.scenario = scenario
+    locator = cea.inputlocator.InputLocator(scenario, config.plugins)
+    if input_tables is not None:
+        with timed('write_inputs', scenario):
+            for dbf_path, table in input_tables.items():
+                dataframe_to_dbf(table, dbf_path)
+
+    config.schedule_maker.buildings = building_names
+    with timed('schedule_maker', scenario):
+        schedule_maker.schedule_maker_main(locator, config)
+    config.demand.buildings = building_names
+    if config.calibration.reduced_demand_output:
+        set_calibration_demand_outputs(config, measured_loads)
+    with timed('demand', scenario):
+        demand_main.demand_calculation(locator, config)
+
+
+# configuration of a scenario worker process (set once per worker by ``init_scenario_worker``)
+SCENARIO_WORKER_CONFIG = {}
+
+
+def init_scenario_worker(config):
+    config.multiprocessing = False  # the scenarios already run in parallel, a worker can not start its own pool
+    np.random.seed()  # forked workers would all continue the random numbers of the parent
+    SCENARIO_WORKER_CONFIG['config'] = config
+
+
+def run_in_scenario_worker(function, args):
+    return function(SCENARIO_WORKER_CONFIG['config'], *args), pop_phase_timings()
+
+
+def make_scenario_pool(config, concurrent_scenarios):
+    """pool of processes running the scenarios of a trial concurrently, None to run them one after the other"""
+    if concurrent_scenarios < 2:
+        return None
+    return multiprocessing.Pool(concurrent_scenarios, initializer=init_scenario_worker, initargs=(config,))
+
+
+def get_concurrent_scenarios(config, list_scenarios):
+    return max(1, min(config.calibration.concurrent_scenarios, config.get_number_of_processes(), len(list_scenarios)))
+
+
+def map_scenarios(config, scenario_pool, function, tasks, sizes):
+    """
+    Runs ``function(config, *task)`` for each task (the work of one scenario). With a ``scenario_pool`` the tasks run
+    concurrently and the largest ones (by ``sizes``) start first, so that a large scenario does not start last and
+    keep the others waiting. The phase timings of the workers are collected in this process.
+
+    :return: the results of the tasks, in the order of ``tasks``
+    """
+    if scenario_pool is None:
+        return [function(config, *task) for task in tasks]
+    order = sorted(range(len(tasks)), key=lambda t: -sizes[t])
+    pending = [(t, scenario_pool.apply_async(run_in_scenario_worker, (function, tasks[t]))) for t in order]
+    results = [None] * len(tasks)
+    for t, pending_result in pending:
+        results[t], phase_timings = pending_result.get()
+        PHASE_TIMINGS.extend(phase_timings)
+    return results
+
+
+def calc_score(static_params, dynamic_params, seed, fidelity=1.0, prune_below=None):
+    """
+    Simulates the trial ``dynamic_params`` with ``fidelity`` of the measured buildings and scores it (see the README).
+
+    :return: the score, whether the trial was pruned and the (scenario index, name) of the validated buildings
+    """
 
     scenario_list = static_params['scenario_list']
     config = static_params['config']
+    prepared_scenarios = static_params['prepared_scenarios']
+
+    ## define set of CEA inputs to be calibrated and initial guess values
+    perturbations = calc_perturbations(seed, prepared_scenarios)
+    selected_building_names_of_scenarios, selected_share = select_measured_buildings(prepared_scenarios, fidelity)
+
+    input_tables_of_scenarios = []
+    for prepared_scenario, Rand_it in zip(prepared_scenarios, perturbations):
+        ## overwrite inputs with corresponding initial values
+        input_tables_of_scenarios.append(calc_input_tables(prepared_scenario,
+                                                           calc_building_parameters(dynamic_params, Rand_it)))
+
+    ## run building schedules and energy demand, batch by batch and scenario by scenario (concurrently with a
+    ## ``scenario_pool``), the inputs that changed are written with the first batch of each scenario
+    n_batches = config.calibration.pruning_batches if prune_below is not None else 1
+    batches = split_into_batches(prepared_scenarios, selected_building_names_of_scenarios, n_batches)
+    simulated_buildings = set()
+    pruned = False
+    for k, batch in enumerate(batches):
+        tasks = []
+        for i, (scenario, prepared_scenario, batch_building_names) in enumerate(zip(scenario_list,
+                                                                                    prepared_scenarios, batch)):
+            if not batch_building_names:
+                continue
+            input_tables = None
+            if not any((i, name) in simulated_buildings for name in selected_building_names_of_scenarios[i]):
+                input_tables = select_changed_tables(prepared_scenario, input_tables_of_scenarios[i])
+            tasks.append((scenario, input_tables, batch_building_names, prepared_scenario['measured_loads']))
+            simulated_buildings.update((i, name) for name in batch_building_names)
+        map_scenarios(config, static_params.get('scenario_pool'), simulate_scenario, tasks,
+                      [len(task[2]) for task in tasks])
+
+        if prune_below is not None and k < len(batches) - 1:
+            with timed('pruning_bound'):
+                upper_bound = calc_upper_bound(prepared_scenarios, selected_building_names_of_scenarios,
+                                               simulated_buildings) / selected_share
+            if upper_bound < prune_below:
+                print('Trial pruned, it can not reach a score above {:.0f} (threshold {:.0f})'.format(upper_bound,
+                                                                                                       prune_below))
+                pruned = True
+                break
 
+    # calculate the score of the simulated buildings (all of them, unless the trial was pruned)
+    simulated_scenarios = []
     locators_of_scenarios = []
     measured_building_names_of_scenarios = []
-    for scenario in scenario_list:
-        config.scenario = scenario
-        locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
-        measured_building_names = get_measured_building_names(locator)
-        modify_monthly_multiplier(locator, config, measured_building_names)
+    validated_buildings = []
+    for i, (scenario, prepared_scenario, measured_building_names) in enumerate(zip(
+            scenario_list, prepared_scenarios, selected_building_names_of_scenarios)):
+        measured_building_names = [name for name in measured_building_names if (i, name) in simulated_buildings]
+        if measured_building_names:
+            simulated_scenarios.append(scenario)
+            locators_of_scenarios.append(prepared_scenario['locator'])
+            measured_building_names_of_scenarios.append(measured_building_names)
+            validated_buildings.extend((i, name) for name in measured_building_names)
+    with timed('validation'):
+        score = validation(scenario_list=simulated_scenarios, locators_of_scenarios=locators_of_scenarios,
+                           measured_building_names_of_scenarios=measured_building_names_of_scenarios)
 
-        # store for later use
-        locators_of_scenarios.append(locator)
-        measured_building_names_of_scenarios.append(measured_building_names)
+    if pruned:
+        return upper_bound, pruned, validated_buildings
+    return score / selected_share, pruned, validated_buildings
 
-        ## overwrite inputs with corresponding initial values
 
-        # Changes and saves variables related to the architecture
-        df_arch = dbf_to_dataframe(locator.get_building_architecture())
-        number_of_buildings = df_arch.shape[0]
-        Rand_it = np.random.randint(low=-30, high=30, size=number_of_buildings) / 100
-        # Rand_it = 0
-        df_arch.Es = Es*(1+Rand_it)
-        df_arch.Ns = Ns*(1+Rand_it)
-        df_arch.Hs_ag = Hs_ag*(1+Rand_it)
-        df_arch.void_deck = void_deck
-        dataframe_to_dbf(df_arch, locator.get_building_architecture())
-
-        # Changes and saves variables related to intetnal loads
-        df_intload = dbf_to_dataframe(locator.get_building_internal())
-        df_intload.Occ_m2pax = Occ_m2pax*(1+Rand_it)
-        df_intload.Vww_lpdpax = Vww_lpdpax*(1+Rand_it)
-        df_intload.Ea_Wm2 = Ea_Wm2*(1+Rand_it)
-        df_intload.El_Wm2 = El_Wm2*(1+Rand_it)
-        dataframe_to_dbf(df_intload, locator.get_building_internal())
-
-        #Changes and saves variables related to comfort
-        df_comfort = dbf_to_dataframe(locator.get_building_comfort())
-        df_comfort.Tcs_set_C = Tcs_set_C*(1+Rand_it)
-        df_comfort.Tcs_setb_C = Tcs_setb_C
-        dataframe_to_dbf(df_comfort, locator.get_building_comfort())
-
-
-        # Changes and saves variables related to zone
-        df_zone = dbf_to_dataframe(locator.get_zone_geometry().split('.')[0]+'.dbf')
-        df_zone.height_bg = height_bg
-        df_zone.floors_bg = floors_bg
-        dataframe_to_dbf(df_zone, locator.get_zone_geometry().split('.')[0]+'.dbf')
+def calc_upper_bound(prepared_scenarios, building_names_of_scenarios, simulated_buildings):
+    """
+    Highest score a trial can reach once the buildings in ``simulated_buildings`` ((scenario index, name) pairs) are
+    simulated: the score of these buildings, plus the measured consumption of the buildings left (as if they were all
+    calibrated).
+    """
+    locators_of_scenarios = []
+    simulated_building_names_of_scenarios = []
+    remaining_consumption = 0.0
+    for i, (prepared_scenario, building_names) in enumerate(zip(prepared_scenarios, building_names_of_scenarios)):
+        simulated_building_names = [name for name in building_names if (i, name) in simulated_buildings]
+        remaining_building_names = [name for name in building_names if (i, name) not in simulated_buildings]
+        remaining_consumption += get_consumption(prepared_scenario, remaining_building_names).sum()
+        if simulated_building_names:
+            locators_of_scenarios.append(prepared_scenario['locator'])
+            simulated_building_names_of_scenarios.append(simulated_building_names)
+    measured, modelled = read_monthly_demand_of_scenarios(locators_of_scenarios, simulated_building_names_of_scenarios)
+    cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors(measured, modelled)
+    return calc_scores(cv_root_mean_squared_error, normalized_mean_biased_error, measured)[1].sum() + \
+        remaining_consumption
 
-        ## run building schedules and energy demand
-        config.schedule_maker.buildings = measured_building_names
-        schedule_maker.schedule_maker_main(locator, config)
-        config.demand.buildings = measured_building_names
-        demand_main.demand_calculation(locator, config)
 
+def archive_trial(static_params, tid, score):
+    """
+    Compresses the inputs and outputs of the trial ``tid`` from its workspaces (see ``archive_scenario``), one archive
+    per scenario. The demand results are only archived if the trials wrote the outputs set in the demand parameters.
+    """
+    config = static_params['config']
+    archive_folder = get_trial_archive_folder(static_params['archives_folder'], tid)
+    shutil.rmtree(archive_folder, ignore_errors=True)
+    os.makedirs(archive_folder)
+    demand_outputs = not config.calibration.reduced_demand_output
+    tasks = [(scenario, get_scenario_archive_file(archive_folder, i), demand_outputs)
+             for i, scenario in enumerate(static_params['scenario_list'])]
+    map_scenarios(config, static_params.get('scenario_pool'), archive_scenario, tasks,
+                  [len(prepared_scenario['measured_building_names'])
+                   for prepared_scenario in static_params['prepared_scenarios']])
+    write_manifest(archive_folder, tid, score, len(tasks), demand_outputs)
+
+
+def evaluate_trial(static_params, dynamic_params, seed, fidelity=1.0, prune_below=None, tid=None, archive_above=None):
+    """
+    Runs one trial (see ``calc_score``) and returns it in the format of a hyperopt result, with the columns of the
+    results table, the errors of each measured building and the timings of its phases.
+    """
+    profile_file = None
+    if tid is not None and tid == static_params.get('profile_trial'):
+        profile_file = static_params['profile_file']
+    with profiled(profile_file):
+        score, pruned, validated_buildings = calc_score(static_params, dynamic_params, seed, fidelity, prune_below)
+    if (static_params.get('archives_folder') is not None and tid is not None and fidelity == 1.0 and not pruned
+            and (archive_above is None or score > archive_above)):
+        archive_trial(static_params, tid, score)
+    validation_results = global_validation_results.pop()  # only needed for this trial
+    return {'loss': -1.0 * score,  # score is set to negative as optimization looks for minimum
+            'status': STATUS_OK,
+            'buildings_calibrated': global_validation_n_calibrated[-1],
+            'percentage_buildings_calibrated_%': global_validation_percentage[-1],
+            'fidelity': fidelity,
+            'pruned': pruned,
+            'parameters': dict((label, float(value)) for label, value in dynamic_params.items()),
+            'seed': seed,
+            'building_metrics': calc_building_metrics(get_measured_buildings(static_params['prepared_scenarios']),
+                                                      validation_results, validated_buildings),
+            'timings': pop_phase_timings()}
+
+
+def get_measured_buildings(prepared_scenarios):
+    """(scenario index, name) of all the measured buildings, in the order of ``read_measured_buildings``"""
+    return [(i, name) for i, prepared_scenario in enumerate(prepared_scenarios)
+            for name in prepared_scenario['measured_building_names']]
 
-    # calculate the score
-    score = validation(scenario_list=scenario_list, locators_of_scenarios=locators_of_scenarios,
-                       measured_building_names_of_scenarios=measured_building_names_of_scenarios)
 
-    return score
+def evaluate_screening_point(static_params, dynamic_params, fidelity, seed):
+    """
+    Simulates a point of the sensitivity screening (see ``screen_parameters``) with the random variation of ``seed``.
+
+    :return: loss of each measured building (see ``calc_building_loss``), NaN for the buildings that were not simulated
+    """
+    _, _, validated_buildings = calc_score(static_params, dynamic_params, seed, fidelity)
+    building_metrics = calc_building_metrics(get_measured_buildings(static_params['prepared_scenarios']),
+                                             global_validation_results.pop(), validated_buildings)
+    loss = calc_building_loss(building_metrics['cv_root_mean_squared_error'],
+                              building_metrics['normalized_mean_biased_error'])
+    return np.where(building_metrics['calibrated'] != NOT_SIMULATED, loss, np.nan)
+
+
+def evaluate_points(static_params, seed, points):
+    """
+    evaluates the points (tid, dynamic_params, fidelity, prune_below, archive_above) one after the other, returns
+    (tid, result) of each point
+    """
+    return [(tid, evaluate_trial(static_params, dynamic_params, seed, fidelity, prune_below, tid, archive_above))
+            for tid, dynamic_params, fidelity, prune_below, archive_above in points]
+
 
-    ## save the iteration number, the value of each parameter tested and the score obtained
+# static parameters of the trials evaluated by a worker process (set once per worker by ``init_trial_worker``)
+WORKER_STATIC_PARAMS = {}
+
+
+def init_trial_worker(config, list_scenarios, workspaces_path, profile_settings, archives_folder):
+    """
+    Prepares a worker process of the parallel calibration. Each worker evaluates all its trials in its own workspace
+    (a clone of the scenarios), so that concurrent trials do not overwrite each other's inputs and demand results.
+    """
+    config.multiprocessing = False  # the trials already run in parallel, a worker can not start its own pool
+    worker_path = os.path.join(workspaces_path, 'worker-%i' % os.getpid())
+    worker_scenarios = create_workspaces(list_scenarios, worker_path, config.plugins)
+    WORKER_STATIC_PARAMS.update({'scenario_list': worker_scenarios, 'config': config,
+                                 'prepared_scenarios': prepare_scenarios(worker_scenarios, config),
+                                 'archives_folder': archives_folder})
+    WORKER_STATIC_PARAMS.update(profile_settings)
+
+
+def evaluate_trial_in_worker(seed, tid, dynamic_params, fidelity=1.0, prune_below=None, archive_above=None):
+    return tid, evaluate_trial(WORKER_STATIC_PARAMS, dynamic_params, seed, fidelity, prune_below, tid, archive_above)
+
+
+def evaluate_screening_point_in_worker(dynamic_params, fidelity, seed):
+    return evaluate_screening_point(WORKER_STATIC_PARAMS, dynamic_params, fidelity, seed)
+
+
+def evaluate_points_in_pool(pool, seed, points):
+    """
+    evaluates the points (tid, dynamic_params, fidelity, prune_below, archive_above) in the worker processes, returns
+    (tid, result) of each point
+    """
+    return pool.starmap(evaluate_trial_in_worker, [(seed,) + tuple(point) for point in points])
+
+
+def make_trial_pool(config, list_scenarios, concurrent_trials, workspaces_path, profile_settings, archives_folder):
+    return multiprocessing.Pool(concurrent_trials, initializer=init_trial_worker,
+                                initargs=(config, list_scenarios, workspaces_path, profile_settings, archives_folder))
+
+
+def run_trial_worker(config, list_scenarios):
+    """
+    Worker of a distributed calibration (``calibration:distributed worker``): evaluates the trials published by the
+    coordinator of the project (see ``QueuePool``) in its own workspace, until the coordinator finishes. The workers
+    have to be started with the same parameters as the coordinator.
+    """
+    project_path = config.project
+    workspaces_path = make_workspaces_folder(project_path)
+    try:
+        run_worker(get_queue_file(project_path), init_trial_worker,
+                   (config, list_scenarios, workspaces_path, get_profile_settings(config, project_path),
+                    get_archives_folder(project_path)))
+    finally:
+        remove_workspace(workspaces_path)
+
+
+def get_profile_settings(config, project_path):
+    """the trial to run with cProfile (``calibration:profile-trial``, None for none) and the file of its stats"""
+    profile_trial = config.calibration.profile_trial
+    profile_file = None
+    if profile_trial is not None:
+        profile_file = os.path.join(project_path, 'output', 'calibration',
+                                    'calibration_profile_trial_%i.prof' % profile_trial)
+    return {'profile_trial': profile_trial, 'profile_file': profile_file}
+
+
+def get_point(trial):
+    """hyperparameter values of a trial"""
+    return {label: vals[0] for label, vals in trial['misc']['vals'].items()}
+
+
+def store_trial_result(trials, tid, result):
+    trial = [trial for trial in trials._dynamic_trials if trial['tid'] == tid][0]
+    trial['result'] = result
+    trial['state'] = JOB_STATE_DONE
+    trials.refresh()
+
+
+def calc_pruning_threshold(trials, fidelity, pruning_quantile):
+    """
+    Score a new trial of the given fidelity has to be able to reach not to be pruned: the ``pruning_quantile`` of the
+    scores of the finished trials of that fidelity (1 is the best score so far). None (no pruning) when pruning is off
+    or no trial finished yet.
+    """
+    if pruning_quantile is None:
+        return None
+    scores = [-1.0 * trial['result']['loss'] for trial in trials.trials
+              if trial['state'] == JOB_STATE_DONE and trial['result']['fidelity'] == fidelity
+              and not trial['result']['pruned']]
+    if not scores:
+        return None
+    return np.quantile(scores, pruning_quantile)
+
+
+def calc_archive_threshold(trials):
+    """score a new trial has to beat to be archived: the best score of the finished trials with all the buildings"""
+    return calc_pruning_threshold(trials, 1.0, 1.0)
+
+
+def get_searched_parameters(space):
+    """labels of the parameters of ``space`` that are searched (not frozen to a value by the screening)"""
+    return [label for label, expression in space.items() if isinstance(expression, Apply)]
+
+
+def read_warm_start_points(results_file, n_trials):
+    """
+    Parameters of the ``n_trials`` best trials of a previous calibration (its results table), among its trials with all
+    the measured buildings.
+    """
+    results = pd.read_csv(results_file)
+    if 'fidelity' in results.columns:
+        results = results[(results['fidelity'] == 1.0) & ~results['pruned'].astype(bool)]
+    results = results.sort_values('score_weighted_demand').drop_duplicates(list(DYNAMIC_PARAMETERS)).head(n_trials)
+    return [OrderedDict((label, float(row[label])) for label in DYNAMIC_PARAMETERS) for _, row in results.iterrows()]
+
+
+def run_warm_start(evaluate, space, points, trials, pruning_quantile=None, checkpoint=None):
+    """
+    Evaluates the ``points`` of a previous calibration (see ``read_warm_start_points``) as the first trials, with all the
+    measured buildings, so that TPE starts its search from their scores. The parameters frozen in ``space`` keep their
+    frozen value.
+
+    :param evaluate: function evaluating a list of points (tid, dynamic_params, fidelity, prune_below, archive_above),
+        returning (tid, result) of each point
+    """
+    searched_parameters = get_searched_parameters(space)
+    new_ids = trials.new_trial_ids(len(points))
+    new_trials = [generate_trial(tid, dict((label, point[label]) for label in searched_parameters))
+                  for tid, point in zip(new_ids, points)]
+    for new_trial in new_trials:
+        new_trial['state'] = JOB_STATE_RUNNING
+    trials.insert_trial_docs(new_trials)
+    trials.refresh()
+    print('Evaluating {} trials of the previous calibration'.format(len(new_trials)))
+    prune_below = calc_pruning_threshold(trials, 1.0, pruning_quantile)
+    archive_above = calc_archive_threshold(trials)
+    for tid, result in evaluate([(trial['tid'], space_eval(space, get_point(trial)), 1.0, prune_below, archive_above)
+                                 for trial in new_trials]):
+        store_trial_result(trials, tid, result)
+    if checkpoint is not None:
+        update_checkpoint(checkpoint, trials)
+
+
+def calc_stopping_reason(trials, plateau_trials, target_calibrated):
+    """
+    Reason to stop the calibration before its budget, None to go on: a trial with all the measured buildings calibrated
+    ``target_calibrated`` % of them, or the best score did not improve in the last ``plateau_trials`` trials with all the
+    measured buildings (pruned trials count as trials without improvement, 0 never stops on a plateau).
+    """
+    full_fidelity_trials = [trial for trial in trials.trials
+                            if trial['state'] == JOB_STATE_DONE and trial['result']['fidelity'] == 1.0]
+    completed_trials = [trial for trial in full_fidelity_trials if not trial['result']['pruned']]
+    if not completed_trials:
+        return None
+    most_calibrated = max(trial['result']['percentage_buildings_calibrated_%'] for trial in completed_trials)
+    if most_calibrated >= target_calibrated:
+        return 'a trial calibrated {:.1f}% of the buildings (target {}%)'.format(most_calibrated, target_calibrated)
+    best_trial = min(completed_trials, key=lambda trial: trial['result']['loss'])
+    trials_since_best = len([trial for trial in full_fidelity_trials if trial['tid'] > best_trial['tid']])
+    if 0 < plateau_trials <= trials_since_best:
+        return 'the best score did not improve in the last {} trials'.format(trials_since_best)
+    return None
+
+
+def run_parallel_trials(pool, space, max_evals, concurrent_trials, trials, seed, algo=tpe.suggest,
+                        pruning_quantile=None, checkpoint=None, stop=None):
+    """
+    Asynchronous version of ``fmin``: keeps ``concurrent_trials`` trials running in a pool of worker processes and asks
+    ``algo`` (TPE) for a new point as soon as one of them finishes. Trials that are still running are known to TPE (with an
+    infinite loss), so it does not suggest the same region twice. The completed trials are stored in ``trials`` (the
+    trials already in ``trials`` count towards ``max_evals``), and in the ``checkpoint`` as soon as they finish. With a
+    ``pruning_quantile``, a trial is pruned against the scores of the trials finished when it started. Once
+    ``stop(trials)`` gives a reason to stop (see ``calc_stopping_reason``), no new trial is started. All the trials use
+    the variation of the parameters between the buildings of ``seed``.
+    """
+    domain = Domain(lambda dynamic_params: None, space)  # trials are evaluated by the workers, not by the domain
+    rstate = np.random.default_rng()
+    finished_trials = Queue()
+    n_submitted = len(trials.trials)
+    n_running = 0
+    stopping_reason = stop(trials) if stop is not None else None
+    while (n_submitted < max_evals and stopping_reason is None) or n_running > 0:
+        # keep all workers busy
+        while n_running < concurrent_trials and n_submitted < max_evals and stopping_reason is None:
+            new_ids = trials.new_trial_ids(1)
+            trials.refresh()
+            new_trial = algo(new_ids, domain, trials, rstate.integers(2 ** 31 - 1))[0]
+            new_trial['state'] = JOB_STATE_RUNNING
+            trials.insert_trial_docs([new_trial])
+            trials.refresh()
+            pool.apply_async(evaluate_trial_in_worker, (seed, new_trial['tid'], space_eval(space, get_point(new_trial)),
+                                                        1.0, calc_pruning_threshold(trials, 1.0, pruning_quantile),
+                                                        calc_archive_threshold(trials)),
+                             callback=finished_trials.put, error_callback=finished_trials.put)
+            n_submitted += 1
+            n_running += 1
+
+        # wait for the next trial to finish and store its result
+        finished = finished_trials.get()
+        if isinstance(finished, Exception):
+            raise finished
+        tid, result = finished
+        n_running -= 1
+        store_trial_result(trials, tid, result)
+        if checkpoint is not None:
+            update_checkpoint(checkpoint, trials)
+        print('Trial {} of {} finished with score {}'.format(len(trials.trials) - n_running, max_evals,
+                                                              -1.0 * result['loss']))
+        if stop is not None and stopping_reason is None:
+            stopping_reason = stop(trials)
+            if stopping_reason is not None:
+                print('Stopping the calibration, {}'.format(stopping_reason))
+
+
+def get_fidelities(low_fidelity_buildings, promotion_rate):
+    """
+    Fidelities (share of the measured buildings that are simulated) of the rungs of the successive halving, up to 1
+    (all buildings), each ``promotion_rate`` times lower than the next one. The lowest rung is the lowest of these
+    fidelities that is not below ``low_fidelity_buildings``.
+    """
+    fidelities = [1.0]
+    while (fidelities[0] / promotion_rate > low_fidelity_buildings
+           or math.isclose(fidelities[0] / promotion_rate, low_fidelity_buildings)):
+        fidelities.insert(0, fidelities[0] / promotion_rate)
+    return fidelities
+
+
+def run_successive_halving(evaluate, space, max_evals, trials, fidelities, promotion_rate, algo=tpe.suggest,
+                           pruning_quantile=None, checkpoint=None, stop=None):
+    """
+    Successive halving scheduler around the TPE search. Each bracket evaluates ``promotion_rate ** (rungs - 1)`` new
+    points suggested by ``algo`` at the lowest fidelity, then promotes the best ``1 / promotion_rate`` of them to the
+    next fidelity, up to the full fidelity. Every evaluation is stored in ``trials`` (TPE also learns from the low
+    fidelity scores). The budget ``max_evals`` counts the evaluations weighted by their fidelity, i.e. in full
+    simulations (the trials already in ``trials`` count towards it). With a ``pruning_quantile``, a trial is pruned
+    against the scores of the finished trials of its fidelity. The trials of each rung are stored in the ``checkpoint``
+    as soon as the rung finishes. Once ``stop(trials)`` gives a reason to stop (see ``calc_stopping_reason``), no new
+    bracket is started.
+
+    :param evaluate: function evaluating a list of points (tid, dynamic_params, fidelity, prune_below, archive_above),
+        returning (tid, result) of each point
+    """
+    domain = Domain(lambda dynamic_params: None, space)  # trials are evaluated by ``evaluate``, not by the domain
+    rstate = np.random.default_rng()
+    budget = sum(trial['result']['fidelity'] for trial in trials.trials)
+    while budget < max_evals:
+        stopping_reason = stop(trials) if stop is not None else None
+        if stopping_reason is not None:
+            print('Stopping the calibration, {}'.format(stopping_reason))
+            break
+        for rung, fidelity in enumerate(fidelities):
+            if rung == 0:
+                # one point at a time (TPE suggests a single point per call), the points already suggested are known
+                # to TPE as running trials
+                new_trials = []
+                for _ in range(promotion_rate ** (len(fidelities) - 1)):
+                    new_ids = trials.new_trial_ids(1)
+                    trials.refresh()
+                    new_trial = algo(new_ids, domain, trials, rstate.integers(2 ** 31 - 1))[0]
+                    new_trial['state'] = JOB_STATE_RUNNING
+                    trials.insert_trial_docs([new_trial])
+                    trials.refresh()
+                    new_trials.append(new_trial)
+                new_ids = [new_trial['tid'] for new_trial in new_trials]
+            else:
+                # promote the best points of the previous rung, they are evaluated again as new trials
+                promoted_trials = sorted(new_trials, key=lambda trial: trial['result']['loss'])
+                promoted_trials = promoted_trials[:max(1, len(new_trials) // promotion_rate)]
+                new_ids = trials.new_trial_ids(len(promoted_trials))
+                new_trials = [generate_trial(tid, get_point(trial)) for tid, trial in zip(new_ids, promoted_trials)]
+                for new_trial in new_trials:
+                    new_trial['state'] = JOB_STATE_RUNNING
+                trials.insert_trial_docs(new_trials)
+                trials.refresh()
+            print('Evaluating {} trials with {:.0%} of the measured buildings'.format(len(new_trials), fidelity))
+            prune_below = calc_pruning_threshold(trials, fidelity, pruning_quantile)
+            archive_above = calc_archive_threshold(trials)
+            for tid, result in evaluate([(trial['tid'], space_eval(space, get_point(trial)), fidelity, prune_below,
+                                          archive_above) for trial in new_trials]):
+                store_trial_result(trials, tid, result)
+            if checkpoint is not None:
+                update_checkpoint(checkpoint, trials)
+            new_trials = [trial for trial in trials.trials if trial['tid'] in new_ids]
+            budget = budget + fidelity * len(new_trials)
+
+
+def get_best_trial(trials):
+    """the trial with the best score among the trials that simulated all the measured buildings"""
+    full_fidelity_trials = [trial for trial in trials.trials
+                            if trial['result']['fidelity'] == 1.0 and not trial['result']['pruned']]
+    return min(full_fidelity_trials, key=lambda trial: trial['result']['loss'])
+
+
+def calc_search_space(config, checkpoint, evaluate, fidelity):
+    """
+    Space searched by TPE. With ``calibration:screening-trajectories``, the parameters are screened first (see
+    ``screen_parameters``) and the ones with little influence are frozen. A resumed calibration keeps the space of the
+    screening it was started with.
+
+    :param evaluate: function evaluating a list of points of the screening (dynamic_params, fidelity, seed), returning
+        the loss of each building at each point (see ``evaluate_screening_point``)
+    """
+    report_file = checkpoint['screening_report_file']
+    if checkpoint['trials'] is not None and os.path.exists(report_file):
+        report = pd.read_csv(report_file)
+    elif config.calibration.screening_trajectories > 0:
+        report = screen_parameters(lambda points: evaluate([(dynamic_params, fidelity, seed)
+                                                            for dynamic_params, seed in points]),
+                                   DYNAMIC_PARAMETERS, config.calibration.screening_trajectories,
+                                   config.calibration.screening_threshold, report_file)
+    else:
+        return DYNAMIC_PARAMETERS
+    print('Parameters frozen by the screening: {}'.format(list(report[report['frozen']]['parameter'])))
+    return calc_reduced_space(DYNAMIC_PARAMETERS, report)
 
 
 def calibration(config, list_scenarios):
-    max_evals = 300 #maximum number of iterations allowed by the algorithm to run
-
-    #  define a search space
-    # DYNAMIC_PARAMETERS = OrderedDict([('SEED', scope.int(hp.uniform('SEED', 0.0, 100.0))),
-    #                                   ('Hs_ag', hp.uniform('Hs_ag', 0.1, 0.25)),
-    #                                   ('Tcs_set_C', hp.uniform('Tcs_set_C', 24, 26)),
-    #                                   ('Es', hp.uniform('Es', 0.4, 0.6)),
-    #                                   ('Ns', hp.uniform('Ns', 0.4, 0.6)),
-    #                                   ('Occ_m2pax', hp.uniform('Occ_m2pax', 35.0, 45.0)),
-    #                                   ('Vww_lpdpax', hp.uniform('Vww_lpdpax', 25.0, 30.0)),
-    #                                   ('Ea_Wm2', hp.uniform('Ea_Wm2', 1, 2.5)),
-    #                                   ('El_Wm2', hp.uniform('El_Wm2', 1, 2.5))
-    #                                   ])
-    DYNAMIC_PARAMETERS = OrderedDict([('SEED', scope.int(hp.uniform('SEED', 0.0, 100.0))),
-                                      ('Hs_ag', hp.uniform('Hs_ag', 0.1, 0.40)),
-                                      ('Tcs_set_C', hp.uniform('Tcs_set_C', 22, 27)),
-                                      ('Es', hp.uniform('Es', 0.4, 0.9)),
-                                      ('Ns', hp.uniform('Ns', 0.4, 1.0)),
-                                      ('Occ_m2pax', hp.uniform('Occ_m2pax', 25.0, 50.0)),
-                                      ('Vww_lpdpax', hp.uniform('Vww_lpdpax', 20.0, 50.0)),
-                                      ('Ea_Wm2', hp.uniform('Ea_Wm2', 1, 8)),
-                                      ('El_Wm2', hp.uniform('El_Wm2', 1, 8))
-                                      ])
-    STATIC_PARAMS = {'scenario_list': list_scenarios, 'config': config}
-
-    # define the objective
-    def objective(dynamic_params):
-        return -1.0 * calc_score(STATIC_PARAMS, dynamic_params) #score is set to negative as optimization looks for minimum
+    max_evals = config.calibration.max_evals  # maximum number of iterations allowed by the algorithm to run
+    # the calibration stops before max_evals once it reaches the target or stops improving
+    stop = partial(calc_stopping_reason, plateau_trials=config.calibration.plateau_trials,
+                   target_calibrated=config.calibration.target_calibrated)
+    coordinator = config.calibration.distributed == 'coordinator'
+    concurrent_trials = config.calibration.concurrent_trials
+    if not coordinator:
+        concurrent_trials = min(concurrent_trials, config.get_number_of_processes())
+
+    # the trials run in workspaces (clones of the scenarios), the inputs of the user are not modified
+    project_path = config.project
+    scenario = config.scenario  # the trials point the config to the workspaces
+    demand_outputs = (config.demand.resolution_output, config.demand.loads_output, config.demand.massflows_output,
+                      config.demand.temperatures_output)  # and may reduce the outputs of the demand
+    workspaces_path = make_workspaces_folder(project_path)
+
+    # optionally screen the points with a share of the measured buildings before simulating all of them
+    fidelities = get_fidelities(config.calibration.low_fidelity_buildings, config.calibration.promotion_rate)
+    # optionally stop the trials that can not beat the trials finished before them
+    pruning_quantile = config.calibration.pruning_quantile if config.calibration.pruning else None
+
+    # optionally start from the best trials of a previous calibration (read first, it may be replaced by this one)
+    warm_start_points = []
+    if config.calibration.warm_start:
+        warm_start_points = read_warm_start_points(config.calibration.warm_start, config.calibration.warm_start_trials)
+
+    # every finished trial is stored in the results table right away, a crashed run can be resumed from there
+    checkpoint = make_checkpoint(project_path, config.calibration.resume)
+    if checkpoint['trials'] is not None:
+        warm_start_points = []  # the resumed trials already started from them
+    trials = checkpoint['trials'] if checkpoint['trials'] is not None else Trials()
+    # all the trials use the same variation of the parameters between the buildings, a resumed calibration keeps it
+    seed = checkpoint['seed'] if checkpoint['seed'] is not None else int(np.random.default_rng().integers(2 ** 32))
+    original_scenarios = [read_scenario(cea.inputlocator.InputLocator(scenario, config.plugins))
+                          for scenario in list_scenarios]
+    write_perturbations(checkpoint['perturbations_file'], seed,
+                        [list(original_scenario['architecture'].Name) for original_scenario in original_scenarios],
+                        calc_perturbations(seed, original_scenarios))
+    # the errors of every building in every trial are appended to a cube as the trials finish (see ``metrics``)
+    write_measured_buildings(checkpoint['metrics_folder'], list_scenarios,
+                             *read_measured_buildings(list_scenarios, config.plugins))
+
+    # optionally pre-screen the points suggested by TPE with an emulator of the demand
+    algo = tpe.suggest
+    surrogate = None
+    if config.calibration.surrogate_trials > 0:
+        monthly_measured = np.concatenate([original_scenario['monthly_measured_demand'].loc[
+                                               original_scenario['measured_building_names'], MONTHS_IN_YEAR_NAMES].values
+                                           for original_scenario in original_scenarios]).astype(float)
+        surrogate = make_surrogate(partial(calc_measured_building_parameters, prepared_scenarios=original_scenarios,
+                                           seed=seed),
+                                   monthly_measured, checkpoint['metrics_folder'], config.calibration.surrogate_trials,
+                                   config.calibration.surrogate_candidates)
+        algo = partial(suggest_with_surrogate, surrogate=surrogate)
+
+    profile_settings = get_profile_settings(config, project_path)
+    # the best trial so far is archived, so that it does not have to be simulated again at the end
+    archives_folder = checkpoint['archives_folder']
 
     # run the algorithm
-    trials = Trials()
-    best = fmin(objective,
-                space=DYNAMIC_PARAMETERS,
-                algo=tpe.suggest,
-                max_evals=max_evals,
-                trials=trials)
+    scenario_pool = None
+    try:
+        if coordinator or concurrent_trials > 1:
+            if coordinator:
+                # the trials run on the workers started on other nodes (see ``run_trial_worker``)
+                queue_file = get_queue_file(project_path)
+                print('Publishing up to {} trials at a time to {}'.format(concurrent_trials, queue_file))
+                pool = QueuePool(queue_file, config.calibration.worker_timeout)
+            else:
+                print('Running {} trials in parallel'.format(concurrent_trials))
+                pool = make_trial_pool(config, list_scenarios, concurrent_trials, workspaces_path, profile_settings,
+                                       archives_folder)
+            try:
+                space = calc_search_space(config, checkpoint,
+                                          lambda points: pool.starmap(evaluate_screening_point_in_worker, points),
+                                          fidelities[0])
+                if warm_start_points:
+                    run_warm_start(lambda points: evaluate_points_in_pool(pool, seed, points), space,
+                                   warm_start_points, trials, pruning_quantile, checkpoint)
+                if len(fidelities) > 1:
+                    run_successive_halving(lambda points: evaluate_points_in_pool(pool, seed, points), space,
+                                           max_evals, trials, fidelities, config.calibration.promotion_rate, algo,
+                                           pruning_quantile, checkpoint, stop)
+                else:
+                    run_parallel_trials(pool, space, max_evals, concurrent_trials, trials, seed, algo,
+                                        pruning_quantile, checkpoint, stop)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            # one trial at a time, its scenarios can run concurrently
+            scenario_pool = make_scenario_pool(config, get_concurrent_scenarios(config, list_scenarios))
+            workspace_list = create_workspaces(list_scenarios, workspaces_path, config.plugins)
+            STATIC_PARAMS = {'scenario_list': workspace_list, 'config': config,
+                             'prepared_scenarios': prepare_scenarios(workspace_list, config),
+                             'scenario_pool': scenario_pool, 'archives_folder': archives_folder}
+            STATIC_PARAMS.update(profile_settings)
+            space = calc_search_space(config, checkpoint,
+                                      lambda points: [evaluate_screening_point(STATIC_PARAMS, *point)
+                                                      for point in points],
+                                      fidelities[0])
+            if warm_start_points:
+                run_warm_start(lambda points: evaluate_points(STATIC_PARAMS, seed, points), space, warm_start_points,
+                               trials, pruning_quantile, checkpoint)
+
+            # define the objective, it gets the trial of fmin to know its id (the archive of the trial is named by it)
+            @fmin_pass_expr_memo_ctrl
+            def objective(expr, memo, ctrl):
+                return evaluate_trial(STATIC_PARAMS, rec_eval(expr, memo=memo), seed,
+                                      prune_below=calc_pruning_threshold(trials, 1.0, pruning_quantile),
+                                      tid=ctrl.current_trial['tid'], archive_above=calc_archive_threshold(trials))
+
+            def store_trials(trials, *args):
+                update_checkpoint(checkpoint, trials)  # called by fmin after every trial
+                stopping_reason = stop(trials)
+                if stopping_reason is not None:
+                    print('Stopping the calibration, {}'.format(stopping_reason))
+                return stopping_reason is not None, args
+
+            if len(fidelities) > 1:
+                run_successive_halving(lambda points: evaluate_points(STATIC_PARAMS, seed, points), space,
+                                       max_evals, trials, fidelities, config.calibration.promotion_rate, algo,
+                                       pruning_quantile, checkpoint, stop)
+            elif stop(trials) is not None:
+                print('Stopping the calibration, {}'.format(stop(trials)))
+            else:
+                fmin(objective,
+                     space=space,
+                     algo=algo,
+                     max_evals=max_evals,
+                     trials=trials,
+                     early_stop_fn=store_trials)
+    finally:
+        if scenario_pool is not None:
+            scenario_pool.terminate()
+            scenario_pool.join()
+        remove_workspace(workspaces_path)
+        config.scenario = scenario
+        (config.demand.resolution_output, config.demand.loads_output, config.demand.massflows_output,
+         config.demand.temperatures_output) = demand_outputs
+    best = get_best_trial(trials)['result']['parameters']
     print(best)
     print('Best Params: {}'.format(best))
     print(trials.losses())
+    print('Time spent in the phases of the calibration:')
+    print(calc_timing_summary(trials.trials).to_string())
 
-    validation_n_calib = pd.DataFrame(global_validation_n_calibrated)
-    validation_percentage = pd.DataFrame(global_validation_percentage)
-
-    results = pd.DataFrame()
-    for counter in range(0, max_evals):
-        results_it = [counter,
-                      trials.trials[counter]['misc']['vals']['SEED'][0],
-                      trials.trials[counter]['misc']['vals']['Hs_ag'][0],
-                      trials.trials[counter]['misc']['vals']['Tcs_set_C'][0],
-                      trials.trials[counter]['misc']['vals']['Ea_Wm2'][0],
-                      trials.trials[counter]['misc']['vals']['El_Wm2'][0],
-                      trials.trials[counter]['misc']['vals']['Es'][0],
-                      trials.trials[counter]['misc']['vals']['Ns'][0],
-                      trials.trials[counter]['misc']['vals']['Occ_m2pax'][0],
-                      trials.trials[counter]['misc']['vals']['Vww_lpdpax'][0],
-                      trials.losses()[counter]
-                      ]
-        results_it = pd.DataFrame([results_it])
-        results = results.append(results_it)
-    results.reset_index(drop=True, inplace=True)
-    results = pd.concat([results, validation_n_calib, validation_percentage],  axis=1, sort=False).sort_index()
-
-    results.columns = ['eval', 'SEED','Hs_ag','Tcs_set_C', 'Ea_Wm2', 'El_Wm2', 'Es',
-                       'Ns', 'Occ_m2pax', 'Vww_lpdpax', 'score_weighted_demand', 'buildings_calibrated', 'percentage_buildings_calibrated_%']
-    project_path = config.project
+    # the results table was written trial by trial (see ``update_checkpoint``), in the order the trials finished
     output_path = (project_path + r'/output/calibration/')
 
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    file_name = output_path+'calibration_results.csv'
-    results.to_csv(file_name, index=False)
+    if surrogate is not None:
+        update_surrogate(surrogate, space, trials)  # the last trials were not seen by the surrogate yet
+        pd.DataFrame(surrogate['log'], columns=['tid', 'emulated_score', 'score', 'emulator_cvrmse_median_%',
+                                                'emulator_cvrmse_max_%']).to_csv(
+            output_path + 'calibration_surrogate.csv', index=False)
+
+def get_best_result(project_path):
+    """row of the results table of the best trial"""
+    results = pd.read_csv(get_results_file(project_path))
+    # screening and pruned trials only simulated part of the buildings, their scores are not comparable
+    ID_best = results[(results['fidelity'] == 1.0) & ~results['pruned']]['score_weighted_demand'].idxmin()
+    return results.loc[ID_best]
+
+
+def promote_best_trial(config, i, scenario):
+    """
+    Extracts the archive of the best trial into the scenario (the ``i``-th scenario of the calibration), see
+    ``archive_trial``. If the trials only wrote the measured loads at monthly resolution, the archive holds no demand
+    results and the demand of the scenario is run once with the outputs set in the demand parameters.
+    """
+    config.scenario = scenario
+    locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
+    archive_folder = get_best_archive_folder(get_archives_folder(config.project))
+    promote_archive(archive_folder, i, scenario)
+    if not read_manifest(archive_folder)['demand_outputs']:
+        config.demand.buildings = get_measured_building_names(locator)
+        demand_main.demand_calculation(locator, config)
+
+
+def rerun_best_trial(config, i, scenario):
+    """
+    Updates the inputs of the scenario (the ``i``-th scenario of the calibration) with the parameters of the best trial
+    and runs its schedules and demand. The variation of the parameters of each building is the one recorded for the
+    trial, so the inputs are exactly those that the trial simulated.
+    """
+    config.scenario = scenario
+    locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
+    dynamic_params = get_best_result(config.project)
+    perturbations = read_perturbations(get_perturbations_file(config.project))[1][i]
+
+    # the trials wrote the monthly multipliers only to their workspaces
+    prepared_scenario = prepare_scenario(locator, config)
+    measured_building_names = prepared_scenario['measured_building_names']
+    Rand_it = np.array([perturbations[building_name] for building_name in prepared_scenario['architecture'].Name])
+    building_parameters = calc_building_parameters(dynamic_params, Rand_it)
+    for dbf_path, table in calc_input_tables(prepared_scenario, building_parameters).items():
+        dataframe_to_dbf(table, dbf_path)
+
+    config.schedule_maker.buildings = measured_building_names
+    schedule_maker.schedule_maker_main(locator, config)
+    config.demand.buildings = measured_building_names
+    demand_main.demand_calculation(locator, config)
+
+
+def get_building_results_file(project_path):
+    """project/output/calibration/calibration_results_buildings.csv"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_results_buildings.csv')
+
+
+def get_building_parameters(prepared_scenario):
+    """
+    Current values of the calibrated parameters of the buildings of a scenario (as read by ``read_scenario``).
+
+    :return: dict of parameter -> array with the value of each building
+    """
+    return OrderedDict([('Hs_ag', prepared_scenario['architecture']['Hs_ag'].values.astype(float)),
+                        ('Tcs_set_C', prepared_scenario['indoor_comfort']['Tcs_set_C'].values.astype(float)),
+                        ('Es', prepared_scenario['architecture']['Es'].values.astype(float)),
+                        ('Ns', prepared_scenario['architecture']['Ns'].values.astype(float)),
+                        ('Occ_m2pax', prepared_scenario['internal_loads']['Occ_m2pax'].values.astype(float)),
+                        ('Vww_lpdpax', prepared_scenario['internal_loads']['Vww_lpdpax'].values.astype(float)),
+                        ('Ea_Wm2', prepared_scenario['internal_loads']['Ea_Wm2'].values.astype(float)),
+                        ('El_Wm2', prepared_scenario['internal_loads']['El_Wm2'].values.astype(float))])
+
+
+def calc_decomposed_building_parameters(prepared_scenario, dynamic_params_of_buildings):
+    """
+    Values of the calibrated parameters for the buildings of a scenario when each measured building has its own
+    parameters (``dynamic_params_of_buildings``, in the order of the measured buildings). The buildings without
+    measurements keep their values.
+    """
+    building_parameters = get_building_parameters(prepared_scenario)
+    for position, dynamic_params in zip(prepared_scenario['measured_building_positions'], dynamic_params_of_buildings):
+        for parameter, value in calc_building_parameters(dynamic_params, 0.0).items():
+            building_parameters[parameter][position] = value
+    return building_parameters
+
+
+def simulate_buildings(static_params, dynamic_params_of_scenarios):
+    """
+    Simulates the measured buildings of all the scenarios, each building with its own parameters.
+
+    :param dynamic_params_of_scenarios: for each scenario, the parameters of each of its measured buildings
+    :return: measured and modelled monthly demand [kWh] of the measured buildings, arrays of (buildings x 12)
+    """
+    prepared_scenarios = static_params['prepared_scenarios']
+    tasks = []
+    for scenario, prepared_scenario, dynamic_params_of_buildings in zip(static_params['scenario_list'],
+                                                                        prepared_scenarios,
+                                                                        dynamic_params_of_scenarios):
+        building_parameters = calc_decomposed_building_parameters(prepared_scenario, dynamic_params_of_buildings)
+        tasks.append((scenario, select_changed_tables(prepared_scenario,
+                                                      calc_input_tables(prepared_scenario, building_parameters)),
+                      prepared_scenario['measured_building_names'], prepared_scenario['measured_loads']))
+    map_scenarios(static_params['config'], static_params.get('scenario_pool'), simulate_scenario, tasks,
+                  [len(task[2]) for task in tasks])
+    with timed('validation'):
+        return read_monthly_demand_of_scenarios(
+            [prepared_scenario['locator'] for prepared_scenario in prepared_scenarios],
+            [prepared_scenario['measured_building_names'] for prepared_scenario in prepared_scenarios])
+
+
+def calibrate_buildings(config, list_scenarios):
+    """
+    Decomposed calibration: every measured building gets its own parameters and its own TPE search (minimizing
+    ``calc_building_loss``), instead of one set of parameters varied randomly for all the buildings. The demand of a
+    building does not depend on the parameters of the others, so the searches advance in lockstep: in each evaluation
+    every search suggests the next parameters of its building, all the measured buildings are simulated together
+    (in parallel by the demand, and by scenario with ``calibration:concurrent-scenarios``) and each search gets the
+    errors of its building. The best parameters of each building are saved to ``calibration_results_buildings.csv``.
+    """
+    building_trials = config.calibration.building_trials
+    space = DECOMPOSED_PARAMETERS
+
+    # the trials run in workspaces (clones of the scenarios), the inputs of the user are not modified
+    project_path = config.project
+    scenario = config.scenario
+    demand_outputs = (config.demand.resolution_output, config.demand.loads_output, config.demand.massflows_output,
+                      config.demand.temperatures_output)
+    workspaces_path = make_workspaces_folder(project_path)
+    scenario_pool = None
+    try:
+        scenario_pool = make_scenario_pool(config, get_concurrent_scenarios(config, list_scenarios))
+        workspace_list = create_workspaces(list_scenarios, workspaces_path, config.plugins)
+        static_params = {'scenario_list': workspace_list, 'config': config,
+                         'prepared_scenarios': prepare_scenarios(workspace_list, config),
+                         'scenario_pool': scenario_pool}
+        prepared_scenarios = static_params['prepared_scenarios']
+        buildings = [(i, building_name) for i, prepared_scenario in enumerate(prepared_scenarios)
+                     for building_name in prepared_scenario['measured_building_names']]
+
+        domain = Domain(lambda dynamic_params: None, space)  # the trials are evaluated by ``simulate_buildings``
+        rstate = np.random.default_rng()
+        trials_of_buildings = [Trials() for _ in buildings]
+        for evaluation in range(building_trials):
+            # the next parameters of every building
+            new_trials = []
+            for trials in trials_of_buildings:
+                new_ids = trials.new_trial_ids(1)
+                trials.refresh()
+                new_trial = tpe.suggest(new_ids, domain, trials, rstate.integers(2 ** 31 - 1))[0]
+                new_trial['state'] = JOB_STATE_RUNNING
+                trials.insert_trial_docs([new_trial])
+                trials.refresh()
+                new_trials.append(new_trial)
+            dynamic_params_of_buildings = [space_eval(space, get_point(new_trial)) for new_trial in new_trials]
+            dynamic_params_of_scenarios = [[dynamic_params for (j, _), dynamic_params in
+                                            zip(buildings, dynamic_params_of_buildings) if j == i]
+                                           for i in range(len(prepared_scenarios))]
+
+            measured, modelled = simulate_buildings(static_params, dynamic_params_of_scenarios)
+            cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors(measured, modelled)
+            losses = calc_building_loss(cv_root_mean_squared_error, normalized_mean_biased_error)
+            calibrated = calc_scores(cv_root_mean_squared_error, normalized_mean_biased_error, measured)[0]
+            for k, (trials, new_trial) in enumerate(zip(trials_of_buildings, new_trials)):
+                store_trial_result(trials, new_trial['tid'],
+                                   {'loss': float(losses[k]),
+                                    'status': STATUS_OK,
+                                    'normalized_mean_biased_error': float(normalized_mean_biased_error[k]),
+                                    'cv_root_mean_squared_error': float(cv_root_mean_squared_error[k]),
+                                    'calibrated': int(calibrated[k]),
+                                    'score': float(calibrated[k] * measured[k].sum())})
+            n_calibrated = sum(min(trial['result']['loss'] for trial in trials.trials) < 1.0
+                               for trials in trials_of_buildings)
+            print('Evaluation {} of {}: {} of {} buildings calibrated so far'.format(evaluation + 1, building_trials,
+                                                                                    n_calibrated, len(buildings)))
+    finally:
+        if scenario_pool is not None:
+            scenario_pool.terminate()
+            scenario_pool.join()
+        remove_workspace(workspaces_path)
+        config.scenario = scenario
+        (config.demand.resolution_output, config.demand.loads_output, config.demand.massflows_output,
+         config.demand.temperatures_output) = demand_outputs
+
+    # the best parameters of each building
+    results = []
+    for (i, building_name), trials in zip(buildings, trials_of_buildings):
+        best_trial = min(trials.trials, key=lambda trial: trial['result']['loss'])
+        best = space_eval(space, get_point(best_trial))
+        results.append([list_scenarios[i], building_name] + [best[label] for label in space] +
+                       [best_trial['tid'], best_trial['result']['loss'],
+                        best_trial['result']['normalized_mean_biased_error'],
+                        best_trial['result']['cv_root_mean_squared_error'],
+                        best_trial['result']['calibrated'], best_trial['result']['score']])
+    results = pd.DataFrame(results, columns=['scenario', 'Name'] + list(space) +
+                                            ['eval', 'loss', 'normalized_mean_biased_error',
+                                             'cv_root_mean_squared_error', 'calibrated', 'score'])
+    results.to_csv(get_building_results_file(project_path), index=False)
+    print('{} of {} buildings calibrated, score {}'.format(results['calibrated'].sum(), len(results),
+                                                          results['score'].sum()))
+    return results
+
+
+def rerun_calibrated_buildings(config, scenario):
+    """
+    Updates the inputs of the scenario with the best parameters of each measured building found by
+    ``calibrate_buildings`` (all buildings in one batch) and runs its schedules and demand.
+    """
+    config.scenario = scenario
+    locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
+    results = pd.read_csv(get_building_results_file(config.project))
+    results = results[[os.path.normpath(result_scenario) == os.path.normpath(scenario)
+                       for result_scenario in results['scenario']]].set_index('Name')
+
+    # the trials wrote the monthly multipliers only to their workspaces
+    prepared_scenario = prepare_scenario(locator, config)
+    measured_building_names = prepared_scenario['measured_building_names']
+    dynamic_params_of_buildings = [results.loc[building_name] for building_name in measured_building_names]
+    building_parameters = calc_decomposed_building_parameters(prepared_scenario, dynamic_params_of_buildings)
+    for dbf_path, table in calc_input_tables(prepared_scenario, building_parameters).items():
+        dataframe_to_dbf(table, dbf_path)
+
+    config.schedule_maker.buildings = measured_building_names
+    schedule_maker.schedule_maker_main(locator, config)
+    config.demand.buildings = measured_building_names
+    demand_main.demand_calculation(locator, config)
+
 
 def main(config):
     """
@@ -242,86 +1272,59 @@ def main(config):
     :type config: cea.config.Configuration
     :return:
     """
-    locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
     project_path = config.project
-    measurement_files = sorted(glob2.glob(project_path + '/**/monthly_measurements.csv'))
     rerun_best_iteration = True #if True, CEA will updates its inputs with the ones for the best iteration and rerun demand
 
-    list_scenarios = []
-    for f in measurement_files:
-        list_scenarios.append(os.path.dirname(os.path.dirname(os.path.dirname(f))))
+    list_scenarios = get_measured_scenarios(project_path)
     print(list_scenarios[:])
 
+    if config.calibration.distributed == 'worker':
+        run_trial_worker(config, list_scenarios[:])
+        return
+
+    if config.calibration.decomposed:
+        calibrate_buildings(config, list_scenarios[:])
+        if rerun_best_iteration:
+            print('Running schedules and demand with the parameters of each building')
+            scenario_pool = make_scenario_pool(config, get_concurrent_scenarios(config, list_scenarios))
+            try:
+                sizes = [len(get_measured_building_names(cea.inputlocator.InputLocator(scenario, config.plugins)))
+                         for scenario in list_scenarios]
+                map_scenarios(config, scenario_pool, rerun_calibrated_buildings,
+                              [(scenario,) for scenario in list_scenarios], sizes)
+            finally:
+                if scenario_pool is not None:
+                    scenario_pool.terminate()
+                    scenario_pool.join()
+        return
+
     calibration(config, list_scenarios[:])
 
     if rerun_best_iteration:
-        print('Running schedules and demand for the best scenario')
-        for scenario in list_scenarios:
-            config.scenario = scenario
-            locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
-            results = pd.read_csv(config.project + r'/output/calibration/calibration_results.csv')
-            ID_best = results['score_weighted_demand'].idxmin()
-
-            SEED = results['SEED'][ID_best]
-
-            df_arch = dbf_to_dataframe(locator.get_building_architecture())
-            df_intload = dbf_to_dataframe(locator.get_building_internal())
-            df_comfort = dbf_to_dataframe(locator.get_building_comfort())
-
-            number_of_buildings = df_arch.shape[0]
-            Rand_it = np.random.randint(low=-30, high=30, size=number_of_buildings) / 100
-            # Rand_it = 0
-            df_arch.Es = results['Es'][ID_best]*(1+Rand_it)
-            df_arch.Ns = results['Ns'][ID_best]*(1+Rand_it)
-            df_arch.Hs_ag = results['Hs_ag'][ID_best]*(1+Rand_it)
-            df_intload.Occ_m2pax = results['Occ_m2pax'][ID_best]*(1+Rand_it)
-            df_intload.Vww_lpdpax = results['Vww_lpdpax'][ID_best]*(1+Rand_it)
-            df_intload.Ea_Wm2 = results['Ea_Wm2'][ID_best]*(1+Rand_it)
-            df_intload.El_Wm2 = results['El_Wm2'][ID_best]*(1+Rand_it)
-            df_comfort.Tcs_set_C = results['Tcs_set_C'][ID_best] * (1 + Rand_it)
-
-            dataframe_to_dbf(df_arch, locator.get_building_architecture())
-            dataframe_to_dbf(df_intload, locator.get_building_internal())
-            dataframe_to_dbf(df_comfort, locator.get_building_comfort())
-
-            measured_building_names = get_measured_building_names(locator)
-            config.schedule_maker.buildings = measured_building_names
-            schedule_maker.schedule_maker_main(locator, config)
-            config.demand.buildings = measured_building_names
-            demand_main.demand_calculation(locator, config)
+        # the best trial was archived during the calibration, unless the archive is missing (e.g. a calibration resumed
+        # from a checkpoint written before the archives) it is promoted instead of simulating the best trial again
+        best_archive = read_manifest(get_best_archive_folder(get_archives_folder(project_path)))
+        if (best_archive is not None and best_archive['tid'] == get_best_result(project_path)['eval']
+                and best_archive['scenarios'] == len(list_scenarios)):
+            print('Promoting the inputs and outputs of the best trial {} to the scenarios'.format(best_archive['tid']))
+            finalize_scenario = promote_best_trial
+        else:
+            print('Running schedules and demand for the best scenario')
+            finalize_scenario = rerun_best_trial
+        # the scenarios run concurrently, the largest (most measured buildings) first
+        scenario_pool = make_scenario_pool(config, get_concurrent_scenarios(config, list_scenarios))
+        try:
+            sizes = [len(get_measured_building_names(cea.inputlocator.InputLocator(scenario, config.plugins)))
+                     for scenario in list_scenarios]
+            map_scenarios(config, scenario_pool, finalize_scenario,
+                          [(i, scenario) for i, scenario in enumerate(list_scenarios)], sizes)
+        finally:
+            if scenario_pool is not None:
+                scenario_pool.terminate()
+                scenario_pool.join()
 
         print('Best scenario simulation completed')
 
-        results = pd.read_csv(config.project + r'/output/calibration/calibration_results.csv')
-        ID_best = results['score_weighted_demand'].idxmin()
-
-        SEED = results['SEED'][ID_best]
-
-        df_arch = dbf_to_dataframe(locator.get_building_architecture())
-        df_intload = dbf_to_dataframe(locator.get_building_internal())
-        df_comfort = dbf_to_dataframe(locator.get_building_comfort())
-
-        number_of_buildings = df_arch.shape[0]
-        # Rand_it = np.random.randint(low=-30, high=30, size=number_of_buildings) / 100
-        Rand_it = 0
-        df_arch.Es = results['Es'][ID_best]*(1+Rand_it)
-        df_arch.Ns = results['Ns'][ID_best]*(1+Rand_it)
-        df_arch.Hs_ag = results['Hs_ag'][ID_best]*(1+Rand_it)
-        df_intload.Occ_m2pax = results['Occ_m2pax'][ID_best]*(1+Rand_it)
-        df_intload.Vww_lpdpax = results['Vww_lpdpax'][ID_best]*(1+Rand_it)
-        df_intload.Ea_Wm2 = results['Ea_Wm2'][ID_best]*(1+Rand_it)
-        df_intload.El_Wm2 = results['El_Wm2'][ID_best]*(1+Rand_it)
-        df_comfort.Tcs_set_C = results['Tcs_set_C'][ID_best] * (1 + Rand_it)
-
-        dataframe_to_dbf(df_arch, locator.get_building_architecture())
-        dataframe_to_dbf(df_intload, locator.get_building_internal())
-        dataframe_to_dbf(df_comfort, locator.get_building_comfort())
-
-        measured_building_names = get_measured_building_names(locator)
-        config.schedule_maker.buildings = measured_building_names
-        schedule_maker.schedule_maker_main(locator, config)
-        config.demand.buildings = measured_building_names
-        demand_main.demand_calculation(locator, config)
 
 if __name__ == '__main__':
     main(cea.config.Configuration())
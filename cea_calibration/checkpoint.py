@@ -0,0 +1,181 @@
+"""
+Checkpoints of a calibration run. Every trial is appended to the results table of the project as soon as it finishes,
+and the hyperopt trials (the search history) are saved next to it, so that a run that crashed can be resumed with
+``calibration:resume`` from its last finished trial.
+"""
+from __future__ import division
+from __future__ import print_function
+import json
+import os
+import pickle
+import shutil
+import pandas as pd
+from hyperopt import JOB_STATE_DONE
+from cea_calibration.timing import append_timings
+from cea_calibration.archive import get_archives_folder, keep_best_archive
+from cea_calibration.screening import get_screening_report_file
+from cea_calibration.metrics import get_metrics_folder, append_metrics
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+RESULTS_COLUMNS = ['eval', 'seed', 'Hs_ag', 'Tcs_set_C', 'Ea_Wm2', 'El_Wm2', 'Es', 'Ns', 'Occ_m2pax', 'Vww_lpdpax',
+                   'score_weighted_demand', 'buildings_calibrated', 'percentage_buildings_calibrated_%', 'fidelity',
+                   'pruned']
+
+
+def get_results_file(project_path):
+    """project/output/calibration/calibration_results.csv"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_results.csv')
+
+
+def get_trials_file(project_path):
+    """project/output/calibration/calibration_trials.pkl"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_trials.pkl')
+
+
+def get_timings_file(project_path):
+    """project/output/calibration/calibration_timings.jsonl"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_timings.jsonl')
+
+
+def get_perturbations_file(project_path):
+    """project/output/calibration/calibration_perturbations.json"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_perturbations.json')
+
+
+def write_perturbations(perturbations_file, seed, building_names_of_scenarios, perturbations):
+    """
+    Saves the seed of the calibration and the random variation of the parameters of each building it draws (the same
+    in all the trials), one array per scenario in the order of the scenarios of the calibration.
+    """
+    with open(perturbations_file, 'w') as f:
+        json.dump({'seed': seed,
+                   'perturbations': [{'Name': building_names, 'Rand_it': Rand_it.tolist()}
+                                     for building_names, Rand_it in zip(building_names_of_scenarios, perturbations)]},
+                  f)
+
+
+def read_perturbations(perturbations_file):
+    """
+    The seed saved by ``write_perturbations`` and the variation of the parameters of each building, one dict of
+    building name to variation per scenario.
+    """
+    with open(perturbations_file) as f:
+        record = json.load(f)
+    return record['seed'], [dict(zip(perturbations['Name'], perturbations['Rand_it']))
+                            for perturbations in record['perturbations']]
+
+
+def get_results_row(trial):
+    """row of the results table for a finished trial, the ``eval`` column is the id of the trial"""
+    parameters = trial['result']['parameters']  # also the parameters frozen by the screening, which are not searched
+    return [trial['tid'],
+            trial['result']['seed'],
+            parameters['Hs_ag'],
+            parameters['Tcs_set_C'],
+            parameters['Ea_Wm2'],
+            parameters['El_Wm2'],
+            parameters['Es'],
+            parameters['Ns'],
+            parameters['Occ_m2pax'],
+            parameters['Vww_lpdpax'],
+            trial['result']['loss'],
+            trial['result']['buildings_calibrated'],
+            trial['result']['percentage_buildings_calibrated_%'],
+            trial['result']['fidelity'],
+            trial['result']['pruned']]
+
+
+def save_trials(trials_file, trials):
+    # write to a temporary file first, so that a crash while writing never destroys the last checkpoint
+    temporary_file = trials_file + '.tmp'
+    with open(temporary_file, 'wb') as f:
+        pickle.dump(trials, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_file, trials_file)
+
+
+def load_trials(trials_file):
+    """
+    Trials saved by ``save_trials``. Trials that were still running when the checkpoint was saved are dropped, they
+    are suggested again.
+    """
+    with open(trials_file, 'rb') as f:
+        trials = pickle.load(f)
+    trials._dynamic_trials = [trial for trial in trials._dynamic_trials if trial['state'] == JOB_STATE_DONE]
+    trials.refresh()
+    return trials
+
+
+def make_checkpoint(project_path, resume):
+    """
+    :param resume: continue the run checkpointed in the project, otherwise the checkpoint of a previous run is removed
+    :return: the state of the checkpoint, with the trials of the run to continue in ``trials`` and the seed of its
+        variation of the parameters between the buildings in ``seed`` (both None when starting a new run or if there
+        is nothing to resume)
+    """
+    results_file = get_results_file(project_path)
+    trials_file = get_trials_file(project_path)
+    timings_file = get_timings_file(project_path)
+    perturbations_file = get_perturbations_file(project_path)
+    archives_folder = get_archives_folder(project_path)
+    metrics_folder = get_metrics_folder(project_path)
+    screening_report_file = get_screening_report_file(project_path)
+    output_path = os.path.dirname(results_file)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    checkpoint = {'results_file': results_file, 'trials_file': trials_file, 'timings_file': timings_file,
+                  'perturbations_file': perturbations_file, 'archives_folder': archives_folder,
+                  'metrics_folder': metrics_folder,
+                  'screening_report_file': screening_report_file, 'stored_trials': set(), 'trials': None,
+                  'seed': None}
+    if resume and os.path.exists(trials_file):
+        checkpoint['trials'] = load_trials(trials_file)
+        if os.path.exists(results_file):
+            checkpoint['stored_trials'] = set(pd.read_csv(results_file, usecols=['eval'])['eval'])
+        if os.path.exists(perturbations_file):
+            checkpoint['seed'] = read_perturbations(perturbations_file)[0]
+        print('Resuming the calibration from {} finished trials'.format(len(checkpoint['trials'].trials)))
+    else:
+        for path in [results_file, trials_file, timings_file, perturbations_file, screening_report_file]:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(archives_folder, ignore_errors=True)
+        shutil.rmtree(metrics_folder, ignore_errors=True)
+    return checkpoint
+
+
+def update_checkpoint(checkpoint, trials):
+    """
+    Saves the trials and appends the trials that finished since the last update to the results table, their building
+    metrics to the cube of the metrics and their phase timings to the timings log. Of the archives written by these
+    trials, only the one of the best trial is kept. Only the new rows are written, the table is never read or rebuilt.
+    """
+    new_trials = [trial for trial in trials.trials
+                  if trial['state'] == JOB_STATE_DONE and trial['tid'] not in checkpoint['stored_trials']]
+    if not new_trials:
+        return
+    # the building metrics are only kept in the cube, so that saving the trials does not grow with the buildings
+    append_metrics(checkpoint['metrics_folder'], new_trials)
+    for trial in new_trials:
+        trial['result'].pop('building_metrics', None)
+    # the trials are saved first: after a crash in between, the results are completed from them on resume
+    save_trials(checkpoint['trials_file'], trials)
+    new_rows = pd.DataFrame([get_results_row(trial) for trial in new_trials], columns=RESULTS_COLUMNS)
+    write_header = not os.path.exists(checkpoint['results_file'])
+    with open(checkpoint['results_file'], 'a') as f:
+        new_rows.to_csv(f, index=False, header=write_header)
+        f.flush()
+        os.fsync(f.fileno())
+    append_timings(checkpoint['timings_file'], new_trials)
+    keep_best_archive(checkpoint['archives_folder'], trials)
+    checkpoint['stored_trials'].update(trial['tid'] for trial in new_trials)
@@ -0,0 +1,132 @@
+"""
+Cache of the monthly demand of the buildings of a scenario. The validation only needs the monthly sums of one or a few
+load variables, so these are kept in a compact npz file next to the demand results and each hourly demand file is only
+read again when it changes (a file is identified by its path, size and modification time).
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import numpy as np
+import pandas as pd
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+
+def get_monthly_demand_cache_file(locator):
+    """scenario/outputs/data/calibration/monthly_demand_cache.npz"""
+    folder = os.path.join(locator.scenario, 'outputs', 'data', 'calibration')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, 'monthly_demand_cache.npz')
+
+
+def get_fingerprint(demand_file):
+    """path, size and modification time of a demand file"""
+    stat = os.stat(demand_file)
+    return os.path.abspath(demand_file), stat.st_size, stat.st_mtime_ns
+
+
+def calc_monthly_demand(demand_file, loads):
+    """
+    Sums the loads of a demand file up to monthly values. Works for hourly and monthly results.
+
+    :param loads: load variables without unit, e.g. ['GRID', 'QC_sys']
+    :return: monthly demand [kWh], array of (loads x 12)
+    """
+    columns = [load + '_kWh' for load in loads]
+    demand = pd.read_csv(demand_file, usecols=lambda column: column == 'DATE' or column in columns)
+    missing_columns = [column for column in columns if column not in demand.columns]
+    if missing_columns:
+        raise ValueError('The demand results in {} have no {} column, run the demand with these loads in '
+                         'demand:loads-output'.format(demand_file, ', '.join(missing_columns)))
+    if 'DATE' in demand.columns:
+        # the month is read from the DATE string (yyyy-mm-dd ...), which is much faster than parsing the dates
+        month = demand['DATE'].str.slice(5, 7).astype(int).values
+    elif len(demand) == 12:
+        month = np.arange(1, 13)  # monthly results without dates, one row per month
+    else:
+        raise ValueError('The demand results in {} have no DATE column'.format(demand_file))
+    return np.array([np.bincount(month - 1, weights=demand[column].values, minlength=12) for column in columns])
+
+
+def read_cache(cache_file):
+    """
+    :return: dict with the cached fingerprints (``paths``, ``sizes``, ``mtimes``) and monthly ``values`` of each
+        building (array of buildings x loads x 12, nan where a load was not read yet), or an empty cache
+    """
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as cache:
+                return {key: cache[key] for key in cache.files}
+        except (IOError, ValueError):
+            print('The monthly demand cache {} can not be read, it is rebuilt'.format(cache_file))
+    return {'buildings': np.array([], dtype=str), 'paths': np.array([], dtype=str),
+            'sizes': np.array([], dtype=np.int64), 'mtimes': np.array([], dtype=np.int64),
+            'loads': np.array([], dtype=str), 'values': np.zeros((0, 0, 12))}
+
+
+def write_cache(cache_file, cache):
+    # write to a temporary file first, so that a process reading the cache at the same time never sees half a file
+    temporary_file = cache_file + '.%i.tmp.npz' % os.getpid()
+    np.savez(temporary_file, **cache)
+    os.replace(temporary_file, cache_file)
+
+
+def read_monthly_demand(locator, building_names, loads):
+    """
+    Monthly demand of the buildings, served from the cache of the scenario where possible. Only the demand files that
+    changed since they were cached, or loads that were not cached yet, are read.
+
+    :param loads: load variables without unit, e.g. ['GRID', 'QC_sys']
+    :return: dict of load variable -> monthly demand [kWh], array of (buildings x 12)
+    """
+    cache_file = get_monthly_demand_cache_file(locator)
+    cache = read_cache(cache_file)
+    cached_buildings = {building_name: i for i, building_name in enumerate(cache['buildings'])}
+
+    # extend the cache with the loads that are not cached yet
+    new_loads = [load for load in loads if load not in cache['loads']]
+    if new_loads:
+        cache['loads'] = np.append(cache['loads'], new_loads)
+        cache['values'] = np.concatenate([cache['values'], np.full((len(cache['buildings']), len(new_loads), 12),
+                                                                   np.nan)], axis=1)
+    load_columns = [list(cache['loads']).index(load) for load in loads]
+
+    new_entries = []
+    monthly_demand = np.zeros((len(building_names), len(loads), 12))
+    for i, building_name in enumerate(building_names):
+        path, size, mtime = get_fingerprint(locator.get_demand_results_file(building_name))
+        j = cached_buildings.get(building_name)
+        if j is not None and (cache['paths'][j], cache['sizes'][j], cache['mtimes'][j]) == (path, size, mtime):
+            if not np.isnan(cache['values'][j, load_columns]).any():
+                monthly_demand[i] = cache['values'][j, load_columns]
+                continue
+            values = cache['values'][j].copy()
+        else:
+            # a new or changed demand file, the values read from the old one are not valid anymore
+            values = np.full((len(cache['loads']), 12), np.nan)
+        values[load_columns] = calc_monthly_demand(path, loads)
+        monthly_demand[i] = values[load_columns]
+        new_entries.append((building_name, path, size, mtime, values))
+
+    if new_entries:
+        # drop the old entries of the updated buildings and append the new ones
+        updated_buildings = set(entry[0] for entry in new_entries)
+        keep = np.array([building_name not in updated_buildings for building_name in cache['buildings']], dtype=bool)
+        names, paths, sizes, mtimes, values = zip(*new_entries)
+        cache = {'buildings': np.append(cache['buildings'][keep], names),
+                 'paths': np.append(cache['paths'][keep], paths),
+                 'sizes': np.append(cache['sizes'][keep], np.array(sizes, dtype=np.int64)),
+                 'mtimes': np.append(cache['mtimes'][keep], np.array(mtimes, dtype=np.int64)),
+                 'loads': cache['loads'],
+                 'values': np.concatenate([cache['values'][keep], np.array(values)])}
+        write_cache(cache_file, cache)
+
+    return {load: monthly_demand[:, k] for k, load in enumerate(loads)}
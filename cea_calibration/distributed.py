@@ -0,0 +1,280 @@
+"""
+Distributed calibration over a shared filesystem. The coordinator publishes the evaluations of the calibration (the
+trials and the points of the screening) as tasks to an SQLite queue in the output folder of the project, and workers
+started on other nodes claim the tasks, evaluate them in their own workspaces and post the results back. While a
+worker evaluates a task it increments the heartbeat of the task, a task whose heartbeat did not change for the timeout
+of the queue (as seen by the coordinator, so the clocks of the nodes do not need to agree) is given to another worker.
+The queue uses the default rollback journal of SQLite, which only needs the file locks of the shared filesystem.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from queue import Queue
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# seconds between two looks at the queue, of the coordinator (for results and lost workers) and of the idle workers
+POLL_SECONDS = 1.0
+# seconds a connection waits for the lock of the queue held by another process
+LOCK_TIMEOUT_SECONDS = 60.0
+# a task lost by this many workers fails the calibration instead of being given to yet another worker
+MAX_ATTEMPTS = 3
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY AUTOINCREMENT, payload BLOB NOT NULL, state TEXT NOT NULL,
+                                  worker TEXT, heartbeat INTEGER NOT NULL DEFAULT 0,
+                                  attempts INTEGER NOT NULL DEFAULT 0, result BLOB);
+CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY CHECK (id = 0), is_open INTEGER NOT NULL,
+                                  worker_timeout REAL NOT NULL);
+"""
+
+
+def get_queue_file(project_path):
+    """project/output/calibration/calibration_queue.sqlite"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_queue.sqlite')
+
+
+@contextmanager
+def transaction(queue_file):
+    """connection to the queue inside a transaction that holds the write lock of the queue until it is committed"""
+    connection = sqlite3.connect(queue_file, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        yield connection
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+
+def open_queue(queue_file, worker_timeout):
+    """creates the queue (or empties the queue of a previous calibration) and opens it to the workers"""
+    connection = sqlite3.connect(queue_file, timeout=LOCK_TIMEOUT_SECONDS)
+    try:
+        connection.executescript(QUEUE_SCHEMA)
+    finally:
+        connection.close()
+    with transaction(queue_file) as connection:
+        connection.execute('DELETE FROM tasks')
+        connection.execute('INSERT OR REPLACE INTO queue (id, is_open, worker_timeout) VALUES (0, 1, ?)',
+                           (worker_timeout,))
+
+
+def close_queue(queue_file):
+    """closes the queue, the tasks nobody claimed are dropped and the workers stop after their current task"""
+    with transaction(queue_file) as connection:
+        connection.execute("DELETE FROM tasks WHERE state = 'pending'")
+        connection.execute('UPDATE queue SET is_open = 0')
+
+
+def read_queue_state(queue_file):
+    """
+    whether the queue is open and its worker timeout, None if no coordinator created the queue yet or the queue could
+    not be read (e.g. it is locked by other processes for longer than ``LOCK_TIMEOUT_SECONDS``)
+    """
+    if not os.path.exists(queue_file):
+        return None
+    try:
+        with transaction(queue_file) as connection:
+            row = connection.execute('SELECT is_open, worker_timeout FROM queue').fetchone()
+    except sqlite3.OperationalError:
+        return None  # the coordinator is still creating the queue
+    if row is None:
+        return None
+    return {'is_open': bool(row[0]), 'worker_timeout': row[1]}
+
+
+def dump_result(value):
+    """pickles the result of a task, an exception that can not be pickled is replaced by its traceback"""
+    try:
+        return pickle.dumps(value)
+    except Exception:
+        return pickle.dumps(RuntimeError(''.join(traceback.format_exception(type(value), value,
+                                                                            value.__traceback__))))
+
+
+class QueuePool(object):
+    """
+    Coordinator of the queue, with the part of the interface of ``multiprocessing.Pool`` used by the calibration
+    (``apply_async``, ``starmap``, ``terminate`` and ``join``), so the trials run on the workers exactly as they run on
+    the worker processes of a local pool. The results are collected, and the tasks of lost workers given back to the
+    queue, by a thread of the coordinator.
+    """
+
+    def __init__(self, queue_file, worker_timeout):
+        self.queue_file = queue_file
+        self.worker_timeout = worker_timeout
+        self.callbacks = {}  # task id -> (callback, error_callback)
+        self.heartbeats = {}  # task id -> (last heartbeat, time the coordinator saw it change)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        open_queue(queue_file, worker_timeout)
+        self.thread = threading.Thread(target=self.collect_results)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        payload = pickle.dumps((func, args))
+        with self.lock:  # registered before the collector can see the result
+            with transaction(self.queue_file) as connection:
+                task_id = connection.execute("INSERT INTO tasks (payload, state) VALUES (?, 'pending')",
+                                             (payload,)).lastrowid
+            self.callbacks[task_id] = (callback, error_callback)
+
+    def starmap(self, func, iterable):
+        tasks = list(iterable)
+        finished = Queue()
+        for k, args in enumerate(tasks):
+            self.apply_async(func, args, callback=lambda result, k=k: finished.put((k, result, None)),
+                             error_callback=lambda error, k=k: finished.put((k, None, error)))
+        results = [None] * len(tasks)
+        for _ in tasks:
+            k, result, error = finished.get()
+            if error is not None:
+                raise error
+            results[k] = result
+        return results
+
+    def collect_results(self):
+        while not self.stopped.wait(POLL_SECONDS):
+            try:
+                finished_tasks = self.check_tasks()
+            except sqlite3.OperationalError as error:
+                print('The queue is busy ({}), trying again'.format(error))
+                continue
+            for task_id, state, result in finished_tasks:
+                callback, error_callback = self.callbacks.pop(task_id, (None, None))
+                self.heartbeats.pop(task_id, None)
+                result = pickle.loads(result)
+                if state == 'done' and callback is not None:
+                    callback(result)
+                elif state == 'failed' and error_callback is not None:
+                    error_callback(result)
+
+    def check_tasks(self):
+        """
+        Takes the finished tasks out of the queue, and gives the tasks of the workers that did not beat for
+        ``worker_timeout`` seconds to other workers.
+
+        :return: (task id, state, pickled result) of the finished tasks
+        """
+        now = time.time()
+        with self.lock, transaction(self.queue_file) as connection:
+            finished_tasks = connection.execute("SELECT id, state, result FROM tasks "
+                                                "WHERE state IN ('done', 'failed')").fetchall()
+            connection.executemany('DELETE FROM tasks WHERE id = ?', [(task[0],) for task in finished_tasks])
+            for task_id, worker, heartbeat, attempts in connection.execute(
+                    "SELECT id, worker, heartbeat, attempts FROM tasks WHERE state = 'running'").fetchall():
+                last_heartbeat, seen = self.heartbeats.get(task_id, (None, now))
+                if heartbeat != last_heartbeat:
+                    self.heartbeats[task_id] = (heartbeat, now)
+                elif now - seen > self.worker_timeout:
+                    del self.heartbeats[task_id]
+                    if attempts >= MAX_ATTEMPTS:
+                        error = RuntimeError('Task {} was lost by {} workers'.format(task_id, attempts))
+                        connection.execute("UPDATE tasks SET state = 'failed', result = ? WHERE id = ?",
+                                           (dump_result(error), task_id))
+                    else:
+                        print('Worker {} did not answer for {:.0f} s, its task is given to another worker'.format(
+                            worker, now - seen))
+                        connection.execute("UPDATE tasks SET state = 'pending', worker = NULL WHERE id = ?",
+                                           (task_id,))
+        return finished_tasks
+
+    def terminate(self):
+        self.stopped.set()
+        close_queue(self.queue_file)
+
+    def join(self):
+        self.thread.join()
+
+
+def claim_task(queue_file, worker):
+    """the oldest pending task (task id, payload), claimed by ``worker``, None if there is none"""
+    with transaction(queue_file) as connection:
+        task = connection.execute("SELECT id, payload FROM tasks WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+        if task is not None:
+            connection.execute("UPDATE tasks SET state = 'running', worker = ?, heartbeat = 0, attempts = attempts + 1 "
+                               "WHERE id = ?", (worker, task[0]))
+    return task
+
+
+def post_result(queue_file, task_id, worker, state, result):
+    """posts the result of a task, unless the task was given to another worker in the meantime"""
+    with transaction(queue_file) as connection:
+        connection.execute("UPDATE tasks SET state = ?, result = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                           (state, dump_result(result), task_id, worker))
+
+
+def beat(queue_file, task_id, worker, interval, stopped):
+    """increments the heartbeat of the task every ``interval`` seconds, until ``stopped`` is set"""
+    while not stopped.wait(interval):
+        try:
+            with transaction(queue_file) as connection:
+                connection.execute('UPDATE tasks SET heartbeat = heartbeat + 1 WHERE id = ? AND worker = ?',
+                                   (task_id, worker))
+        except sqlite3.OperationalError:
+            pass  # the queue is busy, the next beat is in time
+
+
+def run_worker(queue_file, initializer, initargs):
+    """
+    Serves the queue of a coordinator: waits for the coordinator to open the queue, prepares the worker with
+    ``initializer(*initargs)`` and evaluates the tasks one at a time, until the coordinator closes the queue.
+    """
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    print('Worker {} waiting for the tasks of {}'.format(worker, queue_file))
+    initialized = False
+    while True:
+        queue_state = read_queue_state(queue_file)
+        if queue_state is None or not queue_state['is_open']:
+            if initialized and queue_state is not None:
+                break  # the coordinator closed the queue, a queue that could not be read is tried again
+            time.sleep(POLL_SECONDS)
+            continue
+        if not initialized:
+            initializer(*initargs)
+            initialized = True
+        try:
+            task = claim_task(queue_file, worker)
+        except sqlite3.OperationalError as error:
+            print('The queue is busy ({}), trying again'.format(error))
+            task = None
+        if task is None:
+            time.sleep(POLL_SECONDS)
+            continue
+
+        task_id, payload = task
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=beat, args=(queue_file, task_id, worker,
+                                                        queue_state['worker_timeout'] / 4, stopped))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            func, args = pickle.loads(payload)
+            state, result = 'done', func(*args)
+        except Exception as error:
+            traceback.print_exc()
+            state, result = 'failed', error
+        finally:
+            stopped.set()
+            heartbeat.join()
+        post_result(queue_file, task_id, worker, state, result)
+    print('Worker {} finished, the coordinator closed the queue'.format(worker))
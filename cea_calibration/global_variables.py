@@ -1,3 +1,4 @@
 # settings.py
 global_validation_n_calibrated = []
-global_validation_percentage = []
\ No newline at end of file
+global_validation_percentage = []
+global_validation_results = []
@@ -0,0 +1,140 @@
+"""
+Hourly measurements of the buildings (smart meter readings). The measurements of a scenario are read in chunks of rows
+into a memory-mapped array of (buildings x 8760) values next to the demand results, which is only rebuilt when the
+measurements change. The readings and the demand results are aligned by the hour of the year of their DATE (month,
+day and hour, as in the standard year of CEA without the 29th of February), so the memory used does not grow with the
+number of buildings.
+"""
+from __future__ import division
+from __future__ import print_function
+import json
+import os
+import numpy as np
+import pandas as pd
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+HOURS_IN_YEAR = 8760
+# first day of each month in a year without the 29th of February
+FIRST_DAY_OF_MONTH = np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+# number of values read at once from the measurements (rows of a chunk x buildings)
+CHUNK_VALUES = 2 ** 20
+
+
+def get_hourly_measurements_array_file(locator):
+    """scenario/outputs/data/calibration/hourly_measurements.npy"""
+    folder = os.path.join(locator.scenario, 'outputs', 'data', 'calibration')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, 'hourly_measurements.npy')
+
+
+def calc_hour_of_year(dates):
+    """
+    Hour of the year (0 to 8759) of each DATE string (yyyy-mm-dd hh...), -1 for the 29th of February. The parts of the
+    date are sliced from the strings, which is much faster than parsing the dates.
+    """
+    dates = pd.Series(dates).astype(str)
+    month = dates.str.slice(5, 7).astype(int).values
+    day = dates.str.slice(8, 10).astype(int).values
+    hour = dates.str.slice(11, 13).astype(int).values
+    hour_of_year = (FIRST_DAY_OF_MONTH[month - 1] + day - 1) * 24 + hour
+    return np.where((month == 2) & (day == 29), -1, hour_of_year)
+
+
+def read_hourly_building_names(measurements_file):
+    """the buildings of the hourly measurements (all the columns but DATE)"""
+    return [column for column in pd.read_csv(measurements_file, nrows=0).columns if column != 'DATE']
+
+
+def ingest_hourly_measurements(measurements_file, array_file):
+    """
+    Reads the hourly measurements (a DATE column and one column of readings per building) chunk by chunk into the
+    memory-mapped ``array_file``, hours without a reading are NaN.
+    """
+    building_names = read_hourly_building_names(measurements_file)
+    hourly_measured = np.lib.format.open_memmap(array_file, mode='w+', dtype=np.float32,
+                                                shape=(len(building_names), HOURS_IN_YEAR))
+    hourly_measured[:] = np.nan
+    chunk_size = max(1, CHUNK_VALUES // max(1, len(building_names)))
+    for chunk in pd.read_csv(measurements_file, chunksize=chunk_size,
+                             dtype=dict((building_name, np.float32) for building_name in building_names)):
+        hour_of_year = calc_hour_of_year(chunk['DATE'])
+        rows = hour_of_year >= 0
+        hourly_measured[:, hour_of_year[rows]] = chunk[building_names].values[rows].T
+    hourly_measured.flush()
+    del hourly_measured
+
+
+def read_hourly_measurements(locator):
+    """
+    Hourly measurements of a scenario, ingested again only if the measurements changed since the last time (see
+    ``ingest_hourly_measurements``).
+
+    :return: names of the measured buildings and their readings [kWh], memory-mapped array of (buildings x 8760)
+    """
+    measurements_file = locator.get_hourly_measurements()
+    array_file = get_hourly_measurements_array_file(locator)
+    metadata_file = os.path.splitext(array_file)[0] + '.json'
+    stat = os.stat(measurements_file)
+    fingerprint = [os.path.abspath(measurements_file), stat.st_size, stat.st_mtime_ns]
+
+    metadata = None
+    if os.path.exists(metadata_file) and os.path.exists(array_file):
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+    if metadata is None or metadata['fingerprint'] != fingerprint:
+        print('Reading the hourly measurements of {}'.format(locator.scenario))
+        ingest_hourly_measurements(measurements_file, array_file)
+        metadata = {'fingerprint': fingerprint, 'buildings': read_hourly_building_names(measurements_file)}
+        with open(metadata_file, 'w') as f:
+            json.dump(metadata, f)
+    return metadata['buildings'], np.load(array_file, mmap_mode='r')
+
+
+def read_hourly_demand(locator, building_names, load='GRID'):
+    """
+    Hourly modelled demand of the buildings, aligned with the hourly measurements by the hour of the year of the DATE
+    of the demand results (hours without results are NaN).
+
+    :return: hourly modelled demand [kWh], array of (buildings x 8760)
+    """
+    column = load + '_kWh'
+    hourly_modelled = np.full((len(building_names), HOURS_IN_YEAR), np.nan)
+    for i, building_name in enumerate(building_names):
+        demand_file = locator.get_demand_results_file(building_name)
+        demand = pd.read_csv(demand_file, usecols=['DATE', column])
+        if len(demand) < HOURS_IN_YEAR:
+            raise ValueError('The demand results in {} are not hourly, run the demand with demand:resolution-output '
+                             'hourly to validate the hourly measurements'.format(demand_file))
+        hour_of_year = calc_hour_of_year(demand['DATE'])
+        rows = hour_of_year >= 0
+        hourly_modelled[i, hour_of_year[rows]] = demand[column].values[rows]
+    return hourly_modelled
+
+
+def calc_hourly_errors(measured, modelled):
+    """
+    Normalized mean bias error and coefficient of variation of the root mean squared error of many buildings at once,
+    over the hours with both a reading and a modelled value.
+
+    :param measured: measured values, array of (buildings x hours), NaN for the hours without a reading
+    :param modelled: modelled values, array of (buildings x hours)
+    :return: CV(RMSE) and NMBE [%] of each building
+    """
+    valid = ~np.isnan(measured) & ~np.isnan(modelled)
+    hours = valid.sum(axis=1)
+    biased_error = np.where(valid, measured - modelled, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):  # buildings without readings are never calibrated
+        mean_measured = np.where(valid, measured, 0.0).sum(axis=1) / hours
+        normalized_mean_biased_error = (biased_error.sum(axis=1) / hours / mean_measured) * 100  # %
+        root_mean_squared_error = np.sqrt((biased_error ** 2).sum(axis=1) / hours)
+        cv_root_mean_squared_error = root_mean_squared_error * 100 / mean_measured
+    return cv_root_mean_squared_error, normalized_mean_biased_error
@@ -0,0 +1,229 @@
+"""
+Metrics of every measured building in every trial of a calibration (NMBE, CV(RMSE), calibrated flag and monthly
+modelled demand), stored as a cube of (trials x buildings) arrays in ``output/calibration/calibration_metrics/``, one
+``.npy`` file per array. The rows of the trials are appended to the files as the trials finish. The files are
+memory-mapped when loaded, so the cube can be sliced without reading all of it, and the questions about single
+buildings are answered without running the validation again.
+"""
+from __future__ import division
+from __future__ import print_function
+import io
+import os
+import numpy as np
+import pandas as pd
+import cea.inputlocator
+from cea_calibration.validation import MONTHS_IN_YEAR_NAMES, calc_building_loss
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# calibrated flag of a building that was not simulated in a trial (screening and pruned trials)
+NOT_SIMULATED = -1
+# arrays of the cube with one row per trial, ``tid`` is appended last (see ``append_metrics``)
+TRIAL_ARRAYS = ['loss', 'fidelity', 'pruned', 'normalized_mean_biased_error', 'cv_root_mean_squared_error',
+                'calibrated', 'monthly_modelled', 'tid']
+
+
+def get_metrics_folder(project_path):
+    """project/output/calibration/calibration_metrics"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_metrics')
+
+
+def read_measured_buildings(scenario_list, plugins):
+    """
+    The measured buildings of all the scenarios, in the order of the validation (scenario by scenario, in the order of
+    the measurements).
+
+    :return: index of the scenario and name of each building, and their monthly measurements (buildings x 12)
+    """
+    scenarios = []
+    building_names = []
+    monthly_measured = []
+    for i, scenario in enumerate(scenario_list):
+        locator = cea.inputlocator.InputLocator(scenario, plugins)
+        monthly_measured_data = pd.read_csv(locator.get_monthly_measurements())
+        scenarios.extend([i] * len(monthly_measured_data))
+        building_names.extend(monthly_measured_data.Name)
+        monthly_measured.append(monthly_measured_data[MONTHS_IN_YEAR_NAMES].values.astype(float))
+    return np.array(scenarios), np.array(building_names, dtype=str), np.concatenate(monthly_measured)
+
+
+def calc_building_metrics(buildings, validation_results, simulated_buildings):
+    """
+    Metrics of a trial for all the measured ``buildings`` ((scenario index, name) pairs). The buildings the trial did
+    not simulate are NaN (and ``NOT_SIMULATED``).
+
+    :param validation_results: the results of ``validation`` for the trial
+    :param simulated_buildings: (scenario index, name) of the buildings in ``validation_results``, in their order
+    """
+    positions = dict((building, k) for k, building in enumerate(buildings))
+    simulated = [positions[building] for building in simulated_buildings]
+    metrics = {'normalized_mean_biased_error': np.full(len(buildings), np.nan, dtype=np.float32),
+               'cv_root_mean_squared_error': np.full(len(buildings), np.nan, dtype=np.float32),
+               'calibrated': np.full(len(buildings), NOT_SIMULATED, dtype=np.int8),
+               'monthly_modelled': np.full((len(buildings), 12), np.nan, dtype=np.float32)}
+    metrics['normalized_mean_biased_error'][simulated] = validation_results['normalized_mean_biased_error']
+    metrics['cv_root_mean_squared_error'][simulated] = validation_results['cv_root_mean_squared_error']
+    metrics['calibrated'][simulated] = validation_results['calibrated']
+    metrics['monthly_modelled'][simulated] = validation_results['modelled']
+    return metrics
+
+
+def write_measured_buildings(metrics_folder, scenario_list, scenarios, building_names, monthly_measured):
+    """
+    Writes the arrays of the measured buildings of the cube (see ``read_measured_buildings``), the buildings of the
+    rows appended by ``append_metrics``.
+    """
+    if not os.path.exists(metrics_folder):
+        os.makedirs(metrics_folder)
+    for name, array in [('scenario_list', np.array(scenario_list, dtype=str)),
+                        ('scenario', scenarios),
+                        ('building_name', building_names),
+                        ('monthly_measured', monthly_measured.astype(np.float32))]:
+        np.save(os.path.join(metrics_folder, name + '.npy'), array)
+
+
+def append_rows(array_file, rows, n_rows):
+    """
+    Appends ``rows`` to the array of the ``.npy`` file after its first ``n_rows`` rows (the rows after them were left
+    by an interrupted append and are dropped). The data is appended before the shape in the header is updated, numpy
+    leaves room in the header for the first dimension to grow, so it is rewritten in place.
+    """
+    rows = np.ascontiguousarray(rows)
+    if not os.path.exists(array_file):
+        np.save(array_file, rows)
+        return
+    with open(array_file, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            read_array_header, write_array_header = (np.lib.format.read_array_header_1_0,
+                                                     np.lib.format.write_array_header_1_0)
+        else:
+            read_array_header, write_array_header = (np.lib.format.read_array_header_2_0,
+                                                     np.lib.format.write_array_header_2_0)
+        shape, fortran_order, dtype = read_array_header(f)
+        data_offset = f.tell()
+        header = io.BytesIO()
+        write_array_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                                    'shape': (n_rows + len(rows),) + tuple(shape[1:])})
+        if len(header.getvalue()) == data_offset:
+            f.truncate(data_offset + n_rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(rows.astype(dtype).tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+    # a header written by another version of numpy, without room to grow
+    np.save(array_file, np.concatenate([np.load(array_file)[:n_rows], rows.astype(dtype)]))
+
+
+def append_metrics(metrics_folder, trials):
+    """
+    Appends the building metrics of the finished ``trials`` (``building_metrics`` of their result, see
+    ``calc_building_metrics``) to the cube, the trials already in the cube are skipped. ``tid`` is appended last, so
+    the rows of a crashed append are dropped by the next one (see ``append_rows``) and ignored by ``load_metrics``.
+    """
+    tid_file = os.path.join(metrics_folder, 'tid.npy')
+    stored_tids = np.load(tid_file) if os.path.exists(tid_file) else np.empty(0, dtype=np.int64)
+    trials = [trial for trial in trials if 'building_metrics' in trial['result'] and trial['tid'] not in stored_tids]
+    if not trials:
+        return
+    arrays = {'loss': np.array([trial['result']['loss'] for trial in trials], dtype=np.float64),
+              'fidelity': np.array([trial['result']['fidelity'] for trial in trials], dtype=np.float64),
+              'pruned': np.array([trial['result']['pruned'] for trial in trials], dtype=bool),
+              'tid': np.array([trial['tid'] for trial in trials], dtype=np.int64)}
+    for metric, dtype in [('normalized_mean_biased_error', np.float32), ('cv_root_mean_squared_error', np.float32),
+                          ('calibrated', np.int8), ('monthly_modelled', np.float32)]:
+        arrays[metric] = np.array([trial['result']['building_metrics'][metric] for trial in trials], dtype=dtype)
+    for name in TRIAL_ARRAYS:
+        append_rows(os.path.join(metrics_folder, name + '.npy'), arrays[name], len(stored_tids))
+
+
+def load_metrics(metrics_folder):
+    """
+    The cube written by ``write_measured_buildings`` and ``append_metrics``, memory-mapped: dict of array name ->
+    array, the arrays of the building metrics are (trials x buildings), in the order of ``tid`` and of ``scenario``
+    (index in ``scenario_list``) / ``building_name``.
+    """
+    metrics = dict((os.path.splitext(file_name)[0], np.load(os.path.join(metrics_folder, file_name), mmap_mode='r'))
+                   for file_name in os.listdir(metrics_folder) if file_name.endswith('.npy'))
+    n_trials = len(metrics['tid']) if 'tid' in metrics else 0
+    for name in TRIAL_ARRAYS:
+        if name in metrics:
+            metrics[name] = metrics[name][:n_trials]
+    return metrics
+
+
+def get_trial_metrics(metrics, tid):
+    """metrics of the measured buildings in the trial ``tid`` (dict of metric -> array), None if it is not in the cube"""
+    if 'tid' not in metrics:
+        return None
+    rows = np.flatnonzero(np.asarray(metrics['tid']) == tid)
+    if len(rows) == 0:
+        return None
+    return dict((metric, np.asarray(metrics[metric][rows[0]])) for metric in ['normalized_mean_biased_error',
+                                                                             'cv_root_mean_squared_error',
+                                                                             'calibrated', 'monthly_modelled'])
+
+
+def get_best_trials_of_buildings(metrics):
+    """
+    Best trial of each building: the trial with the lowest loss of the building (its NMBE and CV(RMSE) relative to
+    the ASHRAE limits, see ``calc_building_loss``) among the trials that simulated it.
+
+    :return: one row per building with the id of its best trial (-1 if no trial simulated it) and its metrics there
+    """
+    normalized_mean_biased_error = np.asarray(metrics['normalized_mean_biased_error'])
+    cv_root_mean_squared_error = np.asarray(metrics['cv_root_mean_squared_error'])
+    calibrated = np.asarray(metrics['calibrated'])
+    tids = np.asarray(metrics['tid'])[:, np.newaxis].repeat(calibrated.shape[1], axis=1)
+    losses = np.where(calibrated != NOT_SIMULATED,
+                      calc_building_loss(cv_root_mean_squared_error, normalized_mean_biased_error), np.inf)
+    # an extra trial that simulated no building, it is the best trial of the buildings that were never simulated
+    cubes = [np.concatenate([cube, np.full((1, cube.shape[1]), missing, dtype=cube.dtype)]) for cube, missing in
+             [(tids, -1), (losses, np.inf), (normalized_mean_biased_error, np.nan), (cv_root_mean_squared_error, np.nan),
+              (calibrated, NOT_SIMULATED)]]
+    best = np.argmin(cubes[1], axis=0)
+    buildings = np.arange(calibrated.shape[1])
+    tids, losses, normalized_mean_biased_error, cv_root_mean_squared_error, calibrated = [cube[best, buildings]
+                                                                                          for cube in cubes]
+    return pd.DataFrame({'scenario': np.asarray(metrics['scenario']),
+                         'Name': np.asarray(metrics['building_name']),
+                         'tid': np.where(np.isfinite(losses), tids, -1),
+                         'loss': losses,
+                         'normalized_mean_biased_error': normalized_mean_biased_error,
+                         'cv_root_mean_squared_error': cv_root_mean_squared_error,
+                         'calibrated': calibrated})
+
+
+def get_never_calibrated_buildings(metrics):
+    """the buildings that were not calibrated in any trial, with the number of trials that simulated them"""
+    calibrated = np.asarray(metrics['calibrated'])
+    never_calibrated = ~(calibrated == 1).any(axis=0)
+    return pd.DataFrame({'scenario': np.asarray(metrics['scenario'])[never_calibrated],
+                         'Name': np.asarray(metrics['building_name'])[never_calibrated],
+                         'simulated_trials': (calibrated != NOT_SIMULATED).sum(axis=0)[never_calibrated]})
+
+
+def get_building_history(metrics, scenario, building_name):
+    """metrics of one building in every trial that simulated it"""
+    k = np.flatnonzero((np.asarray(metrics['scenario']) == scenario) &
+                       (np.asarray(metrics['building_name']) == building_name))[0]
+    simulated = np.asarray(metrics['calibrated'][:, k]) != NOT_SIMULATED
+    history = pd.DataFrame({'tid': np.asarray(metrics['tid'])[simulated],
+                            'fidelity': np.asarray(metrics['fidelity'])[simulated],
+                            'normalized_mean_biased_error': np.asarray(
+                                metrics['normalized_mean_biased_error'][:, k])[simulated],
+                            'cv_root_mean_squared_error': np.asarray(
+                                metrics['cv_root_mean_squared_error'][:, k])[simulated],
+                            'calibrated': np.asarray(metrics['calibrated'][:, k])[simulated]})
+    monthly_modelled = pd.DataFrame(np.asarray(metrics['monthly_modelled'][:, k])[simulated],
+                                    columns=MONTHS_IN_YEAR_NAMES)
+    return pd.concat([history, monthly_modelled], axis=1)
@@ -0,0 +1,127 @@
+"""
+Sensitivity screening of the calibrated parameters (elementary effects of Morris). Before the search, the parameters
+are varied one at a time along random trajectories through their ranges, and the effect of each step on the errors of
+the measured buildings is recorded. The parameters with little effect are frozen at the middle of their range, and
+only the others are searched by TPE.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from hyperopt.pyll import dfs
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# number of levels of the grid of the trajectories, each step changes a parameter by LEVELS / (2 (LEVELS - 1)) of
+# its range
+LEVELS = 4
+
+
+def get_screening_report_file(project_path):
+    """project/output/calibration/calibration_screening.csv"""
+    return os.path.join(project_path, 'output', 'calibration', 'calibration_screening.csv')
+
+
+def get_uniform_range(expression):
+    """lower and upper bound of a parameter of the search space defined with ``hp.uniform``"""
+    for node in dfs(expression):
+        if node.name == 'uniform':
+            return tuple(float(argument.obj) for argument in node.pos_args)
+    raise ValueError('Only parameters with a uniform distribution can be screened')
+
+
+def make_trajectories(n_parameters, n_trajectories, rstate):
+    """
+    Random trajectories through the unit hypercube of the parameters. Each trajectory starts at a random point of the
+    lower half of the grid and changes the parameters one at a time (in a random order) by ``delta``.
+
+    :return: points of the trajectories, array of (trajectories x parameters + 1 x parameters), the parameter changed
+        in each step, array of (trajectories x parameters), and ``delta``
+    """
+    delta = LEVELS / (2 * (LEVELS - 1))
+    lower_levels = np.arange(LEVELS // 2) / (LEVELS - 1)
+    points = np.empty((n_trajectories, n_parameters + 1, n_parameters))
+    changed_parameters = np.empty((n_trajectories, n_parameters), dtype=int)
+    for t in range(n_trajectories):
+        points[t, 0] = rstate.choice(lower_levels, size=n_parameters)
+        changed_parameters[t] = rstate.permutation(n_parameters)
+        for step, parameter in enumerate(changed_parameters[t]):
+            points[t, step + 1] = points[t, step]
+            points[t, step + 1, parameter] += delta
+    return points, changed_parameters, delta
+
+
+def calc_elementary_effects(outputs, changed_parameters, delta):
+    """
+    Mean of the absolute elementary effects (mu*) and standard deviation of the elementary effects (sigma) of each
+    parameter, averaged over the buildings.
+
+    :param outputs: output of each building at each point of the trajectories, array of (trajectories x parameters + 1
+        x buildings), NaN for the buildings that were not simulated
+    """
+    outputs = outputs[:, :, ~np.isnan(outputs).all(axis=(0, 1))]
+    n_trajectories, n_parameters = changed_parameters.shape
+    effects = np.empty((n_trajectories, n_parameters, outputs.shape[2]))
+    for t in range(n_trajectories):
+        effects[t, changed_parameters[t]] = (outputs[t, 1:] - outputs[t, :-1]) / delta
+    mu_star = np.nanmean(np.abs(effects), axis=(0, 2))
+    sigma = np.nanmean(np.nanstd(effects, axis=0), axis=1)
+    return mu_star, sigma
+
+
+def calc_screening_report(space, mu_star, sigma, threshold):
+    """
+    Ranks the parameters by their influence (mu*). The parameters with a mu* below ``threshold`` times the highest one
+    are frozen at the middle of their range.
+    """
+    normalized_mu_star = mu_star / np.max(mu_star) if np.max(mu_star) > 0 else np.ones_like(mu_star)
+    report = pd.DataFrame({'parameter': list(space),
+                           'mu_star': mu_star,
+                           'sigma': sigma,
+                           'mu_star_normalized': normalized_mu_star,
+                           'frozen': normalized_mu_star < threshold,
+                           'nominal': [np.mean(get_uniform_range(expression)) for expression in space.values()]})
+    report['rank'] = report['mu_star'].rank(ascending=False, method='first').astype(int)
+    return report.sort_values('rank')
+
+
+def calc_reduced_space(space, report):
+    """the search space with the frozen parameters of the ``report`` set to their nominal value"""
+    frozen = report.set_index('parameter')
+    return OrderedDict((label, float(frozen.loc[label, 'nominal']) if frozen.loc[label, 'frozen'] else expression)
+                       for label, expression in space.items())
+
+
+def screen_parameters(evaluate, space, n_trajectories, threshold, report_file, rstate=None):
+    """
+    Screens the parameters of ``space`` along ``n_trajectories`` trajectories (``n_trajectories`` x (parameters + 1)
+    evaluations) and saves the report to ``report_file``.
+
+    :param evaluate: function evaluating a list of points (dynamic_params, seed), returning an array of (points x
+        buildings) with the loss of each building (see ``calc_building_loss``). All the points of a trajectory get the
+        seed of the random variation of its first point, so that the steps only change one parameter.
+    :return: the report (see ``calc_screening_report``)
+    """
+    rstate = rstate if rstate is not None else np.random.default_rng()
+    ranges = np.array([get_uniform_range(expression) for expression in space.values()])
+    points, changed_parameters, delta = make_trajectories(len(space), n_trajectories, rstate)
+    seeds = rstate.integers(2 ** 32, size=n_trajectories)
+    parameter_values = ranges[:, 0] + points * (ranges[:, 1] - ranges[:, 0])
+    print('Screening the parameters with {} evaluations'.format(parameter_values.shape[0] * parameter_values.shape[1]))
+    outputs = np.asarray(evaluate([(OrderedDict(zip(space, values)), int(seeds[t]))
+                                   for t in range(n_trajectories) for values in parameter_values[t]]))
+    mu_star, sigma = calc_elementary_effects(outputs.reshape(points.shape[:2] + (-1,)), changed_parameters, delta)
+    report = calc_screening_report(space, mu_star, sigma, threshold)
+    report.to_csv(report_file, index=False)
+    print('Influence of the parameters:')
+    print(report.to_string(index=False))
+    return report
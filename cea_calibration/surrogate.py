@@ -0,0 +1,155 @@
+"""
+Surrogate pre-screening of the calibration trials. After a number of simulated trials, an emulator of the monthly demand
+of each building is fitted to the calibrated parameters of the building. For every new trial, many points are
+suggested by TPE and scored with the emulator against the ASHRAE criteria of the validation, and only the most promising
+point is simulated with CEA.
+"""
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from hyperopt import tpe, space_eval, JOB_STATE_DONE
+from cea_calibration.validation import calc_errors, calc_scores
+from cea_calibration.metrics import load_metrics, get_trial_metrics
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+
+def fit_emulator(building_parameters, monthly_modelled, regularization=1e-3):
+    """
+    Fits the emulator of each building: a power law of the calibrated parameters of the building for each month
+    (a linear ridge regression of the logarithms), which follows the mostly multiplicative effect of the parameters on
+    the demand. All buildings are fitted at once.
+
+    :param building_parameters: parameters of the measured buildings in the simulated trials,
+        array of (trials x buildings x parameters)
+    :param monthly_modelled: monthly demand simulated in these trials, array of (trials x buildings x 12)
+    :return: coefficients of the emulators, array of (buildings x parameters + 1 x 12)
+    """
+    features = get_features(building_parameters)
+    targets = np.log1p(np.maximum(monthly_modelled, 0.0))
+    penalty = regularization * np.eye(features.shape[2])
+    penalty[0, 0] = 0.0  # the intercept is not regularized
+    features_by_building = np.einsum('tbp,tbq->bpq', features, features) + penalty * features.shape[0]
+    targets_by_building = np.einsum('tbp,tbm->bpm', features, targets)
+    return np.linalg.solve(features_by_building, targets_by_building)
+
+
+def predict_emulator(coefficients, building_parameters):
+    """
+    :param building_parameters: parameters of the measured buildings, array of (points x buildings x parameters)
+    :return: emulated monthly demand, array of (points x buildings x 12)
+    """
+    return np.expm1(np.einsum('tbp,bpm->tbm', get_features(building_parameters), coefficients))
+
+
+def get_features(building_parameters):
+    logarithms = np.log(np.maximum(building_parameters, 1e-6))
+    return np.concatenate([np.ones(logarithms.shape[:2] + (1,)), logarithms], axis=2)
+
+
+def calc_emulated_scores(monthly_measured, monthly_emulated):
+    """score of the validation for each emulated point, array of (points x buildings x 12) -> (points)"""
+    scores = []
+    for monthly_modelled in monthly_emulated:
+        cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors(monthly_measured, monthly_modelled)
+        scores.append(calc_scores(cv_root_mean_squared_error, normalized_mean_biased_error, monthly_measured)[1].sum())
+    return np.array(scores)
+
+
+def get_dynamic_params(space, trial):
+    """parameters of a trial, as passed to the objective"""
+    return space_eval(space, dict((label, vals[0]) for label, vals in trial['misc']['vals'].items()))
+
+
+def update_surrogate(surrogate, space, trials):
+    """
+    Adds the simulated trials that finished since the last call to the training data of the emulator, their monthly
+    demand is read from the cube of the metrics. For the trials that were pre-screened, the emulated and simulated
+    results are compared and logged.
+    """
+    metrics = None
+    for trial in trials.trials:
+        if trial['state'] != JOB_STATE_DONE or trial['tid'] in surrogate['simulated_trials']:
+            continue
+        surrogate['simulated_trials'].add(trial['tid'])
+        if trial['result'].get('fidelity', 1.0) < 1.0 or trial['result'].get('pruned', False):
+            continue  # screening and pruned trials only simulated part of the measured buildings
+        metrics = metrics if metrics is not None else load_metrics(surrogate['metrics_folder'])
+        trial_metrics = get_trial_metrics(metrics, trial['tid'])
+        if trial_metrics is None:
+            continue  # a trial of a checkpoint written before the cube
+        monthly_modelled = trial_metrics['monthly_modelled'].astype(float)
+        surrogate['building_parameters'].append(surrogate['calc_building_parameters'](get_dynamic_params(space, trial)))
+        surrogate['monthly_modelled'].append(monthly_modelled)
+
+        if trial['tid'] in surrogate['predictions']:
+            emulated_score, monthly_emulated = surrogate['predictions'].pop(trial['tid'])
+            score = -1.0 * trial['result']['loss']
+            # CV(RMSE) of the emulated monthly demand of each building against the simulated one
+            emulator_error = calc_errors(monthly_modelled, monthly_emulated)[0]
+            log_entry = {'tid': trial['tid'],
+                         'emulated_score': emulated_score,
+                         'score': score,
+                         'emulator_cvrmse_median_%': np.nanmedian(emulator_error),
+                         'emulator_cvrmse_max_%': np.nanmax(emulator_error)}
+            surrogate['log'].append(log_entry)
+            print('Surrogate: trial {tid} emulated score {emulated_score:.0f}, simulated score {score:.0f}, '
+                  'CV(RMSE) of the emulator {emulator_cvrmse_median_%:.1f}% (median), '
+                  '{emulator_cvrmse_max_%:.1f}% (max)'.format(**log_entry))
+
+
+def suggest_with_surrogate(new_ids, domain, trials, seed, surrogate):
+    """
+    Search algorithm for hyperopt (same signature as ``tpe.suggest`` once the ``surrogate`` is bound with
+    ``hyperopt.partial``). Until ``surrogate['startup_trials']`` trials are simulated it is plain TPE, then each new
+    trial is the best of ``surrogate['candidates']`` TPE suggestions according to the emulator.
+
+    :param surrogate: state of the surrogate, see ``make_surrogate``
+    """
+    update_surrogate(surrogate, domain.expr, trials)
+    if len(surrogate['monthly_modelled']) < surrogate['startup_trials']:
+        return tpe.suggest(new_ids, domain, trials, seed)
+
+    coefficients = fit_emulator(np.array(surrogate['building_parameters']), np.array(surrogate['monthly_modelled']))
+    rstate = np.random.default_rng(seed)
+    new_trials = []
+    for new_id in new_ids:
+        candidates = [tpe.suggest([new_id], domain, trials, rstate.integers(2 ** 31 - 1))[0]
+                      for _ in range(surrogate['candidates'])]
+        building_parameters = np.array([surrogate['calc_building_parameters'](get_dynamic_params(domain.expr,
+                                                                                                 candidate))
+                                        for candidate in candidates])
+        monthly_emulated = predict_emulator(coefficients, building_parameters)
+        emulated_scores = calc_emulated_scores(surrogate['monthly_measured'], monthly_emulated)
+        best = int(np.argmax(emulated_scores))
+        surrogate['predictions'][new_id] = (emulated_scores[best], monthly_emulated[best])
+        new_trials.append(candidates[best])
+    return new_trials
+
+
+def make_surrogate(calc_building_parameters, monthly_measured, metrics_folder, startup_trials, candidates):
+    """
+    :param calc_building_parameters: function of the parameters of a trial returning the calibrated parameters of
+        the measured buildings, array of (buildings x parameters)
+    :param monthly_measured: monthly measurements of the measured buildings, array of (buildings x 12)
+    :param metrics_folder: folder of the cube of the metrics of the trials (see ``append_metrics``)
+    :param startup_trials: number of simulated trials before the emulator is used
+    :param candidates: number of TPE suggestions scored by the emulator for each simulated trial
+    """
+    return {'calc_building_parameters': calc_building_parameters,
+            'monthly_measured': monthly_measured,
+            'metrics_folder': metrics_folder,
+            'startup_trials': startup_trials,
+            'candidates': candidates,
+            'building_parameters': [],
+            'monthly_modelled': [],
+            'simulated_trials': set(),
+            'predictions': {},
+            'log': []}
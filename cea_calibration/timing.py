@@ -0,0 +1,124 @@
+"""
+Timing of the phases of the calibration (preparation of the scenarios, writing of the inputs, schedules, demand and
+validation). Each phase records its wall time, cpu time, how much it raised the peak memory of the process and the peak
+memory of the process so far, the records are written to a JSONL log next to the results of the calibration and
+summarized at the end of the run.
+"""
+from __future__ import division
+from __future__ import print_function
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# phases timed in this process since the last call of ``pop_phase_timings``
+PHASE_TIMINGS = []
+
+
+def get_cpu_time():
+    """cpu time of the process and of its finished child processes (e.g. the pool of the demand) [s]"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def get_peak_rss():
+    """peak resident memory of the process so far [MB], None where it is not known"""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / 1024 ** 2  # bytes
+    return peak_rss / 1024  # kilobytes
+
+
+@contextmanager
+def timed(phase, scenario=None):
+    """
+    Records the wall time and cpu time of the code in the ``with`` block as a phase of the calibration. The peak
+    memory of a process never goes down, so the phase records by how much it raised the peak (0 for a phase that used
+    less memory than the process already did) and the peak of the process at its end.
+    """
+    wall_time = time.perf_counter()
+    cpu_time = get_cpu_time()
+    peak_rss = get_peak_rss()
+    try:
+        yield
+    finally:
+        process_peak_rss = get_peak_rss()
+        PHASE_TIMINGS.append({'phase': phase,
+                              'scenario': os.path.basename(os.path.normpath(scenario)) if scenario else None,
+                              'wall_s': time.perf_counter() - wall_time,
+                              'cpu_s': get_cpu_time() - cpu_time,
+                              'peak_rss_increase_mb': process_peak_rss - peak_rss if peak_rss is not None else None,
+                              'process_peak_rss_mb': process_peak_rss,
+                              'pid': os.getpid()})
+
+
+def pop_phase_timings():
+    """the phases timed since the last call (including the preparation of the scenarios before the first trial)"""
+    phase_timings = list(PHASE_TIMINGS)
+    del PHASE_TIMINGS[:]
+    return phase_timings
+
+
+@contextmanager
+def profiled(profile_file):
+    """runs the code in the ``with`` block with cProfile and dumps the stats to ``profile_file`` (if it is not None)"""
+    if profile_file is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(profile_file)
+        print('Profile of the trial saved to {}'.format(profile_file))
+
+
+def append_timings(timings_file, trials):
+    """appends the phase timings of the finished ``trials`` to the JSONL log, one line per phase"""
+    with open(timings_file, 'a') as f:
+        for trial in trials:
+            for phase_timing in trial['result'].get('timings', []):
+                f.write(json.dumps(dict(phase_timing, tid=trial['tid'])) + '\n')
+
+
+def calc_timing_summary(trials):
+    """
+    Summary of the phase timings of all the trials: number, mean and 95th percentile of the wall time of each phase,
+    mean cpu time, largest increase of the peak memory, peak memory of the processes and share of the total wall
+    time.
+    """
+    phase_timings = pd.DataFrame([phase_timing for trial in trials
+                                  for phase_timing in trial['result'].get('timings', [])])
+    if phase_timings.empty:
+        return phase_timings
+    summary = phase_timings.groupby('phase').agg(count=('wall_s', 'size'),
+                                                 wall_mean_s=('wall_s', 'mean'),
+                                                 wall_p95_s=('wall_s', lambda wall_s: np.percentile(wall_s, 95)),
+                                                 wall_total_s=('wall_s', 'sum'),
+                                                 cpu_mean_s=('cpu_s', 'mean'),
+                                                 peak_rss_increase_max_mb=('peak_rss_increase_mb', 'max'),
+                                                 process_peak_rss_max_mb=('process_peak_rss_mb', 'max'))
+    summary['share_%'] = summary['wall_total_s'] / summary['wall_total_s'].sum() * 100
+    return summary.sort_values('wall_total_s', ascending=False)
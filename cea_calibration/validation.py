@@ -3,13 +3,18 @@ This tool compares measured data (observed) with model outputs (predicted), used
 """
 from __future__ import division
 from __future__ import print_function
+import hashlib
+import multiprocessing
 import os
-from math import sqrt
+import glob2
+import numpy as np
 import pandas as pd
-from sklearn.metrics import mean_squared_error as calc_mean_squared_error
 import cea.config
 import cea.inputlocator
 from cea_calibration.global_variables import *
+from cea_calibration.demand_cache import read_monthly_demand
+from cea_calibration.hourly import read_hourly_measurements, read_hourly_building_names, read_hourly_demand, \
+    calc_hourly_errors
 
 # from cea.constants import MONTHS_IN_YEAR_NAMES
 # import cea.examples.global_variables as global_variables
@@ -56,6 +61,13 @@ MONTHS_IN_YEAR_NAMES = ['JANUARY', 'FEBRUARY', 'MARCH', 'APRIL',
                         'MAY', 'JUNE', 'JULY', 'AUGUST', 'SEPTEMBER',
                         'OCTOBER', 'NOVEMBER', 'DECEMBER']
 
+# limits of NMBE and CV(RMSE) [%] of a calibrated building (ASHRAE Guideline 14-2014), and the comparison of the
+# CV(RMSE) with its limit (the guideline includes the hourly limit, the monthly one is kept strict as before)
+MONTHLY_LIMITS = (5, 15, np.less)
+HOURLY_LIMITS = (10, 30, np.less_equal)
+# number of buildings whose hourly values are compared at once
+HOURLY_BLOCK_SIZE = 256
+
 __author__ = "Luis Santos"
 __copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
 __credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
@@ -70,104 +82,407 @@ def validation(scenario_list,
                measured_building_names_of_scenarios,
                monthly=True,
                load='GRID',
+               hourly=False,
                ):
     """
     This tool compares observed (real life measured data) and predicted (output of the model data) values.
+    Each building is compared for the variable of its measurements (``load`` is used when the file has no Variable column).
     Monthly data is compared in terms of NMBE and CvRMSE (follwing ASHRAE Guideline 14-2014).
     A new input folder with measurements has to be created, with a csv each for monthly data provided as input for this tool.
     The input file contains: Name (CEA ID)| ZipCode (optional) | Monthly Data (JAN - DEC) | Type of equivalent variable in CEA (GRID_kWh is the default for total electricity consumption)
     The script prints the NBME and CvRMSE for each building. It also outputs the number of calibrated buildings and a score metric (calibrated buildings weighted by their energy consumption)
+    The measured and modelled values of all the buildings of all the scenarios are stacked in (buildings x 12) arrays, so
+    the errors and scores are calculated in one vectorized pass.
+    With ``hourly``, the buildings of the hourly measurements of each scenario are also compared hour by hour in terms
+    of NMBE and CvRMSE (see ``hourly_validation``). A building with hourly readings is then judged on them instead of on
+    its monthly measurements, in the number of calibrated buildings and in the score.
     """
+    n_calib = 0
+    score = 0.0
+    number_of_buildings = 0
+    validation_results = {}
 
     ## monthly validation
     if monthly:
-        number_of_buildings = 0
         print("monthly validation")
-        validation_output = pd.DataFrame(columns=['scenario', 'calibrated_buildings', 'score'])
-        for scenario, locator, measured_building_names in zip(scenario_list, locators_of_scenarios,
-                                                              measured_building_names_of_scenarios):
-            list_of_scores = []
-            number_of_calibrated = []
-            number_of_buildings = number_of_buildings + len(measured_building_names)
-            # get measured data for buildings in this scenario
-            monthly_measured_data = pd.read_csv(locator.get_monthly_measurements())
-
-            # loop in the measured buildings of this scenario
-            calib_building_names =[]
-            for building_name in measured_building_names:  # number of buildings that have real data available
-                # extract measured data
+        measured, modelled = read_monthly_demand_of_scenarios(locators_of_scenarios,
+                                                              measured_building_names_of_scenarios, load)
+
+        # calculate errors and scores of all the buildings
+        cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors(measured, modelled)
+        calibrated, building_scores = calc_scores(cv_root_mean_squared_error, normalized_mean_biased_error, measured)
+
+        # sum them up for each scenario
+        first_building = 0
+        for scenario, measured_building_names in zip(scenario_list, measured_building_names_of_scenarios):
+            last_building = first_building + len(measured_building_names)
+            for i, building_name in enumerate(measured_building_names, first_building):
                 print('For building', building_name, 'the errors are')
-                fields_to_extract = ['Name'] + MONTHS_IN_YEAR_NAMES
-                monthly_measured_demand = monthly_measured_data[fields_to_extract].set_index('Name')
-                monthly_measured_demand = monthly_measured_demand.loc[building_name]
-                monthly_measured_demand = pd.DataFrame({'Month': monthly_measured_demand.index.values,
-                                                        'measurements': monthly_measured_demand.values})
-
-                # extract model output
-                hourly_modelled_data = pd.read_csv(locator.get_demand_results_file(building_name),
-                                                   usecols=['DATE', load + '_kWh'])
-                hourly_modelled_data['DATE'] = pd.to_datetime(hourly_modelled_data['DATE'])
-
-                look_up = {1: 'JANUARY', 2: 'FEBRUARY', 3: 'MARCH', 4: 'APRIL', 5: 'MAY',
-                           6: 'JUNE', 7: 'JULY', 8: 'AUGUST', 9: 'SEPTEMBER', 10: 'OCTOBER', 11: 'NOVEMBER',
-                           12: 'DECEMBER'}
-
-                # this step is required to have allow the conversion from hourly to monthly data
-                monthly_modelled_data = hourly_modelled_data.resample('M', on='DATE').sum()  # because data is in kWh
-                monthly_modelled_data['Month'] = monthly_modelled_data.index.month
-                monthly_modelled_data['Month'] = monthly_modelled_data.apply(lambda x: look_up[x['Month']], axis=1)
-                monthly_data = monthly_modelled_data.merge(monthly_measured_demand, on='Month')
-
-                # calculate errors
-                cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors_per_building(load, monthly_data)
-
-                ind_calib_building, ind_score_building = calc_building_score(cv_root_mean_squared_error, monthly_data,
-                                                                             normalized_mean_biased_error)
-
-                # appending list of variables for later use
-                if ind_calib_building ==1:
-                    calib_building_names.append(building_name)
-                number_of_calibrated.append(ind_calib_building)
-                list_of_scores.append(ind_score_building)
-            n_scenario_calib = sum(number_of_calibrated)
-            scenario_score = sum(list_of_scores)
-            scenario_name = os.path.basename(scenario)
-            validation_output = validation_output.append(
-                {'scenario': scenario_name, 'calibrated_buildings': n_scenario_calib, 'score': scenario_score},
-                ignore_index=True)
-        n_calib = validation_output['calibrated_buildings'].sum()
-        score = validation_output['score'].sum()
-
-        global_validation_n_calibrated.append(n_calib)
-        global_validation_percentage.append((n_calib / number_of_buildings) * 100)
-
-    print('The number of calibrated buildings is', n_scenario_calib)
-    print('Calibrated buildings for', scenario_name, 'are', calib_building_names)
+                print('NMBE:', round(normalized_mean_biased_error[i], 1))
+                print('CVRMSE:', round(cv_root_mean_squared_error[i], 1))
+            calib_building_names = [building_name for building_name, ind_calib_building in
+                                    zip(measured_building_names, calibrated[first_building:last_building])
+                                    if ind_calib_building == 1]
+            n_scenario_calib = len(calib_building_names)
+            n_calib = n_calib + n_scenario_calib
+            score = score + building_scores[first_building:last_building].sum()
+            print('The number of calibrated buildings is', n_scenario_calib)
+            print('Calibrated buildings for', os.path.basename(scenario), 'are', calib_building_names)
+            first_building = last_building
+        number_of_buildings = first_building
+
+        validation_results.update({'building_names': [building_name for measured_building_names in
+                                                      measured_building_names_of_scenarios
+                                                      for building_name in measured_building_names],
+                                   'measured': measured,
+                                   'modelled': modelled,
+                                   'normalized_mean_biased_error': normalized_mean_biased_error,
+                                   'cv_root_mean_squared_error': cv_root_mean_squared_error,
+                                   'calibrated': calibrated,
+                                   'score': building_scores})
+
+    ## hourly validation
+    if hourly:
+        print("hourly validation")
+        hourly_results = hourly_validation(scenario_list, locators_of_scenarios, load)
+        validation_results['hourly'] = hourly_results
+        if monthly:
+            # the buildings with hourly readings are judged on them instead of on their monthly measurements
+            hourly_buildings = set(zip(hourly_results['scenarios'], hourly_results['building_names']))
+            judged_monthly = np.array([(i, building_name) not in hourly_buildings
+                                       for i, measured_building_names in enumerate(measured_building_names_of_scenarios)
+                                       for building_name in measured_building_names], dtype=bool)
+            n_calib = int(calibrated[judged_monthly].sum())
+            score = building_scores[judged_monthly].sum()
+            number_of_buildings = int(judged_monthly.sum())
+        n_calib = n_calib + int(hourly_results['calibrated'].sum())
+        score = score + hourly_results['score'].sum()
+        number_of_buildings = number_of_buildings + len(hourly_results['building_names'])
+        print('The number of calibrated buildings is', n_calib, 'of', number_of_buildings)
+
+    global_validation_n_calibrated.append(n_calib)
+    global_validation_percentage.append((n_calib / number_of_buildings) * 100 if number_of_buildings else 0.0)
+    global_validation_results.append(validation_results)
     print('The final score is', score)
     return score
 
 
-def calc_errors_per_building(load, monthly_data):
-    biased_error = monthly_data['measurements'] - monthly_data[load + '_kWh']
-    normalized_mean_biased_error = ((biased_error.sum() / 12) / monthly_data[
-        'measurements'].mean()) * 100  # %
-    print('NMBE:', round(normalized_mean_biased_error,1))
-    mean_squared_error = calc_mean_squared_error(monthly_data['measurements'], monthly_data[load + '_kWh'])
-    root_mean_squared_error = sqrt(mean_squared_error)  # root mean squared error
-    cv_root_mean_squared_error = root_mean_squared_error * 100 / monthly_data['measurements'].mean()
-    print('CVRMSE:', round(cv_root_mean_squared_error,1))
+def hourly_validation(scenario_list, locators_of_scenarios, load='GRID'):
+    """
+    Compares the hourly measurements of the buildings of each scenario with their hourly demand (see
+    ``calc_hourly_validation``). The scenarios without hourly measurements are skipped.
+
+    :return: the errors and scores of the buildings (see ``calc_hourly_validation``), with their ``building_names`` and
+        the index of their scenario in ``scenario_list`` (``scenarios``)
+    """
+    building_names = []
+    scenarios = []
+    results_of_scenarios = []
+    score = 0.0
+    for i, (scenario, locator) in enumerate(zip(scenario_list, locators_of_scenarios)):
+        if not os.path.exists(locator.get_hourly_measurements()):
+            continue
+        scenario_building_names, results = calc_hourly_validation(locator, load)
+        for k, building_name in enumerate(scenario_building_names):
+            print('For building', building_name, 'the hourly errors are')
+            print('NMBE:', round(results['normalized_mean_biased_error'][k], 1))
+            print('CVRMSE:', round(results['cv_root_mean_squared_error'][k], 1))
+        calib_building_names = [building_name for building_name, ind_calib_building in
+                                zip(scenario_building_names, results['calibrated']) if ind_calib_building == 1]
+        score = score + results['score'].sum()
+        print('The number of calibrated buildings (hourly) is', len(calib_building_names))
+        print('Calibrated buildings (hourly) for', os.path.basename(scenario), 'are', calib_building_names)
+        building_names.extend(scenario_building_names)
+        scenarios.extend([i] * len(scenario_building_names))
+        results_of_scenarios.append(results)
+    print('The hourly score is', score)
+
+    hourly_results = dict((key, np.concatenate([empty] + [results[key] for results in results_of_scenarios]))
+                          for key, empty in make_hourly_results(0).items())
+    hourly_results.update({'building_names': building_names, 'scenarios': np.array(scenarios, dtype=int)})
+    return hourly_results
+
+
+def make_hourly_results(n_buildings):
+    """zero errors and scores of ``n_buildings`` buildings, to be filled by ``calc_hourly_validation``"""
+    return {'measured_kWh': np.zeros(n_buildings),
+            'modelled_kWh': np.zeros(n_buildings),
+            'normalized_mean_biased_error': np.zeros(n_buildings),
+            'cv_root_mean_squared_error': np.zeros(n_buildings),
+            'calibrated': np.zeros(n_buildings, dtype=int),
+            'score': np.zeros(n_buildings)}
+
+
+def calc_hourly_validation(locator, load='GRID'):
+    """
+    Compares the hourly measurements (see ``read_hourly_measurements``) of the buildings of a scenario with their
+    hourly demand, ``HOURLY_BLOCK_SIZE`` buildings at a time, without printing them. A building is calibrated with an
+    NMBE within 10% and a CvRMSE of at most 30% (ASHRAE Guideline for hourly data).
+
+    :return: the names of the buildings, and their measured and modelled consumption over the hours with a reading
+        [kWh], errors, calibrated flag and score (the measured consumption of the calibrated buildings)
+    """
+    building_names, hourly_measured = read_hourly_measurements(locator)
+    results = make_hourly_results(len(building_names))
+    for first_building in range(0, len(building_names), HOURLY_BLOCK_SIZE):
+        block = slice(first_building, first_building + HOURLY_BLOCK_SIZE)
+        measured = np.asarray(hourly_measured[block], dtype=float)
+        modelled = read_hourly_demand(locator, building_names[block], load)
+        cv_root_mean_squared_error, normalized_mean_biased_error = calc_hourly_errors(measured, modelled)
+        results['calibrated'][block], results['score'][block] = calc_scores(
+            cv_root_mean_squared_error, normalized_mean_biased_error, np.nan_to_num(measured), HOURLY_LIMITS)
+        results['cv_root_mean_squared_error'][block] = cv_root_mean_squared_error
+        results['normalized_mean_biased_error'][block] = normalized_mean_biased_error
+        results['measured_kWh'][block] = np.nansum(measured, axis=1)
+        results['modelled_kWh'][block] = np.where(np.isnan(measured), 0.0, np.nan_to_num(modelled)).sum(axis=1)
+    return building_names, results
+
+
+def read_monthly_demand_of_scenarios(locators_of_scenarios, measured_building_names_of_scenarios, load='GRID'):
+    """
+    Monthly measured and modelled demand of the measured buildings of all the scenarios, stacked in the order of
+    ``measured_building_names_of_scenarios``.
+
+    :return: measured and modelled demand [kWh], arrays of (buildings x 12)
+    """
+    measured_of_scenarios = []
+    modelled_of_scenarios = []
+    for locator, measured_building_names in zip(locators_of_scenarios, measured_building_names_of_scenarios):
+        # get measured data and model output for buildings in this scenario
+        monthly_measured_data = pd.read_csv(locator.get_monthly_measurements()).set_index('Name')
+        monthly_measured_data = monthly_measured_data.loc[measured_building_names]
+        measured_of_scenarios.append(monthly_measured_data[MONTHS_IN_YEAR_NAMES].values)
+        modelled_of_scenarios.append(calc_monthly_modelled_demand(locator, measured_building_names,
+                                                                  get_measured_loads(monthly_measured_data, load)))
+    return np.concatenate(measured_of_scenarios).astype(float), np.concatenate(modelled_of_scenarios)
+
+
+def get_measured_loads(monthly_measured_data, load='GRID'):
+    """
+    Load variable (without unit, e.g. GRID) that was measured for each building, from the Variable column of the
+    measurements. ``load`` is used for all buildings if the measurements have no Variable column.
+    """
+    variable_columns = [column for column in monthly_measured_data.columns if column.upper() == 'VARIABLE']
+    if not variable_columns:
+        return [load] * len(monthly_measured_data)
+    return [variable.split('_kWh')[0] for variable in monthly_measured_data[variable_columns[0]].fillna(load + '_kWh')]
+
+
+def calc_monthly_modelled_demand(locator, building_names, loads):
+    """
+    Monthly modelled demand of the buildings (read through the monthly demand cache of the scenario).
+
+    :param loads: load variable of each building
+    :return: monthly modelled demand [kWh], array of (buildings x 12)
+    """
+    monthly_demand = read_monthly_demand(locator, building_names, sorted(set(loads)))
+    return np.array([monthly_demand[load][i] for i, load in enumerate(loads)]).reshape(len(building_names), 12)
+
+
+def calc_errors(measured, modelled):
+    """
+    Normalized mean bias error and coefficient of variation of the root mean squared error of many buildings at once.
+
+    :param measured: measured values, array of (buildings x periods)
+    :param modelled: modelled values, array of (buildings x periods)
+    :return: CV(RMSE) and NMBE [%] of each building
+    """
+    biased_error = measured - modelled
+    mean_measured = measured.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):  # buildings without consumption are never calibrated
+        normalized_mean_biased_error = (biased_error.mean(axis=1) / mean_measured) * 100  # %
+        root_mean_squared_error = np.sqrt((biased_error ** 2).mean(axis=1))
+        cv_root_mean_squared_error = root_mean_squared_error * 100 / mean_measured
     return cv_root_mean_squared_error, normalized_mean_biased_error
 
 
+def calc_scores(cv_root_mean_squared_error, normalized_mean_biased_error, measured, limits=MONTHLY_LIMITS):
+    """
+    Indicates which buildings are calibrated (NMBE < 5% and CVRMSE < 15%, ASHRAE Guideline for monthly data, or the
+    ``limits`` of other data, e.g. CVRMSE <= 30% for hourly data) and weights them by their measured energy consumption.
+
+    :return: calibrated flag (0 or 1) and score of each building
+    """
+    nmbe_limit, cv_root_mean_squared_error_limit, within_limit = limits
+    ind_calib_building = ((np.abs(normalized_mean_biased_error) < nmbe_limit) &
+                          within_limit(cv_root_mean_squared_error, cv_root_mean_squared_error_limit)).astype(int)
+    ind_score_building = ind_calib_building * measured.sum(axis=1)
+    return ind_calib_building, ind_score_building
+
+
+def calc_building_loss(cv_root_mean_squared_error, normalized_mean_biased_error):
+    """
+    Loss of the search of each building: its NMBE and CV(RMSE) relative to the ASHRAE limits (5% and 15%), below 1 the
+    building is calibrated. Unlike the calibrated flag of the score, the loss also guides the search while the building
+    is far from calibrated.
+    """
+    with np.errstate(invalid='ignore'):
+        loss = np.maximum(np.abs(normalized_mean_biased_error) / 5.0, cv_root_mean_squared_error / 15.0)
+    return np.where(np.isfinite(loss), loss, 1e6)  # buildings without measured consumption can not be calibrated
+
+
+def calc_errors_per_building(load, monthly_data):
+    cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors(
+        monthly_data['measurements'].values[np.newaxis].astype(float), monthly_data[load + '_kWh'].values[np.newaxis])
+    print('NMBE:', round(normalized_mean_biased_error[0], 1))
+    print('CVRMSE:', round(cv_root_mean_squared_error[0], 1))
+    return cv_root_mean_squared_error[0], normalized_mean_biased_error[0]
+
+
 def calc_building_score(cv_root_mean_squared_error, monthly_data, normalized_mean_biased_error):
-    # indicates if the building is calibrated or not
-    if abs(normalized_mean_biased_error) < 5 and cv_root_mean_squared_error < 15:  #a building is considered calibrated if NMBE<5 and CVRMSE <15 (ASHRAE Guideline for monthly data)
-        ind_calib_building = 1
+    ind_calib_building, ind_score_building = calc_scores(np.array([cv_root_mean_squared_error]),
+                                                         np.array([normalized_mean_biased_error]),
+                                                         monthly_data['measurements'].values[np.newaxis])
+    return ind_calib_building[0], ind_score_building[0]
+
+
+def get_measured_scenarios(project_path, hourly=False):
+    """
+    The scenarios of the project with measurements (``inputs/measurements/monthly_measurements.csv``, and with
+    ``hourly`` also those with only ``hourly_measurements.csv``), without the workspaces left in ``output/calibration``
+    by calibrations that did not finish.
+    """
+    measurement_files = glob2.glob(project_path + '/**/monthly_measurements.csv')
+    if hourly:
+        measurement_files = measurement_files + glob2.glob(project_path + '/**/hourly_measurements.csv')
+    calibration_output = os.path.abspath(os.path.join(project_path, 'output', 'calibration'))
+    scenario_list = []
+    for f in sorted(measurement_files):
+        scenario = os.path.dirname(os.path.dirname(os.path.dirname(f)))
+        if not os.path.abspath(f).startswith(calibration_output) and scenario not in scenario_list:
+            scenario_list.append(scenario)
+    return scenario_list
+
+
+def calc_scenario_fingerprint(locator, building_names):
+    """
+    Fingerprint of the measurements and the demand results of the measured buildings of a scenario (their paths,
+    sizes and modification times), None if a demand result is missing.
+    """
+    files = [f for f in [locator.get_monthly_measurements(), locator.get_hourly_measurements()] if os.path.exists(f)]
+    files = files + [locator.get_demand_results_file(building_name) for building_name in building_names]
+    if not all(os.path.exists(f) for f in files):
+        return None
+    fingerprint = hashlib.sha1()
+    for f in files:
+        stat = os.stat(f)
+        fingerprint.update('{}|{}|{}\n'.format(os.path.abspath(f), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def validate_scenario(scenario, plugins, load='GRID'):
+    """
+    Errors and score of each measured building of a scenario (see ``validation``), without printing them. A building
+    with hourly readings is judged on them instead of on its monthly measurements (the ``resolution`` of its row).
+
+    :return: one row per measured building, with the fingerprint of the validated files (see
+        ``calc_scenario_fingerprint``)
+    """
+    locator = cea.inputlocator.InputLocator(scenario, plugins)
+    fingerprint = calc_scenario_fingerprint(locator, get_validated_building_names(locator))
+    tables = []
+    if os.path.exists(locator.get_monthly_measurements()):
+        monthly_measured_data = pd.read_csv(locator.get_monthly_measurements()).set_index('Name')
+        measured_building_names = list(monthly_measured_data.index)
+        measured, modelled = read_monthly_demand_of_scenarios([locator], [measured_building_names], load)
+        cv_root_mean_squared_error, normalized_mean_biased_error = calc_errors(measured, modelled)
+        calibrated, building_scores = calc_scores(cv_root_mean_squared_error, normalized_mean_biased_error, measured)
+        tables.append(pd.DataFrame({'scenario': scenario,
+                                    'Name': measured_building_names,
+                                    'resolution': 'monthly',
+                                    'variable': [measured_load + '_kWh' for measured_load in
+                                                 get_measured_loads(monthly_measured_data, load)],
+                                    'measured_kWh': measured.sum(axis=1),
+                                    'modelled_kWh': modelled.sum(axis=1),
+                                    'normalized_mean_biased_error': normalized_mean_biased_error,
+                                    'cv_root_mean_squared_error': cv_root_mean_squared_error,
+                                    'calibrated': calibrated,
+                                    'score': building_scores}))
+    if os.path.exists(locator.get_hourly_measurements()):
+        hourly_building_names, hourly_results = calc_hourly_validation(locator, load)
+        tables.append(pd.DataFrame({'scenario': scenario,
+                                    'Name': hourly_building_names,
+                                    'resolution': 'hourly',
+                                    'variable': load + '_kWh',
+                                    'measured_kWh': hourly_results['measured_kWh'],
+                                    'modelled_kWh': hourly_results['modelled_kWh'],
+                                    'normalized_mean_biased_error': hourly_results['normalized_mean_biased_error'],
+                                    'cv_root_mean_squared_error': hourly_results['cv_root_mean_squared_error'],
+                                    'calibrated': hourly_results['calibrated'],
+                                    'score': hourly_results['score']}))
+    results = pd.concat(tables, ignore_index=True).drop_duplicates('Name', keep='last')  # the hourly rows are last
+    results['fingerprint'] = fingerprint
+    return results
+
+
+def validate_project(config, load='GRID'):
+    """
+    Validates all the scenarios of the project with measurements (see ``get_measured_scenarios``) and writes the errors
+    of all their measured buildings to one table (``get_project_calibration_results``). A scenario whose measurements
+    and demand results did not change since the last validation keeps its rows, unless ``validation:force``. The other
+    scenarios are validated in parallel (with ``general:multiprocessing``), the largest first.
+
+    :return: the table of all the measured buildings of the project
+    """
+    locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
+    results_file = os.path.normpath(locator.get_project_calibration_results())
+    scenario_list = get_measured_scenarios(config.project, hourly=True)
+
+    previous_results = pd.DataFrame(columns=['scenario', 'fingerprint'])
+    if os.path.exists(results_file) and not config.validation.force:
+        previous_results = pd.read_csv(results_file)
+        if 'resolution' not in previous_results.columns:  # written before the hourly measurements, validated again
+            previous_results = pd.DataFrame(columns=['scenario', 'fingerprint'])
+
+    # the scenarios whose files did not change since the last validation are skipped
+    results_of_scenarios = {}
+    changed_scenarios = []
+    for scenario in scenario_list:
+        scenario_locator = cea.inputlocator.InputLocator(scenario, config.plugins)
+        measured_building_names = get_validated_building_names(scenario_locator)
+        fingerprint = calc_scenario_fingerprint(scenario_locator, measured_building_names)
+        if fingerprint is None:
+            print('Skipping {}, it has no demand results for all its measured buildings'.format(scenario))
+            continue
+        scenario_results = previous_results[previous_results['scenario'] == scenario]
+        if len(scenario_results) and (scenario_results['fingerprint'] == fingerprint).all():
+            results_of_scenarios[scenario] = scenario_results
+        else:
+            changed_scenarios.append((len(measured_building_names), scenario))
+    print('Validating {} scenarios, {} unchanged since the last validation'.format(len(changed_scenarios),
+                                                                                 len(results_of_scenarios)))
+
+    tasks = [(scenario, config.plugins, load) for _, scenario in sorted(changed_scenarios, reverse=True)]
+    number_of_processes = min(config.get_number_of_processes(), len(tasks))
+    if config.multiprocessing and number_of_processes > 1:
+        pool = multiprocessing.Pool(number_of_processes)
+        try:
+            scenario_results = pool.starmap(validate_scenario, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
     else:
-        ind_calib_building = 0
-    # weights the calibration by building energy consumption
-    ind_score_building = ind_calib_building * sum(monthly_data['measurements'])
-    return ind_calib_building, ind_score_building
+        scenario_results = [validate_scenario(*task) for task in tasks]
+    results_of_scenarios.update((task[0], results) for task, results in zip(tasks, scenario_results))
+
+    if not results_of_scenarios:
+        print('No scenario of the project could be validated')
+        return None
+
+    # one table for the project, in the order of the scenarios
+    results = pd.concat([results_of_scenarios[scenario] for scenario in scenario_list
+                         if scenario in results_of_scenarios], ignore_index=True)
+    temporary_file = results_file + '.tmp'
+    results.to_csv(temporary_file, index=False)
+    os.replace(temporary_file, results_file)
+
+    for scenario, scenario_results in results.groupby('scenario', sort=False):
+        print('{}: {} of {} buildings calibrated, score {}'.format(os.path.basename(scenario),
+                                                                    scenario_results['calibrated'].sum(),
+                                                                    len(scenario_results),
+                                                                    scenario_results['score'].sum()))
+    print('The validation of the project is saved to {}'.format(results_file))
+    return results
 
 
 def get_measured_building_names(locator):
@@ -177,6 +492,19 @@ def get_measured_building_names(locator):
     return measured_building_names
 
 
+def get_validated_building_names(locator):
+    """the buildings of the monthly and of the hourly measurements of a scenario, of those that exist"""
+    building_names = []
+    if os.path.exists(locator.get_monthly_measurements()):
+        building_names.extend(get_measured_building_names(locator))
+    if os.path.exists(locator.get_hourly_measurements()):
+        monthly_building_names = set(building_names)
+        building_names.extend(building_name for building_name in
+                              read_hourly_building_names(locator.get_hourly_measurements())
+                              if building_name not in monthly_building_names)
+    return building_names
+
+
 def main(config):
     """
     This is the main entry point to your script. Any parameters used by your script must be present in the ``config``
@@ -189,8 +517,15 @@ def main(config):
     :return:
     """
     assert os.path.exists(config.scenario), 'Scenario not found: %s' % config.scenario
+    if config.validation.project:
+        validate_project(config)
+        return
     locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
-    measured_building_names = get_measured_building_names(locator)
+    # a scenario can have monthly measurements, hourly measurements (e.g. of smart meters) or both
+    monthly = os.path.exists(locator.get_monthly_measurements())
+    hourly = os.path.exists(locator.get_hourly_measurements())
+    assert monthly or hourly, 'No measurements found in: %s' % os.path.dirname(locator.get_monthly_measurements())
+    measured_building_names = get_measured_building_names(locator) if monthly else []
     scenario_list = [config.scenario]
     locators_of_scenarios = [locator]
     measured_building_names_of_scenarios = [measured_building_names]
@@ -198,8 +533,9 @@ def main(config):
     validation(scenario_list,
                locators_of_scenarios,
                measured_building_names_of_scenarios,
-               monthly=True,
+               monthly=monthly,
                load='GRID',
+               hourly=hourly,
                )
 
 
@@ -0,0 +1,111 @@
+"""
+Scenario workspaces used by the calibration. A workspace is a cheap clone of a scenario where a trial can write its
+inputs and run schedules and demand without touching the scenario of the user: the inputs that are only read (weather,
+geometry, databases, measurements) and the outputs the demand reads (solar radiation) are hardlinked, and only the files
+modified by the trials are copied.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import cea.inputlocator
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+
+def get_mutable_paths(locator):
+    """
+    Files and folders of a scenario that are written during a calibration trial. These are copied into a workspace,
+    everything else is hardlinked (a hardlinked file shares its content with the scenario, so writing to it would
+    change the inputs of the user).
+    """
+    return [locator.get_building_architecture(),
+            locator.get_building_internal(),
+            locator.get_building_comfort(),
+            os.path.splitext(locator.get_zone_geometry())[0] + '.dbf',
+            locator.get_building_weekly_schedules_folder()]
+
+
+def get_read_only_outputs(locator):
+    """
+    Outputs of a scenario that the demand reads but the trials do not write. These are hardlinked into a workspace, the
+    other outputs of the scenario are not cloned (the trials create their own).
+    """
+    return [locator.get_solar_radiation_folder()]
+
+
+def link_or_copy(source_file, target_file):
+    try:
+        os.link(source_file, target_file)
+    except OSError:
+        # e.g. file systems without hardlinks or a workspace on another drive
+        shutil.copy2(source_file, target_file)
+
+
+def create_workspace(scenario, workspace, plugins):
+    """
+    Clones ``scenario`` into the folder ``workspace`` (replacing an existing one) and returns the locator of the clone.
+    Of the outputs of the scenario, only the ones read by the demand are cloned (see ``get_read_only_outputs``).
+    """
+    locator = cea.inputlocator.InputLocator(scenario, plugins)
+    mutable_paths = [os.path.normcase(os.path.abspath(path)) for path in get_mutable_paths(locator)]
+    read_only_outputs = [path for path in get_read_only_outputs(locator) if os.path.isdir(path)]
+
+    def is_mutable(path):
+        path = os.path.normcase(os.path.abspath(path))
+        return any(path == mutable_path or path.startswith(mutable_path + os.sep) for mutable_path in mutable_paths)
+
+    remove_workspace(workspace)
+    for source_folder in [scenario] + read_only_outputs:
+        for folder, sub_folders, file_names in os.walk(source_folder):
+            if os.path.abspath(folder) == os.path.abspath(scenario) and 'outputs' in sub_folders:
+                sub_folders.remove('outputs')
+            workspace_folder = os.path.join(workspace, os.path.relpath(folder, scenario))
+            if not os.path.exists(workspace_folder):
+                os.makedirs(workspace_folder)
+            for file_name in file_names:
+                source_file = os.path.join(folder, file_name)
+                if is_mutable(source_file):
+                    shutil.copy2(source_file, os.path.join(workspace_folder, file_name))
+                else:
+                    link_or_copy(source_file, os.path.join(workspace_folder, file_name))
+    return cea.inputlocator.InputLocator(workspace, plugins)
+
+
+def create_workspaces(scenario_list, workspaces_path, plugins):
+    """
+    Clones every scenario of ``scenario_list`` into ``workspaces_path`` and returns the paths of the clones (in the same
+    order). Each clone sits in its own numbered folder, so scenarios with the same name in different folders of the
+    project do not collide.
+    """
+    workspace_list = []
+    for i, scenario in enumerate(scenario_list):
+        workspace = os.path.join(workspaces_path, str(i), os.path.basename(os.path.normpath(scenario)))
+        create_workspace(scenario, workspace, plugins)
+        workspace_list.append(workspace)
+    return workspace_list
+
+
+def make_workspaces_folder(project):
+    """
+    Creates an empty folder for the workspaces of one calibration run in the output folder of the project (on the
+    same drive as the scenarios, so the inputs can be hardlinked). Several runs on the same project get separate
+    folders.
+    """
+    output_path = os.path.join(project, 'output', 'calibration')
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    return tempfile.mkdtemp(prefix='workspaces-', dir=output_path)
+
+
+def remove_workspace(workspace):
+    if os.path.exists(workspace):
+        shutil.rmtree(workspace, ignore_errors=True)
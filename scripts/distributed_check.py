@@ -0,0 +1,152 @@
+"""
+Check of the distributed calibration on this machine: a coordinator (``QueuePool``) and two workers (``run_worker``) in
+processes of their own evaluate trials of a small synthetic project with the stand-in demand of the benchmark (see
+``benchmark.use_standin_demand``). The check covers the claiming of the trials, the posting of their results and the
+re-queuing of the task of a worker that stops beating, which is simulated by a task that kills its worker the first
+time it runs. Run it with ``python scripts/distributed_check.py`` in an environment with CEA and the plugin installed,
+it raises an ``AssertionError`` on failure.
+"""
+from __future__ import division
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from queue import Queue, Empty
+import numpy as np
+import cea.config
+from cea_calibration.benchmark import make_synthetic_project, use_standin_demand
+from cea_calibration.calibration import init_trial_worker, evaluate_trial_in_worker, DYNAMIC_PARAMETERS
+from cea_calibration.distributed import get_queue_file, QueuePool, run_worker, POLL_SECONDS
+from cea_calibration.screening import get_uniform_range
+from cea_calibration.workspace import make_workspaces_folder, remove_workspace
+
+__author__ = "Luis Santos"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Luis Santos, Jimeno Fonseca, Daren Thomas"]
+__license__ = "MIT"
+__version__ = "1.0"
+__maintainer__ = "Daren Thomas"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# short timeout of the workers, so that the lost worker is detected within seconds
+WORKER_TIMEOUT_SECONDS = 5.0
+N_WORKERS = 2
+N_BUILDINGS = 10
+N_TRIALS = 8
+
+
+def run_standin_worker(queue_file, config, scenario_list, workspaces_path):
+    """``run_worker`` with the trial workers of the calibration and the stand-in demand"""
+    with use_standin_demand():
+        run_worker(queue_file, init_trial_worker, (config, scenario_list, workspaces_path,
+                                                   {'profile_trial': None, 'profile_file': None}, None))
+
+
+def evaluate_trial_with_worker(seed, tid, dynamic_params):
+    """(process id of the worker, result of ``evaluate_trial_in_worker``)"""
+    return os.getpid(), evaluate_trial_in_worker(seed, tid, dynamic_params)
+
+
+def lose_worker(marker_file):
+    """
+    Kills its worker without a result the first time it runs (the heartbeat of the task stops with it), and returns the
+    process ids of the lost worker and of the worker that ran it again.
+    """
+    if not os.path.exists(marker_file):
+        with open(marker_file, 'w') as f:
+            f.write(str(os.getpid()))
+        os._exit(1)
+    with open(marker_file) as f:
+        return int(f.read()), os.getpid()
+
+
+def calc_random_points(n_points, seed=0):
+    """values of the dynamic parameters drawn uniformly from their ranges"""
+    generator = np.random.default_rng(seed)
+    return [dict((label, float(generator.uniform(*get_uniform_range(expression))))
+                 for label, expression in DYNAMIC_PARAMETERS.items()) for _ in range(n_points)]
+
+
+def wait_for_result(queue, timeout):
+    """the result a callback put into ``queue``, fails after ``timeout`` seconds"""
+    try:
+        return queue.get(timeout=timeout)
+    except Empty:
+        raise AssertionError('No result after {:.0f} s'.format(timeout))
+
+
+def run_check(config, project_path):
+    """runs the coordinator in this process and the workers in processes of their own on the project ``project_path``"""
+    scenario_list = make_synthetic_project(project_path, 1, N_BUILDINGS, config.plugins)
+    config.project = project_path
+    config.scenario = scenario_list[0]
+    queue_file = get_queue_file(project_path)
+    os.makedirs(os.path.dirname(queue_file))
+    workspaces_path = make_workspaces_folder(project_path)
+
+    pool = QueuePool(queue_file, WORKER_TIMEOUT_SECONDS)
+    workers = [multiprocessing.Process(target=run_standin_worker, args=(queue_file, config, scenario_list,
+                                                                        workspaces_path))
+               for _ in range(N_WORKERS)]
+    for worker in workers:
+        worker.start()
+    worker_pids = set(worker.pid for worker in workers)
+    try:
+        # the trials are claimed by the workers and their results posted back to the coordinator
+        seed = 0
+        results = pool.starmap(evaluate_trial_with_worker, [(seed, tid, dynamic_params) for tid, dynamic_params
+                                                            in enumerate(calc_random_points(N_TRIALS))])
+        assert [tid for _, (tid, _) in results] == list(range(N_TRIALS)), 'The results are not those of the trials'
+        assert all(np.isfinite(result['loss']) and result['seed'] == seed for _, (_, result) in results), \
+            'A trial has no score'
+        assert set(pid for pid, _ in results) <= worker_pids, 'A trial was evaluated outside of the workers'
+        print('{} trials evaluated by the workers {}'.format(N_TRIALS, sorted(set(pid for pid, _ in results))))
+
+        # the task of a worker that stops beating is given to the other worker
+        finished = Queue()
+        pool.apply_async(lose_worker, (os.path.join(project_path, 'lost_worker.txt'),), callback=finished.put,
+                         error_callback=finished.put)
+        result = wait_for_result(finished, WORKER_TIMEOUT_SECONDS + 10 * POLL_SECONDS + 60)
+        assert not isinstance(result, Exception), 'The task of the lost worker failed: {}'.format(result)
+        lost_pid, rerun_pid = result
+        assert lost_pid in worker_pids and rerun_pid in worker_pids and lost_pid != rerun_pid, \
+            'The task of the lost worker {} was not run again by the other worker'.format(lost_pid)
+        print('The task of the lost worker {} was run again by the worker {}'.format(lost_pid, rerun_pid))
+    finally:
+        pool.terminate()
+        pool.join()
+        deadline = time.time() + 60
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        remove_workspace(workspaces_path)
+
+    # the other worker stops once the coordinator closes the queue
+    exit_codes = dict((worker.pid, worker.exitcode) for worker in workers)
+    assert exit_codes[lost_pid] == 1 and exit_codes[rerun_pid] == 0, \
+        'The workers did not stop as expected: {}'.format(exit_codes)
+
+
+def main(config):
+    """
+    Checks the distributed calibration with two local workers on a synthetic project in a temporary folder.
+
+    :param config:
+    :type config: cea.config.Configuration
+    :return:
+    """
+    project_path = tempfile.mkdtemp(prefix='cea-calibration-distributed-')
+    try:
+        run_check(config, project_path)
+    finally:
+        shutil.rmtree(project_path, ignore_errors=True)
+    print('The distributed calibration works')
+
+
+if __name__ == '__main__':
+    main(cea.config.Configuration())